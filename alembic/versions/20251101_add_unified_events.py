@@ -0,0 +1,134 @@
+"""Replace messages and user_actions_log with unified events table
+
+Revision ID: 003_unified_events
+Revises: 002_add_media_template
+Create Date: 2025-11-01
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '003_unified_events'
+down_revision = '002_add_media_template'
+branch_labels = None
+depends_on = None
+
+
+USER_ACTIONS_LOG_VIEW = """
+    CREATE OR REPLACE VIEW user_actions_log AS
+    SELECT e.id,
+           e.user_id,
+           CASE WHEN e.event_type = 0 THEN split_part(e.payload, ':', 1) ELSE t.name END AS action,
+           CASE WHEN e.event_type = 0 THEN substr(e.payload, strpos(e.payload, ':') + 1) ELSE e.payload END AS object,
+           e.created_at
+    FROM events e
+    JOIN event_types t ON t.code = e.event_type
+"""
+
+MESSAGES_VIEW = """
+    CREATE OR REPLACE VIEW messages AS
+    SELECT e.id,
+           e.user_id,
+           CASE e.event_type WHEN 7 THEN 'command' WHEN 8 THEN 'media' ELSE 'text' END AS message_type,
+           CASE WHEN e.event_type = 7 THEN 'set_car: ' || e.payload || '...' ELSE e.payload END AS content,
+           e.created_at
+    FROM events e
+    WHERE e.event_type IN (7, 8, 9)
+"""
+
+
+def _is_table(conn, name: str) -> bool:
+    result = conn.execute(sa.text("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_class
+            WHERE oid = to_regclass(:name) AND relkind = 'r'
+        )
+    """), {"name": name})
+    return result.scalar()
+
+
+def upgrade() -> None:
+    """Create events table, migrate user_actions_log and replace old tables with views."""
+    conn = op.get_bind()
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS event_types (
+          code        SMALLINT PRIMARY KEY,
+          name        TEXT UNIQUE NOT NULL
+        )
+    """)
+    op.execute("""
+        INSERT INTO event_types (code, name) VALUES
+          (0, 'other'),
+          (1, 'start'),
+          (2, 'menu_action'),
+          (3, 'support_command'),
+          (4, 'my_car'),
+          (5, 'delete_car'),
+          (6, 'set_car_start'),
+          (7, 'set_car'),
+          (8, 'media_message'),
+          (9, 'text_question'),
+          (10, 'limit_exhausted')
+        ON CONFLICT (code) DO NOTHING
+    """)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+          id          BIGSERIAL PRIMARY KEY,
+          user_id     BIGINT NOT NULL,
+          event_type  SMALLINT NOT NULL,
+          payload     TEXT,
+          created_at  TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+
+    if _is_table(conn, 'user_actions_log'):
+        # Каждая запись messages дублировала запись user_actions_log,
+        # поэтому в events переносится только журнал действий
+        op.execute("""
+            INSERT INTO events (user_id, event_type, payload, created_at)
+            SELECT l.user_id,
+                   COALESCE(t.code, 0),
+                   CASE WHEN t.code IS NULL THEN l.action || ':' || COALESCE(l.object, '') ELSE l.object END,
+                   COALESCE(l.created_at, NOW())
+            FROM user_actions_log l
+            LEFT JOIN event_types t ON t.name = l.action
+            ORDER BY l.id
+        """)
+        op.execute("ALTER TABLE user_actions_log RENAME TO user_actions_log_legacy")
+        print("✅ Migrated user_actions_log into events (old table kept as user_actions_log_legacy)")
+    else:
+        print("ℹ️  user_actions_log is already a view")
+
+    if _is_table(conn, 'messages'):
+        op.execute("ALTER TABLE messages RENAME TO messages_legacy")
+        print("✅ Renamed messages to messages_legacy")
+    else:
+        print("ℹ️  messages is already a view")
+
+    # Индексы создаются после переноса данных, чтобы не перестраивать их построчно
+    op.execute("CREATE INDEX IF NOT EXISTS idx_events_created_at ON events USING BRIN (created_at)")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_events_user_created ON events (user_id, created_at)")
+
+    op.execute(USER_ACTIONS_LOG_VIEW)
+    op.execute(MESSAGES_VIEW)
+    print("✅ Created compatibility views user_actions_log and messages")
+
+
+def downgrade() -> None:
+    """Drop views and restore legacy tables."""
+    conn = op.get_bind()
+
+    op.execute("DROP VIEW IF EXISTS user_actions_log")
+    op.execute("DROP VIEW IF EXISTS messages")
+
+    if _is_table(conn, 'user_actions_log_legacy'):
+        op.execute("ALTER TABLE user_actions_log_legacy RENAME TO user_actions_log")
+    if _is_table(conn, 'messages_legacy'):
+        op.execute("ALTER TABLE messages_legacy RENAME TO messages")
+
+    op.execute("DROP TABLE IF EXISTS events")
+    op.execute("DROP TABLE IF EXISTS event_types")
+    print("✅ Restored messages and user_actions_log tables, dropped events")
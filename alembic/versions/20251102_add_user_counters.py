@@ -0,0 +1,73 @@
+"""Add denormalized question_count and last_seen_at to users
+
+Revision ID: 004_user_counters
+Revises: 003_unified_events
+Create Date: 2025-11-02
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '004_user_counters'
+down_revision = '003_unified_events'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Add counters to users, backfill them and install the rag_requests trigger."""
+    op.execute("""
+        ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS question_count INTEGER NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP
+    """)
+
+    # Заполняем счётчики по уже накопленным данным
+    op.execute("""
+        UPDATE users u
+        SET question_count = r.cnt
+        FROM (SELECT user_id, COUNT(*) AS cnt FROM rag_requests GROUP BY user_id) r
+        WHERE u.user_id = r.user_id
+    """)
+    op.execute("""
+        UPDATE users u
+        SET last_seen_at = e.last_seen_at
+        FROM (SELECT user_id, MAX(created_at) AS last_seen_at FROM events GROUP BY user_id) e
+        WHERE u.user_id = e.user_id
+    """)
+    print("✅ Backfilled users.question_count and users.last_seen_at")
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION rag_requests_count_questions() RETURNS trigger AS $$
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            UPDATE users SET question_count = question_count + 1 WHERE user_id = NEW.user_id;
+          ELSIF TG_OP = 'DELETE' THEN
+            UPDATE users SET question_count = GREATEST(question_count - 1, 0) WHERE user_id = OLD.user_id;
+          END IF;
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE OR REPLACE TRIGGER trg_rag_requests_count_questions
+        AFTER INSERT OR DELETE ON rag_requests
+        FOR EACH ROW EXECUTE FUNCTION rag_requests_count_questions()
+    """)
+    op.execute("CREATE INDEX IF NOT EXISTS idx_users_question_count ON users (question_count DESC)")
+    print("✅ Installed question_count trigger on rag_requests")
+
+
+def downgrade() -> None:
+    """Drop trigger and counter columns."""
+    op.execute("DROP TRIGGER IF EXISTS trg_rag_requests_count_questions ON rag_requests")
+    op.execute("DROP FUNCTION IF EXISTS rag_requests_count_questions()")
+    op.execute("DROP INDEX IF EXISTS idx_users_question_count")
+    op.execute("""
+        ALTER TABLE users
+        DROP COLUMN IF EXISTS question_count,
+        DROP COLUMN IF EXISTS last_seen_at
+    """)
+    print("✅ Removed users.question_count and users.last_seen_at")
@@ -0,0 +1,33 @@
+"""Add keyset pagination indexes on users
+
+Revision ID: 005_users_keyset_indexes
+Revises: 004_user_counters
+Create Date: 2025-11-03
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '005_users_keyset_indexes'
+down_revision = '004_user_counters'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create (created_at, user_id) indexes for /list_users and /pending_users pages."""
+    op.execute("CREATE INDEX IF NOT EXISTS idx_users_created_user ON users (created_at, user_id)")
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_pending_created
+        ON users (created_at, user_id) WHERE user_id < 0
+    """)
+    print("✅ Created keyset pagination indexes on users")
+
+
+def downgrade() -> None:
+    """Drop keyset pagination indexes."""
+    op.execute("DROP INDEX IF EXISTS idx_users_pending_created")
+    op.execute("DROP INDEX IF EXISTS idx_users_created_user")
+    print("✅ Dropped keyset pagination indexes on users")
@@ -0,0 +1,31 @@
+"""Add index for pending (temporary ID) users by username
+
+Revision ID: 006_pending_username_index
+Revises: 005_users_keyset_indexes
+Create Date: 2025-11-04
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '006_pending_username_index'
+down_revision = '005_users_keyset_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create partial index on lower(username) for users with a temporary negative user_id."""
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_pending_username
+        ON users (lower(username)) WHERE user_id < 0
+    """)
+    print("✅ Created pending username index on users")
+
+
+def downgrade() -> None:
+    """Drop pending username index."""
+    op.execute("DROP INDEX IF EXISTS idx_users_pending_username")
+    print("✅ Dropped pending username index on users")
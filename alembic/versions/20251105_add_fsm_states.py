@@ -0,0 +1,36 @@
+"""Add fsm_states table for Postgres-backed aiogram FSM storage
+
+Revision ID: 007_fsm_states
+Revises: 006_pending_username_index
+Create Date: 2025-11-05
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '007_fsm_states'
+down_revision = '006_pending_username_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create fsm_states table with expiry index."""
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+          key         TEXT PRIMARY KEY,
+          state       TEXT,
+          data        JSONB,
+          expires_at  TIMESTAMP NOT NULL
+        )
+    """)
+    op.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at)")
+    print("✅ Created fsm_states table")
+
+
+def downgrade() -> None:
+    """Drop fsm_states table."""
+    op.execute("DROP TABLE IF EXISTS fsm_states")
+    print("✅ Dropped fsm_states table")
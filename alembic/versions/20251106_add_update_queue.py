@@ -0,0 +1,55 @@
+"""Add update queue tables for ingress/worker run modes
+
+Revision ID: 008_update_queue
+Revises: 007_fsm_states
+Create Date: 2025-11-06
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '008_update_queue'
+down_revision = '007_fsm_states'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create update_queue, update_shards and update_workers tables."""
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS update_queue (
+          id          BIGSERIAL PRIMARY KEY,
+          update_id   BIGINT UNIQUE NOT NULL,
+          shard       SMALLINT NOT NULL,
+          user_id     BIGINT,
+          payload     JSONB NOT NULL,
+          created_at  TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    op.execute("CREATE INDEX IF NOT EXISTS idx_update_queue_shard_id ON update_queue (shard, id)")
+    print("✅ Created update_queue table")
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS update_shards (
+          shard        SMALLINT PRIMARY KEY,
+          worker_id    TEXT,
+          lease_until  TIMESTAMP
+        )
+    """)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS update_workers (
+          worker_id     TEXT PRIMARY KEY,
+          heartbeat_at  TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    print("✅ Created update_shards and update_workers tables")
+
+
+def downgrade() -> None:
+    """Drop update queue tables."""
+    op.execute("DROP TABLE IF EXISTS update_workers")
+    op.execute("DROP TABLE IF EXISTS update_shards")
+    op.execute("DROP TABLE IF EXISTS update_queue")
+    print("✅ Dropped update queue tables")
@@ -0,0 +1,60 @@
+"""Add broadcast_jobs and broadcast_recipients tables
+
+Revision ID: 009_broadcasts
+Revises: 008_update_queue
+Create Date: 2025-11-07
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '009_broadcasts'
+down_revision = '008_update_queue'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create broadcast job and recipient tables."""
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+          id                   SERIAL PRIMARY KEY,
+          created_by           BIGINT NOT NULL,
+          text                 TEXT NOT NULL,
+          status               TEXT NOT NULL DEFAULT 'draft',
+          total                INTEGER,
+          sent                 INTEGER NOT NULL DEFAULT 0,
+          failed               INTEGER NOT NULL DEFAULT 0,
+          blocked              INTEGER NOT NULL DEFAULT 0,
+          cursor_user_id       BIGINT NOT NULL DEFAULT 0,
+          progress_chat_id     BIGINT,
+          progress_message_id  BIGINT,
+          owner                TEXT,
+          lease_until          TIMESTAMP,
+          created_at           TIMESTAMP NOT NULL DEFAULT NOW(),
+          started_at           TIMESTAMP,
+          finished_at          TIMESTAMP
+        )
+    """)
+    print("✅ Created broadcast_jobs table")
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+          job_id   INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+          user_id  BIGINT NOT NULL,
+          status   TEXT NOT NULL,
+          error    TEXT,
+          sent_at  TIMESTAMP NOT NULL DEFAULT NOW(),
+          PRIMARY KEY (job_id, user_id)
+        )
+    """)
+    print("✅ Created broadcast_recipients table")
+
+
+def downgrade() -> None:
+    """Drop broadcast tables."""
+    op.execute("DROP TABLE IF EXISTS broadcast_recipients")
+    op.execute("DROP TABLE IF EXISTS broadcast_jobs")
+    print("✅ Dropped broadcast tables")
@@ -0,0 +1,37 @@
+"""Add rag_resume table for RAG waits interrupted by shutdown
+
+Revision ID: 010_rag_resume
+Revises: 009_broadcasts
+Create Date: 2025-11-08
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010_rag_resume'
+down_revision = '009_broadcasts'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create rag_resume table."""
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS rag_resume (
+          request_id         TEXT PRIMARY KEY,
+          user_id            BIGINT NOT NULL,
+          chat_id            BIGINT NOT NULL,
+          message_id         BIGINT NOT NULL,
+          status_message_id  BIGINT,
+          saved_at           TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    print("✅ Created rag_resume table")
+
+
+def downgrade() -> None:
+    """Drop rag_resume table."""
+    op.execute("DROP TABLE IF EXISTS rag_resume")
+    print("✅ Dropped rag_resume table")
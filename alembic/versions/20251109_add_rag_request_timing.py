@@ -0,0 +1,47 @@
+"""Add lifecycle timing columns to rag_requests
+
+Revision ID: 011_rag_request_timing
+Revises: 010_rag_resume
+Create Date: 2025-11-09
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '011_rag_request_timing'
+down_revision = '010_rag_resume'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Add accepted_at, completed_at, poll_count, answer_length and indexes."""
+    op.execute("""
+        ALTER TABLE rag_requests
+          ADD COLUMN IF NOT EXISTS accepted_at TIMESTAMP,
+          ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP,
+          ADD COLUMN IF NOT EXISTS poll_count INTEGER,
+          ADD COLUMN IF NOT EXISTS answer_length INTEGER
+    """)
+    print("✅ Added timing columns to rag_requests")
+
+    # Завершение запроса обновляется по request_id, статистика выбирает по created_at
+    op.execute("CREATE INDEX IF NOT EXISTS idx_rag_requests_request_id ON rag_requests (request_id)")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_rag_requests_created_at ON rag_requests (created_at)")
+    print("✅ Created rag_requests indexes")
+
+
+def downgrade() -> None:
+    """Drop timing columns and indexes."""
+    op.execute("DROP INDEX IF EXISTS idx_rag_requests_created_at")
+    op.execute("DROP INDEX IF EXISTS idx_rag_requests_request_id")
+    op.execute("""
+        ALTER TABLE rag_requests
+          DROP COLUMN IF EXISTS answer_length,
+          DROP COLUMN IF EXISTS poll_count,
+          DROP COLUMN IF EXISTS completed_at,
+          DROP COLUMN IF EXISTS accepted_at
+    """)
+    print("✅ Dropped timing columns from rag_requests")
@@ -0,0 +1,44 @@
+"""Add rag_answers table for stored RAG answers
+
+Revision ID: 012_rag_answers
+Revises: 011_rag_request_timing
+Create Date: 2025-11-10
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '012_rag_answers'
+down_revision = '011_rag_request_timing'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create rag_answers table and indexes."""
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS rag_answers (
+          request_id     TEXT PRIMARY KEY,
+          user_id        BIGINT NOT NULL,
+          lookup_key     BYTEA NOT NULL,
+          question       TEXT NOT NULL,
+          car            TEXT,
+          answer         BYTEA NOT NULL,
+          compressed     BOOLEAN NOT NULL DEFAULT FALSE,
+          answer_length  INTEGER NOT NULL,
+          created_at     TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    print("✅ Created rag_answers table")
+
+    op.execute("CREATE INDEX IF NOT EXISTS idx_rag_answers_lookup ON rag_answers (lookup_key, created_at DESC)")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_rag_answers_created_at ON rag_answers (created_at)")
+    print("✅ Created rag_answers indexes")
+
+
+def downgrade() -> None:
+    """Drop rag_answers table."""
+    op.execute("DROP TABLE IF EXISTS rag_answers")
+    print("✅ Dropped rag_answers table")
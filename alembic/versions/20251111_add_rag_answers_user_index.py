@@ -0,0 +1,28 @@
+"""Add rag_answers user index for conversation context
+
+Revision ID: 013_rag_answers_user
+Revises: 012_rag_answers
+Create Date: 2025-11-11
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '013_rag_answers_user'
+down_revision = '012_rag_answers'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Create index for the latest answers of a user."""
+    op.execute("CREATE INDEX IF NOT EXISTS idx_rag_answers_user ON rag_answers (user_id, created_at DESC)")
+    print("✅ Created idx_rag_answers_user index")
+
+
+def downgrade() -> None:
+    """Drop rag_answers user index."""
+    op.execute("DROP INDEX IF EXISTS idx_rag_answers_user")
+    print("✅ Dropped idx_rag_answers_user index")
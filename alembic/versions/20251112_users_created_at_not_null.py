@@ -0,0 +1,31 @@
+"""Make users.created_at NOT NULL for keyset pagination
+
+Revision ID: 014_users_created_at_not_null
+Revises: 013_rag_answers_user
+Create Date: 2025-11-12
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '014_users_created_at_not_null'
+down_revision = '013_rag_answers_user'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    """Backfill NULL created_at and forbid NULLs (rows with NULL drop out of keyset pages)."""
+    # Время добавления неизвестно: такие пользователи считаются самыми старыми
+    op.execute("UPDATE users SET created_at = '1970-01-01' WHERE created_at IS NULL")
+    op.execute("ALTER TABLE users ALTER COLUMN created_at SET DEFAULT NOW()")
+    op.execute("ALTER TABLE users ALTER COLUMN created_at SET NOT NULL")
+    print("✅ users.created_at is NOT NULL")
+
+
+def downgrade() -> None:
+    """Allow NULL created_at again."""
+    op.execute("ALTER TABLE users ALTER COLUMN created_at DROP NOT NULL")
+    print("✅ users.created_at allows NULL")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Пропускная способность обработки обновлений на стандартном цикле asyncio и на uvloop
+
+В отдельном процессе для каждого цикла событий поднимается заглушка Bot API (aiohttp-сервер
+на localhost), диспетчер с защитой от флуда и планировщиком, как в bot.py, и обработчик,
+который ждёт --handler-ms и отвечает на сообщение. Обновления подаются так же, как в polling:
+разбор JSON, feed_update, обратное давление планировщика. Измеряется время до завершения
+всех обработчиков и задержка цикла событий (utils/loop_watchdog.py).
+
+База не нужна.
+    python -m benchmarks.loop_bench --updates 20000 --loops asyncio,uvloop
+"""
+import argparse
+import asyncio
+import multiprocessing as mp
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+USER_ID_BASE = 100000
+TOKEN = "42:BENCHMARK"
+
+
+def _loop_factory(name: str) -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    if name == 'uvloop':
+        import uvloop
+        return uvloop.new_event_loop
+    return None
+
+
+def _loop_available(name: str) -> bool:
+    try:
+        _loop_factory(name)
+    except ImportError:
+        return False
+    return True
+
+
+def _run_process(name: str, args: Dict[str, Any], results: "mp.Queue") -> None:
+    try:
+        with asyncio.Runner(loop_factory=_loop_factory(name)) as runner:
+            results.put(runner.run(_run(**args)))
+    except BaseException as e:
+        results.put({'error': f"{type(e).__name__}: {e}"})
+        raise
+
+
+def _fake_message(chat_id: int, text: str) -> Dict[str, Any]:
+    return {
+        'message_id': 1, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': True, 'first_name': 'Bot'},
+    }
+
+
+async def _fake_bot_api(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+    data = await request.post()
+    return web.json_response({'ok': True, 'result': _fake_message(int(data['chat_id']), data['text'])})
+
+
+async def _run(updates: int, users: int, handler_ms: float, concurrency: int) -> Dict[str, Any]:
+    from aiogram import Bot, Dispatcher, Router
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Message, Update
+    from aiohttp import web
+
+    from utils.loop_watchdog import LoopWatchdog
+    from utils.scheduler import HandlerScheduler
+    from utils.throttling import ThrottlingMiddleware
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', _fake_bot_api)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    router = Router()
+
+    @router.message()
+    async def handle(message: Message) -> None:
+        await asyncio.sleep(handler_ms / 1000)
+        await message.answer(f"re: {message.text}")
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+    bot = Bot(TOKEN, session=session)
+    dp = Dispatcher()
+    dp.include_router(router)
+    ThrottlingMiddleware(limit=updates).setup(dp)
+    scheduler = HandlerScheduler(max_concurrent=concurrency, fast_concurrent=concurrency,
+                                 max_pending=concurrency * 5)
+    scheduler.setup(dp, detach=True)
+
+    raw = [
+        {'update_id': i, 'message': {
+            'message_id': i, 'date': 0, 'text': f"question {i}",
+            'chat': {'id': USER_ID_BASE + i % users, 'type': 'private'},
+            'from': {'id': USER_ID_BASE + i % users, 'is_bot': False, 'first_name': 'User'},
+        }}
+        for i in range(updates)
+    ]
+    watchdog = LoopWatchdog(interval=0.01, warn_after=0)
+    watchdog.start()
+    started = time.perf_counter()
+    for data in raw:
+        await dp.feed_update(bot, Update.model_validate(data, context={'bot': bot}))
+    await scheduler.drain()
+    elapsed = time.perf_counter() - started
+    lag = watchdog.snapshot()
+    await watchdog.stop()
+
+    await session.close()
+    await runner.cleanup()
+    return {
+        'elapsed': elapsed,
+        'failed': scheduler.failed,
+        'lag_p50_ms': lag['p50_ms'],
+        'lag_p99_ms': lag['p99_ms'],
+        'lag_max_ms': lag['max_ms'],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loops', default='asyncio,uvloop', help="Циклы событий через запятую")
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--handler-ms', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=100, help="Лимит одновременных обработчиков")
+    parser.add_argument('--repeat', type=int, default=3, help="Прогонов на цикл (берётся лучший)")
+    args = parser.parse_args()
+
+    run_args = {'updates': args.updates, 'users': args.users,
+                'handler_ms': args.handler_ms, 'concurrency': args.concurrency}
+    # Чистый процесс на прогон: синглтоны модулей и пул соединений не переходят между циклами
+    context = mp.get_context('spawn')
+    print(f"{args.updates} updates from {args.users} users, handler {args.handler_ms}ms, "
+          f"concurrency {args.concurrency}")
+    print(f"{'loop':<10} {'updates/s':>10} {'best s':>8} {'lag p50':>9} {'lag p99':>9} {'lag max':>9} {'failed':>7}")
+    for name in args.loops.split(','):
+        if not _loop_available(name):
+            print(f"{name:<10} not installed (pip install {name})")
+            continue
+        runs: List[Dict[str, Any]] = []
+        for _ in range(args.repeat):
+            results = context.Queue()
+            process = context.Process(target=_run_process, args=(name, run_args, results))
+            process.start()
+            run = results.get()
+            process.join()
+            if 'error' in run:
+                raise SystemExit(f"{name}: {run['error']}")
+            runs.append(run)
+        best = min(runs, key=lambda run: run['elapsed'])
+        print(f"{name:<10} {args.updates / best['elapsed']:>10.0f} {best['elapsed']:>8.2f} "
+              f"{best['lag_p50_ms']:>7.1f}ms {best['lag_p99_ms']:>7.1f}ms {best['lag_max_ms']:>7.0f}ms "
+              f"{best['failed']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Хранение ответов RAG (таблица rag_answers)
+
+Ответ сохраняется вместе с полным вопросом и машиной пользователя, ключ — request_id.
+lookup_key — хеш нормализованного вопроса и машины: по нему находится последний ответ
+на такой же вопрос для такой же машины (кэш и повтор ответов).
+
+Ответ длиннее RAG_ANSWER_COMPRESS_MIN_BYTES хранится сжатым zlib; короткие ответы
+не сжимаются — выигрыш меньше заголовка. Строки старше RAG_ANSWERS_RETENTION_DAYS
+удаляются фоновой очисткой (purge_loop).
+"""
+import asyncio
+import hashlib
+import os
+import re
+import zlib
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
+
+from utils.logger import get_logger
+
+if TYPE_CHECKING:
+    from database.db import Database
+
+logger = get_logger(__name__)
+
+# Ответы длиннее этого (байт UTF-8) сжимаются
+RAG_ANSWER_COMPRESS_MIN_BYTES = int(os.getenv('RAG_ANSWER_COMPRESS_MIN_BYTES', 512))
+RAG_ANSWER_COMPRESS_LEVEL = 6
+# Срок хранения ответов (0 — хранить всегда)
+RAG_ANSWERS_RETENTION_DAYS = int(os.getenv('RAG_ANSWERS_RETENTION_DAYS', 90))
+RAG_ANSWERS_PURGE_INTERVAL_SEC = 3600
+# Строк за один DELETE при очистке (короткие транзакции, без долгих блокировок)
+RAG_ANSWERS_PURGE_BATCH = 5000
+
+_SPACES = re.compile(r'\s+')
+_TRAILING_PUNCTUATION = re.compile(r'[\s?!.,;:]+$')
+
+
+class QuestionContext(NamedTuple):
+    """
+    Вопрос пользователя без служебного контекста и его машина
+
+    history — предыдущие вопросы и ответы, отправленные вместе с вопросом (utils/conversation.py):
+    ответ зависит от них, поэтому они входят в ключ поиска.
+    """
+    question: str
+    car: Optional[str] = None
+    history: Optional[str] = None
+
+
+def normalize_question(text: str) -> str:
+    """Регистр, пробелы и знаки в конце не меняют вопрос"""
+    return _TRAILING_PUNCTUATION.sub('', _SPACES.sub(' ', text).strip().lower())
+
+
+def lookup_key(question: str, car: Optional[str], history: Optional[str] = None) -> bytes:
+    """Ключ поиска одинаковых вопросов (16 байт); ответы в разговоре не совпадают с отдельным вопросом"""
+    source = f"{normalize_question(car or '')}\x00{normalize_question(question)}"
+    if history:
+        source += f"\x00{normalize_question(history)}"
+    return hashlib.blake2b(source.encode('utf-8'), digest_size=16).digest()
+
+
+def encode_answer(answer: str) -> Tuple[bytes, bool]:
+    """Ответ для записи: (данные, сжат ли)"""
+    data = answer.encode('utf-8')
+    if len(data) < RAG_ANSWER_COMPRESS_MIN_BYTES:
+        return data, False
+    compressed = zlib.compress(data, RAG_ANSWER_COMPRESS_LEVEL)
+    if len(compressed) >= len(data):
+        return data, False
+    return compressed, True
+
+
+def decode_answer(data: bytes, compressed: bool) -> str:
+    return (zlib.decompress(data) if compressed else data).decode('utf-8')
+
+
+def answer_rows(answers: List[Tuple[str, int, QuestionContext, str]]) -> List[List[Any]]:
+    """
+    Колонки для пакетной вставки из (request_id, user_id, контекст, ответ)
+
+    Сжатие и хеширование пачки выполняются в рабочем потоке (asyncio.to_thread).
+    """
+    rows = []
+    for request_id, user_id, context, answer in answers:
+        data, compressed = encode_answer(answer)
+        rows.append((request_id, user_id, lookup_key(*context),
+                     context.question, context.car, data, compressed, len(answer)))
+    return [list(column) for column in zip(*rows)]
+
+
+def answer_from_row(row: Any) -> Dict[str, Any]:
+    """Строка rag_answers с распакованным ответом"""
+    result = dict(row)
+    result['answer'] = decode_answer(result.pop('answer_data'), result.pop('compressed'))
+    return result
+
+
+async def purge_loop(database: "Database", retention_days: int = RAG_ANSWERS_RETENTION_DAYS) -> None:
+    """Удаление ответов старше срока хранения (фоновая задача, запускается в bot.py)"""
+    if retention_days <= 0:
+        return
+    while True:
+        try:
+            purged = await database.purge_rag_answers(retention_days, RAG_ANSWERS_PURGE_BATCH)
+            if purged:
+                logger.info(f"Purged {purged} RAG answer(s) older than {retention_days} day(s)")
+        except Exception as e:
+            logger.warning(f"RAG answers purge failed: {e}")
+        await asyncio.sleep(RAG_ANSWERS_PURGE_INTERVAL_SEC)
@@ -0,0 +1,86 @@
+"""
+Буферизованная пакетная запись в базу данных
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class BatchWriter:
+    """
+    Накапливает записи в памяти и сбрасывает их одной операцией
+
+    Сброс происходит по таймеру (flush_interval) или при накоплении max_batch записей.
+    Если база недоступна, записи остаются в буфере, но не больше max_buffer —
+    самые старые отбрасываются, чтобы не расходовать память бесконечно.
+    """
+
+    def __init__(self, name: str, flush_fn: Callable[[List[Any]], Awaitable[None]],
+                 flush_interval: float = 1.0, max_batch: int = 500, max_buffer: int = 50000):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self._buffer: List[Any] = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def add(self, record: Any) -> None:
+        """Добавление записи в буфер (без обращения к БД)"""
+        self._buffer.append(record)
+        if len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """Запуск фоновой задачи периодического сброса"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"batch-writer-{self.name}")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Сброс накопленных записей, возвращает количество записанных"""
+        async with self._lock:
+            written = 0
+            while self._buffer:
+                batch = self._buffer[:self.max_batch]
+                try:
+                    await self.flush_fn(batch)
+                except Exception as e:
+                    logger.error(f"Error flushing {len(batch)} '{self.name}' records: {e}")
+                    overflow = len(self._buffer) - self.max_buffer
+                    if overflow > 0:
+                        del self._buffer[:overflow]
+                        self.dropped += overflow
+                        logger.warning(f"Dropped {overflow} '{self.name}' records, buffer is full")
+                    break
+                del self._buffer[:len(batch)]
+                written += len(batch)
+            return written
+
+    async def stop(self) -> None:
+        """Остановка фоновой задачи и финальный сброс буфера"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
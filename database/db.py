@@ -1,13 +1,90 @@
+import asyncio
 import asyncpg
 import os
-from typing import Optional, List, Dict, Any
+import time
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, AsyncIterator, Set, Tuple
+
+from database.answers import QuestionContext, answer_from_row, answer_rows, lookup_key
+from database.batch_writer import BatchWriter
+from database.events import EVENT_TYPES, MESSAGE_EVENT_TYPES, event_code
+from database.statements import (
+    POOL_DEFAULT, POOL_ANALYTICS, STATEMENTS, RegistryConnection, StatementStats, statements_for_pool,
+)
+from utils.helpers import temp_user_id
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Размер пачки строк, читаемых из курсора при выгрузках
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+# Время ответа RAG API, дольше которого ответ считается нарушением SLO (/stat)
+RAG_SLO_SEC = float(os.getenv('RAG_SLO_SEC', 30))
+
+# Как часто перечитывать множество ожидающих username при промахе (другие процессы тоже добавляют)
+PENDING_USERNAMES_REFRESH_SEC = float(os.getenv('PENDING_USERNAMES_REFRESH_SEC', 300))
+
+def utc_now() -> datetime:
+    """Текущее время для колонок TIMESTAMP: без часового пояса, в БД время хранится в UTC"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+PERIOD_INTERVALS = {
+    "day": "1 day",
+    "month": "1 month",
+    "year": "1 year",
+}
+
+def _period_interval(period: str) -> str:
+    """Интервал периода для параметра $n::text::interval (day по умолчанию)"""
+    return PERIOD_INTERVALS.get(period, "1 day")
+
+# Настройки пулов: переменная с DSN, префикс переменных окружения и значения по умолчанию
+POOL_SETTINGS = {
+    POOL_DEFAULT: {
+        'dsn_env': 'DATABASE_URL',
+        'env_prefix': 'DB_POOL',
+        'min_size': 2,
+        'max_size': 10,
+        'statement_timeout_ms': 10000,
+        'max_inactive_lifetime_sec': 300,
+        'statement_cache_size': 100,
+    },
+    POOL_ANALYTICS: {
+        'dsn_env': 'ANALYTICS_DATABASE_URL',
+        'env_prefix': 'ANALYTICS_POOL',
+        'min_size': 1,
+        'max_size': 3,
+        'statement_timeout_ms': 300000,
+        'max_inactive_lifetime_sec': 60,
+        'statement_cache_size': 50,
+    },
+}
+
 class Database:
     def __init__(self):
+        self.pools: Dict[str, asyncpg.Pool] = {}
+        # Пул по умолчанию (используется также при инициализации схемы в bot.py)
         self.pool: Optional[asyncpg.Pool] = None
+        # Время выполнения запросов реестра
+        self.query_stats = StatementStats()
+        # Username (в нижнем регистре) пользователей с временным ID, ожидающих первого обращения
+        self.pending_usernames: Set[str] = set()
+        self._pending_loaded_at: Optional[float] = None
+        # События пишутся пакетами в таблицу events
+        self.events = BatchWriter(
+            'events',
+            self._write_events,
+            flush_interval=float(os.getenv('EVENTS_FLUSH_INTERVAL_SEC', 1)),
+            max_batch=int(os.getenv('EVENTS_BATCH_SIZE', 500)),
+        )
+        # Завершения запросов к RAG (статус, время, число опросов) и ответы пишутся пакетами
+        self.rag_completions = BatchWriter(
+            'rag_completions',
+            self._write_rag_completions,
+            flush_interval=float(os.getenv('EVENTS_FLUSH_INTERVAL_SEC', 1)),
+            max_batch=int(os.getenv('EVENTS_BATCH_SIZE', 500)),
+        )
     
     async def connect(self):
         """Подключение к базе данных"""
@@ -15,32 +92,107 @@ class Database:
         if not database_url:
             raise ValueError("DATABASE_URL environment variable is required")
         
-        self.pool = await asyncpg.create_pool(database_url)
+        # Пулы создаются параллельно: каждый открывает min_size соединений и готовит запросы
+        pools = await asyncio.gather(*(self._create_pool(name, database_url) for name in POOL_SETTINGS))
+        self.pools = dict(zip(POOL_SETTINGS, pools))
+        self.pool = self.pools[POOL_DEFAULT]
+        self.events.start()
+        self.rag_completions.start()
         logger.info("Connected to database")
     
+    async def _create_pool(self, name: str, default_dsn: str) -> asyncpg.Pool:
+        """Создание именованного пула с собственным размером и statement_timeout"""
+        settings = POOL_SETTINGS[name]
+        prefix = settings['env_prefix']
+        dsn = os.getenv(settings['dsn_env']) or default_dsn
+        min_size = int(os.getenv(f'{prefix}_MIN_SIZE', settings['min_size']))
+        max_size = int(os.getenv(f'{prefix}_MAX_SIZE', settings['max_size']))
+        statement_timeout_ms = int(os.getenv(f'{prefix}_STATEMENT_TIMEOUT_MS', settings['statement_timeout_ms']))
+        max_inactive_lifetime = float(os.getenv(f'{prefix}_MAX_INACTIVE_LIFETIME_SEC', settings['max_inactive_lifetime_sec']))
+        # Кэш должен вмещать все запросы реестра, иначе подготовленные запросы будут вытесняться
+        statement_cache_size = max(
+            int(os.getenv(f'{prefix}_STATEMENT_CACHE_SIZE', settings['statement_cache_size'])),
+            len(statements_for_pool(name)) * 2,
+        )
+        
+        async def init_connection(conn: RegistryConnection) -> None:
+            await conn.prepare_registry(name)
+        
+        pool = await asyncpg.create_pool(
+            dsn,
+            min_size=min_size,
+            max_size=max_size,
+            max_inactive_connection_lifetime=max_inactive_lifetime,
+            connection_class=RegistryConnection,
+            init=init_connection,
+            statement_cache_size=statement_cache_size,
+            # Подготовленные запросы живут столько же, сколько соединение
+            max_cached_statement_lifetime=0,
+            server_settings={
+                'application_name': f'carbot-{name}',
+                'statement_timeout': str(statement_timeout_ms),
+            },
+        )
+        logger.info(
+            f"Database pool '{name}' created: size {min_size}-{max_size}, "
+            f"statement_timeout {statement_timeout_ms}ms, idle lifetime {max_inactive_lifetime}s, "
+            f"statement cache {statement_cache_size}"
+        )
+        return pool
+    
     async def close(self):
         """Закрытие соединения с базой данных"""
         if self.pool:
-            await self.pool.close()
+            await self.events.stop()
+            await self.rag_completions.stop()
+        for pool in self.pools.values():
+            await pool.close()
+        if self.pools:
+            self.pools.clear()
             logger.info("Database connection closed")
     
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        """Занятость пулов: открыто, простаивает и максимум соединений"""
+        return {
+            name: {
+                'size': pool.get_size(),
+                'idle': pool.get_idle_size(),
+                'max_size': pool.get_max_size(),
+            }
+            for name, pool in self.pools.items()
+        }
+    
+    async def _query(self, name: str, method: str, *args, conn: Optional[asyncpg.Connection] = None) -> Any:
+        """
+        Выполнение запроса из реестра с замером времени
+        
+        Args:
+            name: Имя запроса в database/statements.py
+            method: Метод соединения: fetch, fetchrow, fetchval или execute
+            conn: Уже захваченное соединение (иначе берётся из пула запроса)
+        """
+        statement = STATEMENTS[name]
+        if conn is None:
+            async with self.pools[statement.pool].acquire() as conn:
+                return await self._run(conn, name, statement.sql, method, args)
+        return await self._run(conn, name, statement.sql, method, args)
+    
+    async def _run(self, conn: asyncpg.Connection, name: str, sql: str, method: str, args: tuple) -> Any:
+        started = time.perf_counter()
+        try:
+            return await getattr(conn, method)(sql, *args)
+        finally:
+            self.query_stats.observe(name, time.perf_counter() - started)
+    
     async def bootstrap_admin(self, user_id: int, username: str, secret: str) -> bool:
         """Создание первого администратора"""
         admin_secret = os.getenv('ADMIN_BOOTSTRAP_SECRET')
         if secret != admin_secret:
             return False
         
-        async with self.pool.acquire() as conn:
-            # Обновляем существующего пользователя или создаем нового администратора
-            await conn.execute("""
-                INSERT INTO users (user_id, username, role, allowed)
-                VALUES ($1, $2, 'admin', TRUE)
-                ON CONFLICT (user_id) DO UPDATE SET 
-                    role = 'admin',
-                    allowed = TRUE,
-                    username = EXCLUDED.username
-            """, user_id, username)
-            return True
+        # Обновляем существующего пользователя или создаем нового администратора
+        await self._query('bootstrap_admin', 'execute', user_id, username)
+        return True
     
     async def add_user(self, user_id: int, username: str) -> bool:
         """Добавление пользователя"""
@@ -48,198 +200,248 @@ class Database:
         if username and not username.startswith('@') and not username.startswith('user_'):
             username = f"@{username}"
         
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO users (user_id, username, role, allowed)
-                VALUES ($1, $2, 'user', TRUE)
-                ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
-            """, user_id, username)
-            return True
+        await self._query('add_user', 'execute', user_id, username)
+        return True
     
-    async def add_user_by_username(self, username: str) -> bool:
-        """Добавление пользователя по username (временный user_id = -1)"""
-        async with self.pool.acquire() as conn:
-            # Используем временный user_id = -1 для пользователей, добавленных по username
-            await conn.execute("""
-                INSERT INTO users (user_id, username, role, allowed)
-                VALUES (-1, $1, 'user', TRUE)
-                ON CONFLICT (user_id) DO NOTHING
-            """, username)
+    async def add_user_by_username(self, username: str, role: str = 'user') -> int:
+        """
+        Добавление пользователя по username с временным отрицательным user_id
+        
+        Реальный ID подставляется при первом обращении к боту (activate_pending_user).
+        
+        Returns:
+            Временный user_id
+        """
+        temp_id = temp_user_id(username)
+        await self._query('add_pending_user', 'execute', temp_id, username, role)
+        self.pending_usernames.add(username.lower())
+        return temp_id
+    
+    async def load_pending_usernames(self) -> None:
+        """Загрузка множества username пользователей, ожидающих активации"""
+        rows = await self._query('pending_usernames', 'fetch')
+        self.pending_usernames = {row[0] for row in rows}
+        self._pending_loaded_at = time.monotonic()
+        logger.info(f"Loaded {len(self.pending_usernames)} pending username(s)")
+    
+    async def _is_pending_username(self, username: str) -> bool:
+        """Проверка по множеству в памяти; при промахе оно изредка перечитывается из БД"""
+        key = username.lower()
+        if key in self.pending_usernames:
             return True
+        if self._pending_loaded_at is None or time.monotonic() - self._pending_loaded_at >= PENDING_USERNAMES_REFRESH_SEC:
+            await self.load_pending_usernames()
+            return key in self.pending_usernames
+        return False
+    
+    async def activate_pending_user(self, user_id: int, username: str) -> Optional[Dict[str, Any]]:
+        """
+        Активация пользователя, добавленного администратором по @username
+        
+        Запрос к БД выполняется, только если username есть среди ожидающих.
+        Строка пользователя, лимиты, источник привлечения, запросы к RAG и события
+        переносятся на реальный user_id одним атомарным запросом.
+        
+        Args:
+            user_id: Реальный ID Telegram
+            username: Username с @
+            
+        Returns:
+            Активированный пользователь или None, если ожидающего пользователя нет
+        """
+        if not username or not await self._is_pending_username(username):
+            return None
+        
+        row = await self._query('activate_pending_user', 'fetchrow', user_id, username)
+        if not row or not row['more_pending']:
+            self.pending_usernames.discard(username.lower())
+        if not row:
+            return None
+        
+        logger.info(f"User {user_id} ({username}) activated from temporary ID {row['temp_user_id']}")
+        user = dict(row)
+        del user['temp_user_id'], user['more_pending']
+        return user
     
     async def update_user_id_by_username(self, username: str, new_user_id: int) -> bool:
         """Обновление user_id для пользователя, добавленного по username"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                UPDATE users 
-                SET user_id = $1 
-                WHERE username = $2 AND user_id = -1
-            """, new_user_id, username)
-            return result == "UPDATE 1"
-    
-    async def get_pending_users(self) -> List[Dict[str, Any]]:
-        """Получение пользователей с временным user_id"""
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT user_id, username, role, allowed, car, created_at
-                FROM users WHERE user_id = -1
-                ORDER BY created_at ASC
-            """)
-            return [dict(row) for row in rows]
-    
-    async def log_rag_request(self, user_id: int, request_id: str, text: str, status: str = 'pending') -> None:
-        """Логирование запроса к RAG API"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO rag_requests (user_id, request_id, text, status)
-                VALUES ($1, $2, $3, $4)
-            """, user_id, request_id, text, status)
+        return await self.activate_pending_user(new_user_id, username) is not None
     
-    async def update_rag_request_status(self, request_id: str, status: str) -> None:
-        """Обновление статуса запроса к RAG API"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE rag_requests SET status = $1 WHERE request_id = $2
-            """, status, request_id)
+    async def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        """Поиск пользователя по username (с @)"""
+        row = await self._query('get_user_by_username', 'fetchrow', username)
+        return dict(row) if row else None
+    
+    async def set_user_role(self, user_id: int, role: str, allow: bool = False) -> bool:
+        """Изменение роли пользователя (allow=True заодно разрешает доступ)"""
+        result = await self._query('set_user_role', 'execute', user_id, role, allow)
+        return result != "UPDATE 0"
+    
+    async def set_user_allowed(self, user_id: int, allowed: bool) -> bool:
+        """Блокировка или разблокировка пользователя"""
+        result = await self._query('set_user_allowed', 'execute', user_id, allowed)
+        return result != "UPDATE 0"
+    
+    async def _users_page(self, kind: str, descending: bool, limit: int,
+                          after: Optional[Tuple[datetime, int]] = None,
+                          before: Optional[Tuple[datetime, int]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Keyset-страница пользователей по (created_at, user_id)
+        
+        Args:
+            kind: Выборка из USERS_PAGE_CONDITIONS ('all' или 'pending')
+            descending: Порядок страниц (новые сначала или старые сначала)
+            limit: Размер страницы
+            after: Ключ последней строки предыдущей страницы (листаем вперёд)
+            before: Ключ первой строки текущей страницы (листаем назад)
+            
+        Returns:
+            Кортеж (строки в порядке отображения, есть ли ещё страница в направлении листания)
+        """
+        forward = before is None
+        cursor = after if forward else before
+        # Листание назад — тот же индекс в обратном направлении
+        ascending_scan = descending != forward
+        name = f"users_page_{kind}_{'asc' if ascending_scan else 'desc'}"
+        
+        if cursor:
+            rows = await self._query(f"{name}_after", 'fetch', limit + 1, *cursor)
+        else:
+            rows = await self._query(name, 'fetch', limit + 1)
+        
+        has_more = len(rows) > limit
+        users = [dict(row) for row in rows[:limit]]
+        if not forward:
+            users.reverse()
+        return users, has_more
+    
+    async def get_pending_users(self, limit: int = 20,
+                                after: Optional[Tuple[datetime, int]] = None,
+                                before: Optional[Tuple[datetime, int]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """Получение страницы пользователей с временным (отрицательным) user_id, старые сначала"""
+        return await self._users_page('pending', False, limit, after, before)
+    
+    async def log_rag_request(self, user_id: int, request_id: str, text: str, status: str = 'pending',
+                              created_at: Optional[datetime] = None,
+                              accepted_at: Optional[datetime] = None) -> None:
+        """Логирование запроса к RAG API (время — UTC без часового пояса, см. utc_now)"""
+        await self._query('log_rag_request', 'execute', user_id, request_id, text, status, created_at, accepted_at)
+    
+    def complete_rag_request(self, request_id: str, status: str, poll_count: int, answer: Optional[str] = None,
+                             user_id: Optional[int] = None, context: Optional[QuestionContext] = None) -> None:
+        """
+        Завершение запроса к RAG API (пакетная запись, без ожидания БД)
+        
+        Ответ с контекстом вопроса сохраняется в rag_answers в той же пакетной записи.
+        """
+        self.rag_completions.add((request_id, status, utc_now(), poll_count,
+                                  len(answer) if answer else None, user_id, context, answer))
     
-    async def log_message(self, user_id: int, message_type: str, content: str) -> None:
-        """Логирование сообщения"""
+    async def _write_rag_completions(self, records: List[tuple]) -> None:
+        """Статусы запросов и ответы — одна транзакция на пачку"""
+        completions = [list(column) for column in zip(*(record[:5] for record in records))]
+        answers = [
+            (request_id, user_id, context, answer)
+            for request_id, _, _, _, _, user_id, context, answer in records
+            if context is not None and answer
+        ]
+        # Сжатие ответов вне цикла событий
+        answer_columns = await asyncio.to_thread(answer_rows, answers) if answers else None
         async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO messages (user_id, message_type, content)
-                VALUES ($1, $2, $3)
-            """, user_id, message_type, content)
+            async with conn.transaction():
+                await self._query('complete_rag_requests', 'execute', *completions, conn=conn)
+                if answer_columns:
+                    await self._query('save_rag_answers', 'execute', *answer_columns, conn=conn)
+    
+    async def get_rag_answer(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """Сохранённый ответ по request_id (question, car, answer, created_at...)"""
+        row = await self._query('rag_answer_by_request', 'fetchrow', request_id)
+        return answer_from_row(row) if row else None
+    
+    async def find_rag_answer(self, question: str, car: Optional[str],
+                              max_age_sec: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Последний ответ на такой же вопрос для такой же машины (не старше max_age_sec)"""
+        row = await self._query('rag_answer_latest', 'fetchrow', lookup_key(question, car), max_age_sec)
+        return answer_from_row(row) if row else None
+    
+    async def recent_rag_answers(self, user_id: int, limit: int, max_age_sec: float) -> List[Dict[str, Any]]:
+        """Последние limit ответов пользователя не старше max_age_sec, от новых к старым"""
+        rows = await self._query('rag_answers_recent', 'fetch', user_id, limit, max_age_sec)
+        return [answer_from_row(row) for row in rows]
+    
+    async def purge_rag_answers(self, retention_days: int, batch: int) -> int:
+        """Удаление ответов старше retention_days частями по batch строк"""
+        purged = 0
+        while True:
+            result = await self._query('rag_answers_purge', 'execute', retention_days, batch)
+            deleted = int(result.split()[-1])
+            purged += deleted
+            if deleted < batch:
+                return purged
+    
+    async def save_rag_resume(self, records: List[Tuple[str, int, int, int, Optional[int]]]) -> None:
+        """Сохранение прерванных ожиданий (request_id, user_id, chat_id, message_id, status_message_id)"""
+        columns = [list(column) for column in zip(*records)]
+        await self._query('rag_resume_save', 'execute', *columns)
+    
+    async def claim_rag_resume(self, max_age_sec: int) -> List[Dict[str, Any]]:
+        """Прерванные ожидания для возобновления (забираются из таблицы)"""
+        rows = await self._query('rag_resume_claim', 'fetch', max_age_sec)
+        return [dict(row) for row in rows]
     
     async def get_statistics(self, period: str) -> Dict[str, Any]:
         """Получение статистики за период"""
-        async with self.pool.acquire() as conn:
-            # Определяем временной интервал
-            if period == "day":
-                time_filter = "created_at >= NOW() - INTERVAL '1 day'"
-            elif period == "month":
-                time_filter = "created_at >= NOW() - INTERVAL '1 month'"
-            elif period == "year":
-                time_filter = "created_at >= NOW() - INTERVAL '1 year'"
-            else:
-                time_filter = "created_at >= NOW() - INTERVAL '1 day'"
-            
-            # Общее количество пользователей
-            total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            
-            # Активные пользователи за период
-            active_users = await conn.fetchval(f"""
-                SELECT COUNT(DISTINCT user_id) 
-                FROM messages 
-                WHERE {time_filter}
-            """)
-            
-            # Новые пользователи за период
-            new_users = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM users 
-                WHERE {time_filter}
-            """)
-            
-            # Общее количество сообщений за период
-            total_messages = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM messages 
-                WHERE {time_filter}
-            """)
-            
-            # Количество команд за период
-            commands = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM messages 
-                WHERE message_type = 'command' AND {time_filter}
-            """)
-            
-            # Количество текстовых сообщений за период
-            text_messages = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM messages 
-                WHERE message_type = 'text' AND {time_filter}
-            """)
-            
-            # Количество запросов к RAG API за период
-            rag_requests = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM rag_requests 
-                WHERE {time_filter}
-            """)
-            
-            # Количество неудачных RAG запросов за период
-            rag_failed = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM rag_requests 
-                WHERE status = 'failed' AND {time_filter}
-            """)
+        interval = _period_interval(period)
+        message_types = list(MESSAGE_EVENT_TYPES)
+        
+        async with self.pools[POOL_ANALYTICS].acquire() as conn:
+            # Пользователи: всего и новых за период
+            users_row = await self._query('stat_users', 'fetchrow', interval, conn=conn)
             
-            # Количество установок машин за период
-            car_setted = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM user_actions_log 
-                WHERE action = 'set_car' AND {time_filter}
-            """)
+            # Сообщения и действия за период — один проход по events
+            events_row = await self._query(
+                'stat_events', 'fetchrow', interval, message_types, EVENT_TYPES['set_car'],
+                EVENT_TYPES['text_question'], EVENT_TYPES['limit_exhausted'], conn=conn)
             
-            # Количество достижений лимитов за период
-            limits_exhausted = await conn.fetchval(f"""
-                SELECT COUNT(*) 
-                FROM user_actions_log 
-                WHERE action = 'limit_exhausted' AND {time_filter}
-            """)
+            # Запросы к RAG API за период и время ответа по дням
+            rag_row = await self._query('stat_rag', 'fetchrow', interval, conn=conn)
+            rag_latency = await self._query('stat_rag_latency', 'fetch', interval, RAG_SLO_SEC, conn=conn)
             
             # Топ пользователей по активности
-            top_users = await conn.fetch(f"""
-                SELECT u.username, u.user_id, COUNT(m.id) as message_count
-                FROM users u
-                JOIN messages m ON u.user_id = m.user_id
-                WHERE m.{time_filter}
-                GROUP BY u.user_id, u.username
-                ORDER BY message_count DESC
-                LIMIT 5
-            """)
+            top_users = await self._query('stat_top_users', 'fetch', interval, message_types, conn=conn)
             
             # Статистика по ролям
-            role_stats = await conn.fetch(f"""
-                SELECT role, COUNT(*) as count
-                FROM users
-                WHERE {time_filter}
-                GROUP BY role
-            """)
+            role_stats = await self._query('stat_roles', 'fetch', interval, conn=conn)
             
             return {
                 "period": period,
-                "total_users": total_users,
-                "active_users": active_users,
-                "new_users": new_users,
-                "total_messages": total_messages,
-                "commands": commands,
-                "text_messages": text_messages,
-                "rag_requests": rag_requests,
-                "rag_failed": rag_failed,
-                "car_setted": car_setted,
-                "limits_exhausted": limits_exhausted,
+                "total_users": users_row['total_users'],
+                "active_users": events_row['active_users'],
+                "new_users": users_row['new_users'],
+                "total_messages": events_row['total_messages'],
+                "commands": events_row['commands'],
+                "text_messages": events_row['text_messages'],
+                "rag_requests": rag_row['rag_requests'],
+                "rag_failed": rag_row['rag_failed'],
+                "rag_latency": [dict(row) for row in rag_latency],
+                "rag_slo_sec": RAG_SLO_SEC,
+                "car_setted": events_row['commands'],
+                "limits_exhausted": events_row['limits_exhausted'],
                 "top_users": [dict(row) for row in top_users],
                 "role_stats": [dict(row) for row in role_stats]
             }
     
     async def delete_user(self, user_id: int) -> bool:
         """Удаление пользователя"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute("""
-                DELETE FROM users WHERE user_id = $1
-            """, user_id)
-            return result == "DELETE 1"
+        row = await self._query('delete_user', 'fetchrow', user_id)
+        if row and user_id < 0 and row['username']:
+            self.pending_usernames.discard(row['username'].lower())
+        return row is not None
     
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получение информации о пользователе"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT user_id, username, role, allowed, car, created_at
-                FROM users WHERE user_id = $1
-            """, user_id)
-            return dict(row) if row else None
+        row = await self._query('get_user', 'fetchrow', user_id)
+        return dict(row) if row else None
     
     async def is_user_allowed(self, user_id: int) -> bool:
         """Проверка разрешения доступа пользователя"""
@@ -253,126 +455,232 @@ class Database:
     
     async def set_car(self, user_id: int, car_description: str) -> bool:
         """Сохранение информации об автомобиле"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE users SET car = $1 WHERE user_id = $2
-            """, car_description, user_id)
-            return True
+        await self._query('set_car', 'execute', car_description, user_id)
+        return True
     
     async def get_car(self, user_id: int) -> Optional[str]:
         """Получение информации об автомобиле"""
         user = await self.get_user(user_id)
         return user['car'] if user else None
     
-    async def list_users(self, filter_type: str = None, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-        """Получение списка пользователей с фильтрацией"""
-        async with self.pool.acquire() as conn:
-            # По умолчанию - последние добавленные (ORDER BY created_at DESC)
-            rows = await conn.fetch("""
-                SELECT user_id, username, role, allowed, car, created_at
-                FROM users
-                ORDER BY created_at DESC
-                LIMIT $1 OFFSET $2
-            """, limit, offset)
-            
-            return [dict(row) for row in rows]
+    async def list_users(self, limit: int = 20,
+                         after: Optional[Tuple[datetime, int]] = None,
+                         before: Optional[Tuple[datetime, int]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """Получение страницы пользователей, последние добавленные сначала"""
+        return await self._users_page('all', True, limit, after, before)
     
     async def list_users_top(self, limit: int = 50) -> List[Dict[str, Any]]:
-        """Получение топ пользователей по количеству вопросов (rag_requests)"""
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT u.user_id, u.username, u.role, u.allowed, u.car, u.created_at,
-                       COUNT(r.id) as question_count
-                FROM users u
-                LEFT JOIN rag_requests r ON u.user_id = r.user_id
-                GROUP BY u.user_id, u.username, u.role, u.allowed, u.car, u.created_at
-                ORDER BY question_count DESC
-                LIMIT $1
-            """, limit)
-            
-            return [dict(row) for row in rows]
+        """Получение топ пользователей по количеству вопросов (счётчик users.question_count)"""
+        rows = await self._query('list_users_top', 'fetch', limit)
+        return [dict(row) for row in rows]
+    
+    async def _iter_rows(self, name: str, *args, chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[List[asyncpg.Record]]:
+        """Чтение результата запроса реестра пачками через серверный курсор"""
+        statement = STATEMENTS[name]
+        async with self.pools[statement.pool].acquire() as conn:
+            async with conn.transaction(readonly=True):
+                started = time.perf_counter()
+                cursor = await conn.cursor(statement.sql, *args)
+                self.query_stats.observe(name, time.perf_counter() - started)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+    
+    def iter_users_for_csv(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[List[asyncpg.Record]]:
+        """Потоковое получение всех пользователей для CSV экспорта"""
+        return self._iter_rows('export_users', chunk_size=chunk_size)
     
-    async def list_all_users_for_csv(self) -> List[Dict[str, Any]]:
-        """Получение всех пользователей для CSV экспорта"""
+    def iter_user_analytics_for_csv(self, period: str = "day",
+                                    chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[List[asyncpg.Record]]:
+        """Потоковое получение аналитики по всем пользователям одним запросом"""
+        return self._iter_rows(
+            'export_user_analytics', _period_interval(period), list(MESSAGE_EVENT_TYPES),
+            EVENT_TYPES['set_car'], EVENT_TYPES['text_question'], EVENT_TYPES['limit_exhausted'],
+            chunk_size=chunk_size)
+    
+    async def seed_bootstrap(self, templates: List[Tuple[str, str, str]], admins: Dict[int, str]) -> None:
+        """
+        Запись шаблонов по умолчанию и администраторов из окружения одной транзакцией
+        
+        Args:
+            templates: Список (key, value, description)
+            admins: user_id -> username
+        """
+        keys, values, descriptions = (list(column) for column in zip(*templates)) if templates else ([], [], [])
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT u.user_id, u.username, u.role, u.allowed, u.car, u.created_at,
-                       COUNT(r.id) as question_count,
-                       ua.src, ua.campaign, ua.ad
-                FROM users u
-                LEFT JOIN rag_requests r ON u.user_id = r.user_id
-                LEFT JOIN user_acquisition ua ON u.user_id = ua.user_id
-                GROUP BY u.user_id, u.username, u.role, u.allowed, u.car, u.created_at,
-                         ua.src, ua.campaign, ua.ad
-                ORDER BY u.created_at DESC
-            """)
-            
-            return [dict(row) for row in rows]
+            async with conn.transaction():
+                await self._query('seed_templates', 'execute', keys, values, descriptions, conn=conn)
+                await self._query('seed_admins', 'execute', list(admins), list(admins.values()), conn=conn)
     
+    # FSM storage
+    async def get_fsm_record(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """Состояние и данные FSM (данные — JSON-строка) или (None, None)"""
+        row = await self._query('fsm_get', 'fetchrow', key)
+        return (row['state'], row['data']) if row else (None, None)
+    
+    async def set_fsm_state(self, key: str, state: Optional[str], ttl: int, origin: str) -> None:
+        """Запись состояния FSM (None — сброс) с уведомлением других процессов"""
+        if state is None:
+            await self._query('fsm_clear_state', 'execute', key, origin)
+        else:
+            await self._query('fsm_set_state', 'execute', key, state, ttl, origin)
+    
+    async def set_fsm_data(self, key: str, data: Optional[str], ttl: int, origin: str) -> None:
+        """Запись данных FSM (JSON-строка, None — сброс) с уведомлением других процессов"""
+        if data is None:
+            await self._query('fsm_clear_data', 'execute', key, origin)
+        else:
+            await self._query('fsm_set_data', 'execute', key, data, ttl, origin)
+    
+    async def purge_fsm_states(self) -> int:
+        """Удаление просроченных состояний FSM"""
+        result = await self._query('fsm_purge', 'execute')
+        return int(result.split()[-1])
+
+    # Update queue
+    async def enqueue_updates(self, updates: List[Tuple[int, int, Optional[int], str]]) -> None:
+        """Добавление обновлений (update_id, shard, user_id, JSON) в очередь одним запросом"""
+        update_ids, shards, user_ids, payloads = (list(column) for column in zip(*updates))
+        await self._query('enqueue_updates', 'execute', update_ids, shards, user_ids, payloads)
+
+    async def fetch_queued_updates(self, shards: List[int], after_ids: List[int], limit: int) -> List[asyncpg.Record]:
+        """Очередные обновления шардов (после указанного id каждого шарда) в порядке id"""
+        return await self._query('fetch_queued_updates', 'fetch', shards, after_ids, limit)
+
+    async def ack_updates(self, ids: List[int]) -> None:
+        """Удаление обработанных обновлений"""
+        await self._query('ack_updates', 'execute', ids)
+
+    async def seed_update_shards(self, count: int) -> None:
+        await self._query('seed_update_shards', 'execute', count)
+
+    async def worker_heartbeat(self, worker_id: str, lease_sec: int) -> int:
+        """Отметка воркера, возвращает число живых воркеров"""
+        return await self._query('worker_heartbeat', 'fetchval', worker_id, lease_sec)
+
+    async def remove_worker(self, worker_id: str) -> None:
+        await self._query('remove_worker', 'execute', worker_id)
+
+    async def claim_update_shards(self, worker_id: str, lease_sec: int, limit: int, shard_count: int) -> List[int]:
+        """Захват до limit свободных шардов (или шардов с истёкшей арендой)"""
+        rows = await self._query('claim_update_shards', 'fetch', worker_id, lease_sec, limit, shard_count)
+        return [row['shard'] for row in rows]
+
+    async def renew_update_shards(self, worker_id: str, lease_sec: int, shards: List[int]) -> List[int]:
+        """Продление аренды, возвращает шарды, оставшиеся за воркером"""
+        rows = await self._query('renew_update_shards', 'fetch', worker_id, lease_sec, shards)
+        return [row['shard'] for row in rows]
+
+    async def release_update_shards(self, worker_id: str, shards: List[int]) -> None:
+        await self._query('release_update_shards', 'execute', worker_id, shards)
+
+    # Broadcasts
+    async def create_broadcast(self, created_by: int, text: str, progress_chat_id: int) -> int:
+        """Черновик рассылки, возвращает ID"""
+        return await self._query('broadcast_create', 'fetchval', created_by, text, progress_chat_id)
+
+    async def set_broadcast_progress_message(self, job_id: int, message_id: int) -> None:
+        await self._query('broadcast_set_progress_message', 'execute', job_id, message_id)
+
+    async def start_broadcast(self, job_id: int) -> Optional[int]:
+        """Запуск черновика, возвращает число получателей (None, если рассылка не черновик)"""
+        return await self._query('broadcast_start', 'fetchval', job_id)
+
+    async def cancel_broadcast(self, job_id: int) -> bool:
+        return await self._query('broadcast_cancel', 'fetchval', job_id) is not None
+
+    async def get_broadcast(self, job_id: int) -> Optional[Dict[str, Any]]:
+        row = await self._query('broadcast_get', 'fetchrow', job_id)
+        return dict(row) if row else None
+
+    async def get_recent_broadcasts(self, limit: int = 5) -> List[Dict[str, Any]]:
+        rows = await self._query('broadcast_recent', 'fetch', limit)
+        return [dict(row) for row in rows]
+
+    async def claim_broadcasts(self, owner: str, lease_sec: int) -> List[Dict[str, Any]]:
+        """Захват запущенных рассылок без живого владельца"""
+        rows = await self._query('broadcast_claim', 'fetch', owner, lease_sec)
+        return [dict(row) for row in rows]
+
+    async def renew_broadcast(self, job_id: int, owner: str, lease_sec: int, cursor_user_id: int) -> Optional[str]:
+        """Продление аренды с сохранением позиции, возвращает статус (None — аренда потеряна)"""
+        return await self._query('broadcast_renew', 'fetchval', job_id, owner, lease_sec, cursor_user_id)
+
+    async def release_broadcasts(self, owner: str) -> None:
+        await self._query('broadcast_release', 'execute', owner)
+
+    async def finish_broadcast(self, job_id: int, owner: str) -> None:
+        await self._query('broadcast_finish', 'execute', job_id, owner)
+
+    async def get_broadcast_recipients(self, job_id: int, after_user_id: int, limit: int) -> List[int]:
+        """Следующая страница получателей по user_id (keyset)"""
+        rows = await self._query('broadcast_recipients_page', 'fetch', job_id, after_user_id, limit)
+        return [row['user_id'] for row in rows]
+
+    async def record_broadcast_results(self, records: List[Tuple[int, int, str, Optional[str]]]) -> None:
+        """Пакетная запись статусов получателей (job_id, user_id, status, error)"""
+        job_ids, user_ids, statuses, errors = (list(column) for column in zip(*records))
+        await self._query('broadcast_record', 'execute', job_ids, user_ids, statuses, errors)
+
     # Template management
     async def get_template(self, key: str) -> Optional[str]:
         """Получение шаблона текста по ключу"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT value FROM text_templates WHERE key = $1", key)
-            return row['value'] if row else None
+        return await self._query('get_template', 'fetchval', key)
     
     async def set_template(self, key: str, value: str, description: str = None) -> bool:
         """Сохранение шаблона текста"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO text_templates (key, value, description)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
-            """, key, value, description)
-            return True
+        await self._query('set_template', 'execute', key, value, description)
+        return True
     
     # Action logging
     async def log_action(self, user_id: int, action: str, object_data: str = None) -> None:
-        """Логирование действия пользователя"""
+        """Логирование действия пользователя (запись в events происходит пакетами)"""
+        code = event_code(action)
+        if code == EVENT_TYPES['other']:
+            object_data = f"{action}:{object_data or ''}"
+        self.events.add((user_id, code, object_data, utc_now()))
+    
+    async def _write_events(self, records: List[tuple]) -> None:
+        """Пакетная запись событий через COPY и обновление users.last_seen_at"""
+        # Записи идут в порядке добавления, поэтому последняя запись пользователя — самая свежая
+        last_seen = {user_id: created_at for user_id, _, _, created_at in records}
+        
         async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO user_actions_log (user_id, action, object)
-                VALUES ($1, $2, $3)
-            """, user_id, action, object_data)
+            async with conn.transaction():
+                await conn.copy_records_to_table(
+                    'events',
+                    records=records,
+                    columns=('user_id', 'event_type', 'payload', 'created_at'),
+                )
+                await self._query('update_last_seen', 'execute',
+                                  list(last_seen), list(last_seen.values()), conn=conn)
     
     # User acquisition tracking
     async def save_user_acquisition(self, user_id: int, payload_raw: str, payload_decoded: str, 
                                    src: str, campaign: str, ad: str, language_code: str) -> bool:
         """Сохранение информации о привлечении пользователя"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO user_acquisition (user_id, payload_raw, payload_decoded, src, campaign, ad, language_code)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                ON CONFLICT (user_id) DO NOTHING
-            """, user_id, payload_raw, payload_decoded, src, campaign, ad, language_code)
-            return True
+        await self._query('save_user_acquisition', 'execute',
+                          user_id, payload_raw, payload_decoded, src, campaign, ad, language_code)
+        return True
     
     async def get_user_acquisition(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получение информации о привлечении пользователя"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT user_id, payload_raw, payload_decoded, src, campaign, ad, language_code
-                FROM user_acquisition WHERE user_id = $1
-            """, user_id)
-            return dict(row) if row else None
+        row = await self._query('get_user_acquisition', 'fetchrow', user_id)
+        return dict(row) if row else None
     
     # User limits management
     async def get_user_limits(self, user_id: int) -> Dict[str, Any]:
         """Получение лимитов пользователя"""
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT absolute_limit, absolute_used, weekly_limit, weekly_used, week_start
-                FROM user_limits WHERE user_id = $1
-            """, user_id)
+            row = await self._query('get_user_limits', 'fetchrow', user_id, conn=conn)
             
             if row:
                 return dict(row)
             else:
                 # Создаем запись с лимитами по умолчанию
-                await conn.execute("""
-                    INSERT INTO user_limits (user_id, absolute_limit, weekly_limit)
-                    VALUES ($1, NULL, NULL)
-                """, user_id)
+                await self._query('create_user_limits', 'execute', user_id, conn=conn)
                 return {
                     'absolute_limit': None,
                     'absolute_used': 0,
@@ -387,21 +695,12 @@ class Database:
         Returns: (can_proceed, error_message)
         """
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT absolute_limit, absolute_used, weekly_limit, weekly_used, week_start
-                FROM user_limits WHERE user_id = $1
-            """, user_id)
+            row = await self._query('get_user_limits', 'fetchrow', user_id, conn=conn)
             
             # Если запись не существует, создаем её
             if not row:
-                await conn.execute("""
-                    INSERT INTO user_limits (user_id)
-                    VALUES ($1)
-                """, user_id)
-                row = await conn.fetchrow("""
-                    SELECT absolute_limit, absolute_used, weekly_limit, weekly_used, week_start
-                    FROM user_limits WHERE user_id = $1
-                """, user_id)
+                await self._query('create_user_limits', 'execute', user_id, conn=conn)
+                row = await self._query('get_user_limits', 'fetchrow', user_id, conn=conn)
             
             limits = dict(row)
             
@@ -428,11 +727,7 @@ class Database:
                 week_duration = timedelta(days=7)
                 if now - week_start >= week_duration:
                     # Сбрасываем недельный лимит
-                    await conn.execute("""
-                        UPDATE user_limits 
-                        SET weekly_used = 0, week_start = NOW()
-                        WHERE user_id = $1
-                    """, user_id)
+                    await self._query('reset_weekly_limit', 'execute', user_id, conn=conn)
                     limits['weekly_used'] = 0
                     limits['week_start'] = now
                 else:
@@ -440,126 +735,69 @@ class Database:
                         return False, "weekly_limit_exceeded"
             
             # Увеличиваем лимиты
-            await conn.execute("""
-                UPDATE user_limits
-                SET absolute_used = absolute_used + 1,
-                    weekly_used = weekly_used + 1,
-                    week_start = COALESCE(week_start, NOW())
-                WHERE user_id = $1
-            """, user_id)
+            await self._query('increment_limits', 'execute', user_id, conn=conn)
             
             return True, ""
     
     async def update_user_limits(self, user_id: int, absolute_limit: int = None, weekly_limit: int = None) -> bool:
         """Обновление лимитов пользователя"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE user_limits
-                SET absolute_limit = $1, weekly_limit = $2
-                WHERE user_id = $3
-            """, absolute_limit, weekly_limit, user_id)
-            return True
+        await self._query('update_user_limits', 'execute', absolute_limit, weekly_limit, user_id)
+        return True
     
     async def update_all_users_limits(self, absolute_limit: int = None, weekly_limit: int = None) -> bool:
         """Обновление лимитов для всех пользователей"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE user_limits
-                SET absolute_limit = $1, weekly_limit = $2
-            """, absolute_limit, weekly_limit)
-            return True
+        await self._query('update_all_users_limits', 'execute', absolute_limit, weekly_limit)
+        return True
     
     async def get_user_analytics(self, user_id: int, period: str = "day") -> Dict[str, Any]:
         """Получение аналитики по пользователю"""
-        async with self.pool.acquire() as conn:
-            # Определяем временной интервал
-            if period == "day":
-                time_filter = "created_at >= NOW() - INTERVAL '1 day'"
-            elif period == "month":
-                time_filter = "created_at >= NOW() - INTERVAL '1 month'"
-            elif period == "year":
-                time_filter = "created_at >= NOW() - INTERVAL '1 year'"
-            else:
-                time_filter = "created_at >= NOW() - INTERVAL '1 day'"
-            
-            # Количество сообщений
-            total_messages = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM messages
-                WHERE user_id = $1 AND {time_filter}
-            """, user_id)
-            
-            # Команды
-            commands = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM messages
-                WHERE user_id = $1 AND message_type = 'command' AND {time_filter}
-            """, user_id)
-            
-            # Текстовые сообщения
-            text_messages = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM messages
-                WHERE user_id = $1 AND message_type = 'text' AND {time_filter}
-            """, user_id)
-            
-            # RAG запросы
-            rag_requests = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM rag_requests
-                WHERE user_id = $1 AND {time_filter}
-            """, user_id)
-            
-            # RAG ошибки
-            rag_failed = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM rag_requests
-                WHERE user_id = $1 AND status = 'failed' AND {time_filter}
-            """, user_id)
-            
-            # Установка машины
-            car_setted = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM user_actions_log
-                WHERE user_id = $1 AND action = 'set_car' AND {time_filter}
-            """, user_id)
-            
-            # Достижение лимитов
-            limits_exhausted = await conn.fetchval(f"""
-                SELECT COUNT(*) FROM user_actions_log
-                WHERE user_id = $1 AND action = 'limit_exhausted' AND {time_filter}
-            """, user_id)
-            
-            # Информация о пользователе
-            user = await self.get_user(user_id)
-            acquisition = await self.get_user_acquisition(user_id)
-            limits = await self.get_user_limits(user_id)
-            
-            is_blocked = not user['allowed'] if user else True
-            is_admin = user['role'] == 'admin' if user else False
-            car_name = user['car'] if user and user.get('car') else None
-            
-            # Проверяем достижение лимитов
-            limits_reached = False
-            if limits['absolute_limit'] is not None and limits['absolute_used'] >= limits['absolute_limit']:
-                limits_reached = True
-            elif limits['weekly_limit'] is not None and limits['weekly_used'] >= limits['weekly_limit']:
-                limits_reached = True
-            
-            return {
-                'user_id': user_id,
-                'username': user['username'] if user else None,
-                'first_seen_at': user['created_at'] if user else None,
-                'last_seen_at': None,
-                'total_messages': total_messages,
-                'command_messages': commands,
-                'text_messages': text_messages,
-                'rag_requests': rag_requests,
-                'rag_failed': rag_failed,
-                'is_blocked': is_blocked,
-                'is_admin': is_admin,
-                'car': car_name,
-                'limits_reached': limits_reached,
-                'src': acquisition['src'] if acquisition else None,
-                'campaign': acquisition['campaign'] if acquisition else None,
-                'ad': acquisition['ad'] if acquisition else None,
-                'car_setted': car_setted,
-                'limits_exhausted': limits_exhausted
-            }
+        interval = _period_interval(period)
+        
+        async with self.pools[POOL_ANALYTICS].acquire() as conn:
+            # Сообщения и действия пользователя — один проход по events
+            events_row = await self._query(
+                'user_stat_events', 'fetchrow', user_id, interval, list(MESSAGE_EVENT_TYPES),
+                EVENT_TYPES['set_car'], EVENT_TYPES['text_question'], EVENT_TYPES['limit_exhausted'], conn=conn)
+            
+            # RAG запросы и ошибки
+            rag_row = await self._query('user_stat_rag', 'fetchrow', user_id, interval, conn=conn)
+        
+        # Информация о пользователе
+        user = await self.get_user(user_id)
+        acquisition = await self.get_user_acquisition(user_id)
+        limits = await self.get_user_limits(user_id)
+        
+        is_blocked = not user['allowed'] if user else True
+        is_admin = user['role'] == 'admin' if user else False
+        car_name = user['car'] if user and user.get('car') else None
+        
+        # Проверяем достижение лимитов
+        limits_reached = False
+        if limits['absolute_limit'] is not None and limits['absolute_used'] >= limits['absolute_limit']:
+            limits_reached = True
+        elif limits['weekly_limit'] is not None and limits['weekly_used'] >= limits['weekly_limit']:
+            limits_reached = True
+        
+        return {
+            'user_id': user_id,
+            'username': user['username'] if user else None,
+            'first_seen_at': user['created_at'] if user else None,
+            'last_seen_at': user['last_seen_at'] if user else None,
+            'total_messages': events_row['total_messages'],
+            'command_messages': events_row['commands'],
+            'text_messages': events_row['text_messages'],
+            'rag_requests': rag_row['rag_requests'],
+            'rag_failed': rag_row['rag_failed'],
+            'is_blocked': is_blocked,
+            'is_admin': is_admin,
+            'car': car_name,
+            'limits_reached': limits_reached,
+            'src': acquisition['src'] if acquisition else None,
+            'campaign': acquisition['campaign'] if acquisition else None,
+            'ad': acquisition['ad'] if acquisition else None,
+            'car_setted': events_row['commands'],
+            'limits_exhausted': events_row['limits_exhausted']
+        }
 
 # Глобальный экземпляр базы данных
 db = Database()
@@ -0,0 +1,33 @@
+"""
+Коды типов событий для таблицы events
+
+Коды должны совпадать с содержимым таблицы event_types (database/models.sql и миграция
+20251101_add_unified_events). Новые типы добавляются только в конец, коды не переиспользуются.
+"""
+from typing import Dict
+
+EVENT_TYPES: Dict[str, int] = {
+    'other': 0,
+    'start': 1,
+    'menu_action': 2,
+    'support_command': 3,
+    'my_car': 4,
+    'delete_car': 5,
+    'set_car_start': 6,
+    'set_car': 7,
+    'media_message': 8,
+    'text_question': 9,
+    'limit_exhausted': 10,
+}
+
+# События, которые раньше дополнительно записывались в таблицу messages
+MESSAGE_EVENT_TYPES: Dict[int, str] = {
+    EVENT_TYPES['set_car']: 'command',
+    EVENT_TYPES['media_message']: 'media',
+    EVENT_TYPES['text_question']: 'text',
+}
+
+
+def event_code(action: str) -> int:
+    """Код события по имени действия (0 для неизвестных действий)"""
+    return EVENT_TYPES.get(action, EVENT_TYPES['other'])
@@ -0,0 +1,174 @@
+"""
+Хранилище состояний FSM aiogram в PostgreSQL
+
+Состояния переживают перезапуск и видны всем репликам. aiogram читает состояние
+на каждое обновление, поэтому перед базой стоит LRU-кэш, включая отрицательные
+результаты («состояния нет»). Записи в других процессах сбрасывают кэш через
+LISTEN/NOTIFY, просроченные состояния периодически удаляются.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, BaseStorage, StateType, StorageKey
+
+from database.db import Database
+from database.statements import FSM_CHANNEL
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Время жизни брошенного состояния (например, /set_car без ответа)
+FSM_STATE_TTL_SEC = int(os.getenv('FSM_STATE_TTL_SEC', 86400))
+# Размер и время жизни записи кэша в процессе
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+FSM_CACHE_TTL_SEC = float(os.getenv('FSM_CACHE_TTL_SEC', 60))
+# Интервал удаления просроченных состояний
+FSM_PURGE_INTERVAL_SEC = float(os.getenv('FSM_PURGE_INTERVAL_SEC', 600))
+
+
+def storage_key(key: StorageKey) -> str:
+    """Компактный строковый ключ: bot:chat:user[:thread][:destiny]"""
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(str(key.thread_id))
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(key.destiny)
+    return ':'.join(parts)
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище поверх пула Database"""
+
+    def __init__(self, database: Database, ttl: int = FSM_STATE_TTL_SEC,
+                 cache_size: int = FSM_CACHE_SIZE, cache_ttl: float = FSM_CACHE_TTL_SEC):
+        self.db = database
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # key -> (state, data, момент загрузки)
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+        # Свои уведомления отличаются по префиксу и не сбрасывают кэш
+        self._origin = uuid.uuid4().hex[:12]
+        self._listener: Optional[asyncpg.Connection] = None
+        self._purge_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self) -> None:
+        """Подписка на уведомления и запуск очистки (после подключения к базе)"""
+        try:
+            self._listener = await self.db.pool.acquire()
+            await self._listener.add_listener(FSM_CHANNEL, self._on_notify)
+            self._listener.add_termination_listener(self._on_listener_lost)
+        except (OSError, asyncpg.PostgresError) as e:
+            # Без уведомлений кэш может расходиться с другими репликами — работаем без него
+            logger.warning(f"FSM cache disabled, LISTEN failed: {e}")
+            await self._release_listener()
+            self.cache_size = 0
+        if self._purge_task is None:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+        logger.info(f"Postgres FSM storage started (ttl {self.ttl}s, cache {self.cache_size})")
+
+    async def close(self) -> None:
+        if self._purge_task:
+            self._purge_task.cancel()
+            try:
+                await self._purge_task
+            except asyncio.CancelledError:
+                pass
+            self._purge_task = None
+        await self._release_listener()
+        # Без уведомлений кэш может расходиться с другими репликами: обработчики, которые
+        # дорабатывают после закрытия (shutdown диспетчера), читают состояние из базы
+        self.cache_size = 0
+        self._cache.clear()
+
+    async def _release_listener(self) -> None:
+        if self._listener is None:
+            return
+        listener, self._listener = self._listener, None
+        try:
+            await listener.remove_listener(FSM_CHANNEL, self._on_notify)
+            await self.db.pool.release(listener)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            logger.debug(f"FSM listener release failed: {e}")
+
+    def _on_notify(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        origin, _, key = payload.partition(' ')
+        if origin != self._origin:
+            self._cache.pop(key, None)
+
+    def _on_listener_lost(self, connection: asyncpg.Connection) -> None:
+        logger.warning("FSM notification connection lost, cache disabled")
+        self._listener = None
+        self.cache_size = 0
+        self._cache.clear()
+
+    async def _purge_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FSM_PURGE_INTERVAL_SEC)
+            try:
+                purged = await self.db.purge_fsm_states()
+                if purged:
+                    logger.info(f"Purged {purged} expired FSM state(s)")
+            except Exception as e:
+                logger.warning(f"FSM purge failed: {e}")
+
+    # --- Кэш ---
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        # Уведомление, пришедшее во время чтения из базы, может не сбросить прочитанное значение;
+        # такое расхождение ограничено временем жизни записи кэша
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[2] < self.cache_ttl:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[0], cached[1]
+
+        self.misses += 1
+        state, raw_data = await self.db.get_fsm_record(key)
+        data = json.loads(raw_data) if raw_data else {}
+        self._remember(key, state, data)
+        return state, data
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = (state, data, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = storage_key(key)
+        value = state.state if isinstance(state, State) else state
+        await self.db.set_fsm_state(name, value, self.ttl, self._origin)
+        # Если ключа нет в кэше, данные неизвестны — он загрузится при следующем чтении
+        cached = self._cache.get(name)
+        if cached:
+            self._remember(name, value, cached[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(storage_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        name = storage_key(key)
+        payload = json.dumps(data, ensure_ascii=False) if data else None
+        await self.db.set_fsm_data(name, payload, self.ttl, self._origin)
+        cached = self._cache.get(name)
+        if cached:
+            self._remember(name, cached[0], data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(storage_key(key))
+        return data.copy()
@@ -4,7 +4,9 @@ CREATE TABLE IF NOT EXISTS users (
   role        TEXT,           -- 'admin' или 'user'
   allowed     BOOLEAN DEFAULT FALSE,
   car         TEXT,
-  created_at  TIMESTAMP DEFAULT NOW()
+  created_at  TIMESTAMP NOT NULL DEFAULT NOW(),
+  question_count INTEGER NOT NULL DEFAULT 0,  -- число запросов к RAG (поддерживается триггером)
+  last_seen_at   TIMESTAMP                    -- время последнего события (обновляется при записи events)
 );
 
 -- Таблица для хранения статистики запросов к RAG API
@@ -14,19 +16,39 @@ CREATE TABLE IF NOT EXISTS rag_requests (
   request_id  TEXT,
   text        TEXT,
   status      TEXT DEFAULT 'pending', -- 'pending', 'success', 'failed'
-  created_at  TIMESTAMP DEFAULT NOW(),
+  created_at  TIMESTAMP DEFAULT NOW(),  -- вопрос пользователя
+  accepted_at TIMESTAMP,                -- RAG API принял запрос (вернул request_id)
+  completed_at TIMESTAMP,               -- получен ответ, отказ или истекло ожидание
+  poll_count  INTEGER,                  -- опросов статуса до завершения
+  answer_length INTEGER,                -- длина ответа, символов
   FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
+-- Завершение запроса обновляется по request_id, статистика выбирает по created_at
+CREATE INDEX IF NOT EXISTS idx_rag_requests_request_id ON rag_requests (request_id);
+CREATE INDEX IF NOT EXISTS idx_rag_requests_created_at ON rag_requests (created_at);
 
--- Таблица для хранения статистики сообщений
-CREATE TABLE IF NOT EXISTS messages (
-  id          SERIAL PRIMARY KEY,
-  user_id     BIGINT NOT NULL,
-  message_type TEXT NOT NULL, -- 'command', 'text', 'rag_response'
-  content     TEXT,
-  created_at  TIMESTAMP DEFAULT NOW(),
-  FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
+CREATE INDEX IF NOT EXISTS idx_users_question_count ON users (question_count DESC);
+-- Keyset-пагинация /list_users и /pending_users
+CREATE INDEX IF NOT EXISTS idx_users_created_user ON users (created_at, user_id);
+CREATE INDEX IF NOT EXISTS idx_users_pending_created ON users (created_at, user_id) WHERE user_id < 0;
+-- Поиск пользователя, добавленного по @username, при активации
+CREATE INDEX IF NOT EXISTS idx_users_pending_username ON users (lower(username)) WHERE user_id < 0;
+
+-- Счётчик вопросов пользователя ведётся триггером на rag_requests
+CREATE OR REPLACE FUNCTION rag_requests_count_questions() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    UPDATE users SET question_count = question_count + 1 WHERE user_id = NEW.user_id;
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE users SET question_count = GREATEST(question_count - 1, 0) WHERE user_id = OLD.user_id;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_rag_requests_count_questions
+AFTER INSERT OR DELETE ON rag_requests
+FOR EACH ROW EXECUTE FUNCTION rag_requests_count_questions();
 
 -- Таблица для хранения шаблонов текстов
 CREATE TABLE IF NOT EXISTS text_templates (
@@ -34,20 +56,70 @@ CREATE TABLE IF NOT EXISTS text_templates (
   key         TEXT UNIQUE NOT NULL,
   value       TEXT NOT NULL,
   description TEXT,
-  created_at  TIMESTAMP DEFAULT NOW(),
+  created_at  TIMESTAMP NOT NULL DEFAULT NOW(),
   updated_at  TIMESTAMP DEFAULT NOW()
 );
 
--- Таблица для логирования действий пользователей
-CREATE TABLE IF NOT EXISTS user_actions_log (
-  id          SERIAL PRIMARY KEY,
+-- Справочник типов событий (коды совпадают с database/events.py)
+CREATE TABLE IF NOT EXISTS event_types (
+  code        SMALLINT PRIMARY KEY,
+  name        TEXT UNIQUE NOT NULL
+);
+
+INSERT INTO event_types (code, name) VALUES
+  (0, 'other'),
+  (1, 'start'),
+  (2, 'menu_action'),
+  (3, 'support_command'),
+  (4, 'my_car'),
+  (5, 'delete_car'),
+  (6, 'set_car_start'),
+  (7, 'set_car'),
+  (8, 'media_message'),
+  (9, 'text_question'),
+  (10, 'limit_exhausted')
+ON CONFLICT (code) DO NOTHING;
+
+-- Единый журнал событий пользователей (заменяет messages и user_actions_log)
+-- Без внешнего ключа на users: журнал пишется пакетами и не должен падать из-за удалённого пользователя
+CREATE TABLE IF NOT EXISTS events (
+  id          BIGSERIAL PRIMARY KEY,
   user_id     BIGINT NOT NULL,
-  action      TEXT NOT NULL,
-  object      TEXT,
-  created_at  TIMESTAMP DEFAULT NOW(),
-  FOREIGN KEY (user_id) REFERENCES users(user_id)
+  event_type  SMALLINT NOT NULL,  -- код из event_types
+  payload     TEXT,
+  created_at  TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
+CREATE INDEX IF NOT EXISTS idx_events_created_at ON events USING BRIN (created_at);
+CREATE INDEX IF NOT EXISTS idx_events_user_created ON events (user_id, created_at);
+
+-- Представления для совместимости со старыми таблицами messages и user_actions_log
+-- (пока миграция не переименовала старые таблицы, представления не создаются)
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('user_actions_log') AND relkind = 'r') THEN
+    CREATE OR REPLACE VIEW user_actions_log AS
+    SELECT e.id,
+           e.user_id,
+           CASE WHEN e.event_type = 0 THEN split_part(e.payload, ':', 1) ELSE t.name END AS action,
+           CASE WHEN e.event_type = 0 THEN substr(e.payload, strpos(e.payload, ':') + 1) ELSE e.payload END AS object,
+           e.created_at
+    FROM events e
+    JOIN event_types t ON t.code = e.event_type;
+  END IF;
+
+  IF NOT EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('messages') AND relkind = 'r') THEN
+    CREATE OR REPLACE VIEW messages AS
+    SELECT e.id,
+           e.user_id,
+           CASE e.event_type WHEN 7 THEN 'command' WHEN 8 THEN 'media' ELSE 'text' END AS message_type,
+           CASE WHEN e.event_type = 7 THEN 'set_car: ' || e.payload || '...' ELSE e.payload END AS content,
+           e.created_at
+    FROM events e
+    WHERE e.event_type IN (7, 8, 9);
+  END IF;
+END $$;
+
 -- Таблица для хранения информации о привлечении пользователей (рекламные источники)
 CREATE TABLE IF NOT EXISTS user_acquisition (
   id             SERIAL PRIMARY KEY,
@@ -73,3 +145,105 @@ CREATE TABLE IF NOT EXISTS user_limits (
   week_start          TIMESTAMP DEFAULT NOW(), -- Начало недели для отсчета
   FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
+
+-- Состояния FSM aiogram (database/fsm_storage.py)
+-- key: bot_id:chat_id:user_id[:thread_id][:destiny]; пустые state и data не хранятся
+CREATE TABLE IF NOT EXISTS fsm_states (
+  key         TEXT PRIMARY KEY,
+  state       TEXT,
+  data        JSONB,
+  expires_at  TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at);
+
+-- Очередь обновлений Telegram для режимов ingress/worker (utils/update_queue.py)
+-- shard = user_id % UPDATE_QUEUE_SHARDS; строка удаляется после обработки
+CREATE TABLE IF NOT EXISTS update_queue (
+  id          BIGSERIAL PRIMARY KEY,
+  update_id   BIGINT UNIQUE NOT NULL,
+  shard       SMALLINT NOT NULL,
+  user_id     BIGINT,
+  payload     JSONB NOT NULL,
+  created_at  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_update_queue_shard_id ON update_queue (shard, id);
+
+-- Аренда шардов воркерами (worker_id NULL — шард свободен)
+CREATE TABLE IF NOT EXISTS update_shards (
+  shard        SMALLINT PRIMARY KEY,
+  worker_id    TEXT,
+  lease_until  TIMESTAMP
+);
+
+-- Живые воркеры: по их числу каждый воркер вычисляет свою долю шардов
+CREATE TABLE IF NOT EXISTS update_workers (
+  worker_id     TEXT PRIMARY KEY,
+  heartbeat_at  TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Рассылки администраторов (utils/broadcast.py)
+-- status: draft -> running -> completed | cancelled; owner/lease_until — процесс, выполняющий рассылку
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+  id                   SERIAL PRIMARY KEY,
+  created_by           BIGINT NOT NULL,
+  text                 TEXT NOT NULL,
+  status               TEXT NOT NULL DEFAULT 'draft',
+  total                INTEGER,
+  sent                 INTEGER NOT NULL DEFAULT 0,
+  failed               INTEGER NOT NULL DEFAULT 0,
+  blocked              INTEGER NOT NULL DEFAULT 0,
+  cursor_user_id       BIGINT NOT NULL DEFAULT 0,  -- последний обработанный получатель (keyset)
+  progress_chat_id     BIGINT,
+  progress_message_id  BIGINT,
+  owner                TEXT,
+  lease_until          TIMESTAMP,
+  created_at           TIMESTAMP NOT NULL DEFAULT NOW(),
+  started_at           TIMESTAMP,
+  finished_at          TIMESTAMP
+);
+
+-- Результат по каждому получателю: sent, failed или blocked (бот заблокирован пользователем)
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+  job_id   INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+  user_id  BIGINT NOT NULL,
+  status   TEXT NOT NULL,
+  error    TEXT,
+  sent_at  TIMESTAMP NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (job_id, user_id)
+);
+
+-- Вопросы, ответ на которые не пришёл до остановки бота; ответ доставляется после запуска (utils/shutdown.py)
+CREATE TABLE IF NOT EXISTS rag_resume (
+  request_id         TEXT PRIMARY KEY,
+  user_id            BIGINT NOT NULL,
+  chat_id            BIGINT NOT NULL,
+  message_id         BIGINT NOT NULL,   -- вопрос пользователя (ответ приходит реплаем)
+  status_message_id  BIGINT,            -- сообщение «Обрабатываю...»
+  saved_at           TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Ответы RAG с полным вопросом и машиной (database/answers.py); ответ сжат zlib, если compressed
+CREATE TABLE IF NOT EXISTS rag_answers (
+  request_id     TEXT PRIMARY KEY,
+  user_id        BIGINT NOT NULL,
+  lookup_key     BYTEA NOT NULL,      -- хеш нормализованного вопроса и машины
+  question       TEXT NOT NULL,
+  car            TEXT,
+  answer         BYTEA NOT NULL,
+  compressed     BOOLEAN NOT NULL DEFAULT FALSE,
+  answer_length  INTEGER NOT NULL,    -- символов в ответе
+  created_at     TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_rag_answers_lookup ON rag_answers (lookup_key, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_rag_answers_created_at ON rag_answers (created_at);
+-- Контекст диалога: последние ответы пользователя (utils/conversation.py)
+CREATE INDEX IF NOT EXISTS idx_rag_answers_user ON rag_answers (user_id, created_at DESC);
+
+-- Служебные значения (отпечаток схемы, см. database/schema.py)
+CREATE TABLE IF NOT EXISTS schema_meta (
+  key         TEXT PRIMARY KEY,
+  value       TEXT NOT NULL,
+  updated_at  TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,117 @@
+"""
+Отпечаток схемы базы данных
+
+Отпечаток — хеш models.sql и файлов миграций Alembic. Он сохраняется в таблице schema_meta
+после успешного применения схемы; если при следующем запуске отпечаток совпадает,
+миграции и models.sql не выполняются.
+
+Использование из entrypoint.sh:
+    python -m database.schema check --wait 60
+
+Коды выхода: 0 — схема актуальна, 1 — нужно применить миграции, 2 — база недоступна.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+MODELS_SQL = ROOT_DIR / "database" / "models.sql"
+MIGRATIONS_DIR = ROOT_DIR / "alembic" / "versions"
+
+FINGERPRINT_KEY = "schema_fingerprint"
+
+
+def schema_fingerprint() -> str:
+    """Хеш models.sql и всех файлов миграций"""
+    digest = hashlib.sha256()
+    files = [MODELS_SQL] + sorted(MIGRATIONS_DIR.glob("*.py"))
+    for path in files:
+        digest.update(path.name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(path.read_bytes())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+async def stored_fingerprint(conn: asyncpg.Connection) -> Optional[str]:
+    """Сохранённый отпечаток (None, если схема ещё ни разу не применялась)"""
+    exists = await conn.fetchval("SELECT to_regclass('schema_meta') IS NOT NULL")
+    if not exists:
+        return None
+    return await conn.fetchval("SELECT value FROM schema_meta WHERE key = $1", FINGERPRINT_KEY)
+
+
+async def ensure_schema(pool: asyncpg.Pool) -> bool:
+    """
+    Применение models.sql, если отпечаток схемы изменился
+
+    Returns:
+        True, если схема применялась, False, если была актуальна
+    """
+    fingerprint = schema_fingerprint()
+    async with pool.acquire() as conn:
+        if await stored_fingerprint(conn) == fingerprint:
+            logger.info("Database schema is up to date, skipping models.sql")
+            return False
+
+        async with conn.transaction():
+            # models.sql создаёт и таблицу schema_meta
+            await conn.execute(MODELS_SQL.read_text(encoding='utf-8'))
+            await conn.execute("""
+                INSERT INTO schema_meta (key, value) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+            """, FINGERPRINT_KEY, fingerprint)
+    logger.info(f"Database schema applied, fingerprint {fingerprint[:12]}")
+    return True
+
+
+async def _check(wait: float) -> int:
+    database_url = os.getenv('DATABASE_URL')
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            conn = await asyncpg.connect(database_url)
+            break
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            if time.monotonic() >= deadline:
+                print(f"❌ PostgreSQL is not ready: {e}")
+                return 2
+            await asyncio.sleep(0.5)
+
+    try:
+        if await stored_fingerprint(conn) == schema_fingerprint():
+            return 0
+        return 1
+    finally:
+        await conn.close()
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Database schema fingerprint")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    check = subparsers.add_parser('check', help="compare stored fingerprint with the code")
+    check.add_argument('--wait', type=float, default=0, help="wait for PostgreSQL up to N seconds")
+    subparsers.add_parser('show', help="print fingerprint of the code")
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        print(schema_fingerprint())
+        return
+    sys.exit(asyncio.run(_check(args.wait)))
+
+
+if __name__ == "__main__":
+    main()
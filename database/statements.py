@@ -0,0 +1,790 @@
+"""
+Реестр именованных SQL-запросов
+
+Все запросы Database описаны здесь и подготавливаются один раз на каждое соединение
+пула (хук init), поэтому в горячем пути нет разбора и планирования запроса заново.
+Запрос привязан к пулу, в котором он выполняется.
+"""
+import os
+from typing import Dict, List, NamedTuple, Set
+
+import asyncpg
+
+from utils.logger import get_logger
+from utils.metrics import DB_QUERY_SECONDS, HistogramValue
+from utils.tracing import SPAN_DB, add_span
+
+logger = get_logger(__name__)
+
+# Именованные пулы соединений
+POOL_DEFAULT = "default"      # пользовательский трафик и короткие админские запросы
+POOL_ANALYTICS = "analytics"  # статистика и выгрузки (может смотреть на реплику)
+
+# Запросы дольше порога пишутся в лог с уровнем WARNING
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 500))
+
+
+class Statement(NamedTuple):
+    name: str
+    pool: str
+    sql: str
+
+
+STATEMENTS: Dict[str, Statement] = {}
+
+
+def register(name: str, sql: str, pool: str = POOL_DEFAULT) -> Statement:
+    """Регистрация запроса в реестре"""
+    if name in STATEMENTS:
+        raise ValueError(f"Statement {name} is already registered")
+    statement = Statement(name, pool, sql)
+    STATEMENTS[name] = statement
+    return statement
+
+
+def statements_for_pool(pool: str) -> List[Statement]:
+    """Запросы, которые выполняются в указанном пуле"""
+    return [statement for statement in STATEMENTS.values() if statement.pool == pool]
+
+
+class RegistryConnection(asyncpg.Connection):
+    """
+    Соединение, которое заранее подготавливает запросы из реестра
+
+    Подготовленные запросы хранятся в штатном кэше asyncpg (по тексту запроса),
+    поэтому conn.fetch(sql, ...) использует уже подготовленный запрос, а при смене
+    схемы asyncpg сам переподготавливает его (InvalidCachedStatementError).
+    """
+    __slots__ = ('prepared',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Set[str] = set()
+
+    async def prepare_registry(self, pool: str) -> None:
+        """Подготовка всех запросов пула (вызывается из хука init)"""
+        for statement in statements_for_pool(pool):
+            try:
+                await self._get_statement(statement.sql, None)
+                self.prepared.add(statement.name)
+            except asyncpg.PostgresError as e:
+                # Например, таблицы ещё не созданы: запрос подготовится при первом вызове
+                logger.debug(f"Statement {statement.name} not prepared: {e}")
+
+
+class StatementStats:
+    """Время выполнения запросов реестра (включая сетевой обмен): гистограммы /metrics, трасса, медленные запросы"""
+
+    def __init__(self):
+        # Гистограммы для /metrics (utils/metrics.py): число вызовов и суммарное время — в _count и _sum
+        self.histograms: Dict[str, HistogramValue] = {}
+
+    def observe(self, name: str, elapsed: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = DB_QUERY_SECONDS.labels(name)
+        histogram.observe(elapsed)
+        add_span(SPAN_DB, name, elapsed)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning(f"Slow query {name}: {elapsed * 1000:.1f}ms")
+
+
+# --- Пользователи ---
+
+register('bootstrap_admin', """
+    INSERT INTO users (user_id, username, role, allowed)
+    VALUES ($1, $2, 'admin', TRUE)
+    ON CONFLICT (user_id) DO UPDATE SET
+        role = 'admin',
+        allowed = TRUE,
+        username = EXCLUDED.username
+""")
+
+register('add_user', """
+    INSERT INTO users (user_id, username, role, allowed)
+    VALUES ($1, $2, 'user', TRUE)
+    ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+""")
+
+register('add_pending_user', """
+    INSERT INTO users (user_id, username, role, allowed)
+    VALUES ($1, $2, $3, TRUE)
+    ON CONFLICT (user_id) DO NOTHING
+""")
+
+register('pending_usernames', """
+    SELECT DISTINCT lower(username) FROM users WHERE user_id < 0 AND username IS NOT NULL
+""")
+
+# Активация пользователя, добавленного по @username: одним запросом переносит строку users
+# с временного (отрицательного) ID на реальный вместе с лимитами, источником привлечения,
+# запросами к RAG и событиями. Внешние ключи проверяются в конце запроса, поэтому порядок
+# подзапросов не важен. Если у реального пользователя уже есть лимиты или источник
+# привлечения, остаются они, а записи временного ID удаляются.
+register('activate_pending_user', """
+    WITH temp AS (
+        DELETE FROM users
+        WHERE user_id = (
+            SELECT user_id FROM users
+            WHERE lower(username) = lower($2) AND user_id < 0
+            ORDER BY created_at
+            LIMIT 1
+        )
+        RETURNING user_id, role, allowed, car, question_count
+    ),
+    activated AS (
+        INSERT INTO users (user_id, username, role, allowed, car, question_count)
+        SELECT $1, $2, role, allowed, car, question_count FROM temp
+        ON CONFLICT (user_id) DO UPDATE
+        SET username = EXCLUDED.username,
+            role = EXCLUDED.role,
+            allowed = EXCLUDED.allowed,
+            car = COALESCE(users.car, EXCLUDED.car),
+            question_count = users.question_count + EXCLUDED.question_count
+        RETURNING user_id, username, role, allowed, car, created_at, question_count, last_seen_at
+    ),
+    moved_limits AS (
+        UPDATE user_limits SET user_id = $1
+        WHERE user_id IN (SELECT user_id FROM temp)
+          AND NOT EXISTS (SELECT 1 FROM user_limits WHERE user_id = $1)
+    ),
+    dropped_limits AS (
+        DELETE FROM user_limits
+        WHERE user_id IN (SELECT user_id FROM temp)
+          AND EXISTS (SELECT 1 FROM user_limits WHERE user_id = $1)
+    ),
+    moved_acquisition AS (
+        UPDATE user_acquisition SET user_id = $1
+        WHERE user_id IN (SELECT user_id FROM temp)
+          AND NOT EXISTS (SELECT 1 FROM user_acquisition WHERE user_id = $1)
+    ),
+    dropped_acquisition AS (
+        DELETE FROM user_acquisition
+        WHERE user_id IN (SELECT user_id FROM temp)
+          AND EXISTS (SELECT 1 FROM user_acquisition WHERE user_id = $1)
+    ),
+    moved_rag_requests AS (
+        UPDATE rag_requests SET user_id = $1 WHERE user_id IN (SELECT user_id FROM temp)
+    ),
+    moved_events AS (
+        UPDATE events SET user_id = $1 WHERE user_id IN (SELECT user_id FROM temp)
+    )
+    SELECT a.*, (SELECT user_id FROM temp) AS temp_user_id,
+           EXISTS (SELECT 1 FROM users WHERE lower(username) = lower($2) AND user_id < 0
+                   AND user_id <> (SELECT user_id FROM temp)) AS more_pending
+    FROM activated a
+""")
+
+register('get_user', """
+    SELECT user_id, username, role, allowed, car, created_at, question_count, last_seen_at
+    FROM users WHERE user_id = $1
+""")
+
+register('get_user_by_username', """
+    SELECT user_id, role, allowed FROM users WHERE username = $1
+""")
+
+register('set_user_role', """
+    UPDATE users SET role = $2, allowed = allowed OR $3::boolean WHERE user_id = $1
+""")
+
+register('set_user_allowed', """
+    UPDATE users SET allowed = $2 WHERE user_id = $1
+""")
+
+register('delete_user', """
+    DELETE FROM users WHERE user_id = $1 RETURNING username
+""")
+
+register('set_car', """
+    UPDATE users SET car = $1 WHERE user_id = $2
+""")
+
+register('list_users_top', """
+    SELECT user_id, username, role, allowed, car, created_at, question_count
+    FROM users
+    ORDER BY question_count DESC
+    LIMIT $1
+""")
+
+# Keyset-страницы /list_users и /pending_users: отдельный запрос на каждое сочетание
+# выборки, направления обхода индекса и наличия курсора
+USERS_PAGE_CONDITIONS = {
+    'all': "TRUE",
+    'pending': "user_id < 0",
+}
+
+for _kind, _condition in USERS_PAGE_CONDITIONS.items():
+    for _order, _operator in (('asc', '>'), ('desc', '<')):
+        register(f'users_page_{_kind}_{_order}', f"""
+            SELECT user_id, username, role, allowed, car, created_at
+            FROM users
+            WHERE {_condition}
+            ORDER BY created_at {_order.upper()}, user_id {_order.upper()}
+            LIMIT $1
+        """)
+        register(f'users_page_{_kind}_{_order}_after', f"""
+            SELECT user_id, username, role, allowed, car, created_at
+            FROM users
+            WHERE {_condition} AND (created_at, user_id) {_operator} ($2, $3)
+            ORDER BY created_at {_order.upper()}, user_id {_order.upper()}
+            LIMIT $1
+        """)
+
+# --- RAG-запросы ---
+
+register('log_rag_request', """
+    INSERT INTO rag_requests (user_id, request_id, text, status, created_at, accepted_at)
+    VALUES ($1, $2, $3, $4, COALESCE($5, NOW()), $6)
+""")
+
+# Завершение запросов пакетом (Database.rag_completions): статус, время, опросы, длина ответа
+register('complete_rag_requests', """
+    UPDATE rag_requests r
+    SET status = c.status, completed_at = c.completed_at,
+        poll_count = c.poll_count, answer_length = c.answer_length
+    FROM unnest($1::text[], $2::text[], $3::timestamp[], $4::int[], $5::int[])
+         AS c(request_id, status, completed_at, poll_count, answer_length)
+    WHERE r.request_id = c.request_id
+""")
+
+# Ожидания ответа RAG, прерванные остановкой бота (utils/shutdown.py)
+register('rag_resume_save', """
+    INSERT INTO rag_resume (request_id, user_id, chat_id, message_id, status_message_id)
+    SELECT * FROM unnest($1::text[], $2::bigint[], $3::bigint[], $4::bigint[], $5::bigint[])
+    ON CONFLICT (request_id) DO NOTHING
+""")
+
+# Забираются все строки (другие реплики их уже не увидят), возвращаются только свежие
+register('rag_resume_claim', """
+    WITH claimed AS (
+        DELETE FROM rag_resume RETURNING *
+    )
+    SELECT * FROM claimed
+    WHERE saved_at > NOW() - $1::integer * INTERVAL '1 second'
+    ORDER BY saved_at
+""")
+
+# --- Шаблоны ---
+
+register('get_template', """
+    SELECT value FROM text_templates WHERE key = $1
+""")
+
+register('set_template', """
+    INSERT INTO text_templates (key, value, description)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+""")
+
+# --- Начальные данные (одним запросом на таблицу) ---
+
+# Значение шаблона обновляется только если оно изменилось в коде, чтобы не плодить версии строк
+register('seed_templates', """
+    INSERT INTO text_templates (key, value, description)
+    SELECT * FROM unnest($1::text[], $2::text[], $3::text[])
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+    WHERE text_templates.value IS DISTINCT FROM EXCLUDED.value
+""")
+
+register('seed_admins', """
+    INSERT INTO users (user_id, username, role, allowed)
+    SELECT user_id, username, 'admin', TRUE
+    FROM unnest($1::bigint[], $2::text[]) AS a(user_id, username)
+    ON CONFLICT (user_id) DO UPDATE SET
+        role = 'admin',
+        allowed = TRUE,
+        username = EXCLUDED.username
+    WHERE users.role IS DISTINCT FROM 'admin'
+       OR users.allowed IS NOT TRUE
+       OR users.username IS DISTINCT FROM EXCLUDED.username
+""")
+
+# --- Состояния FSM (database/fsm_storage.py) ---
+# Каждая запись уведомляет остальные процессы через NOTIFY, чтобы они сбросили свой кэш
+
+FSM_CHANNEL = "fsm_states"
+
+register('fsm_get', """
+    SELECT state, data FROM fsm_states WHERE key = $1 AND expires_at > NOW()
+""")
+
+register('fsm_set_state', f"""
+    WITH written AS (
+        INSERT INTO fsm_states (key, state, expires_at)
+        VALUES ($1, $2, NOW() + $3::integer * INTERVAL '1 second')
+        ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at
+        RETURNING key
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $4::text || ' ' || $1) FROM written
+""")
+
+# Запись без состояния и без данных удаляется, иначе обнуляется только состояние
+register('fsm_clear_state', f"""
+    WITH deleted AS (
+        DELETE FROM fsm_states WHERE key = $1 AND data IS NULL
+        RETURNING key
+    ),
+    updated AS (
+        UPDATE fsm_states SET state = NULL WHERE key = $1 AND data IS NOT NULL
+        RETURNING key
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $2::text || ' ' || $1)
+    WHERE EXISTS (SELECT 1 FROM deleted) OR EXISTS (SELECT 1 FROM updated)
+""")
+
+register('fsm_set_data', f"""
+    WITH written AS (
+        INSERT INTO fsm_states (key, data, expires_at)
+        VALUES ($1, $2::jsonb, NOW() + $3::integer * INTERVAL '1 second')
+        ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        RETURNING key
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $4::text || ' ' || $1) FROM written
+""")
+
+register('fsm_clear_data', f"""
+    WITH deleted AS (
+        DELETE FROM fsm_states WHERE key = $1 AND state IS NULL
+        RETURNING key
+    ),
+    updated AS (
+        UPDATE fsm_states SET data = NULL WHERE key = $1 AND state IS NOT NULL
+        RETURNING key
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $2::text || ' ' || $1)
+    WHERE EXISTS (SELECT 1 FROM deleted) OR EXISTS (SELECT 1 FROM updated)
+""")
+
+register('fsm_purge', """
+    DELETE FROM fsm_states WHERE expires_at <= NOW()
+""")
+
+# --- Очередь обновлений (utils/update_queue.py) ---
+# Ingress добавляет обновления и будит воркеров через NOTIFY (payload — номера шардов через запятую).
+# Шард обрабатывает один воркер, пока держит аренду; строка удаляется после обработки.
+
+UPDATE_QUEUE_CHANNEL = "update_queue"
+
+# Повторно полученное обновление (ingress упал до подтверждения offset) пропускается по update_id
+register('enqueue_updates', f"""
+    WITH inserted AS (
+        INSERT INTO update_queue (update_id, shard, user_id, payload)
+        SELECT update_id, shard, user_id, payload::jsonb
+        FROM unnest($1::bigint[], $2::smallint[], $3::bigint[], $4::text[]) WITH ORDINALITY
+             AS u(update_id, shard, user_id, payload, ord)
+        ORDER BY ord
+        ON CONFLICT (update_id) DO NOTHING
+        RETURNING shard
+    )
+    SELECT pg_notify('{UPDATE_QUEUE_CHANNEL}', string_agg(DISTINCT shard::text, ','))
+    FROM inserted
+    HAVING COUNT(*) > 0
+""")
+
+# Следующие обновления каждого шарда после последнего взятого в работу id
+register('fetch_queued_updates', """
+    SELECT q.id, q.shard, q.user_id, q.payload
+    FROM unnest($1::smallint[], $2::bigint[]) AS c(shard, after_id)
+    CROSS JOIN LATERAL (
+        SELECT id, shard, user_id, payload
+        FROM update_queue
+        WHERE shard = c.shard AND id > c.after_id
+        ORDER BY id
+        LIMIT $3
+    ) q
+    ORDER BY q.id
+""")
+
+register('ack_updates', """
+    DELETE FROM update_queue WHERE id = ANY($1::bigint[])
+""")
+
+register('seed_update_shards', """
+    INSERT INTO update_shards (shard)
+    SELECT generate_series(0, $1 - 1)
+    ON CONFLICT (shard) DO NOTHING
+""")
+
+# Число живых воркеров, включая текущий (его строка из CTE в подзапросе ещё не видна)
+register('worker_heartbeat', """
+    WITH beat AS (
+        INSERT INTO update_workers (worker_id, heartbeat_at) VALUES ($1, NOW())
+        ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = NOW()
+    )
+    SELECT COUNT(*) + 1 FROM update_workers
+    WHERE worker_id <> $1 AND heartbeat_at > NOW() - $2::integer * INTERVAL '1 second'
+""")
+
+register('remove_worker', """
+    DELETE FROM update_workers WHERE worker_id = $1 OR heartbeat_at < NOW() - INTERVAL '1 day'
+""")
+
+# Свободные шарды и шарды с истёкшей арендой (упавший воркер); занятые другими строки пропускаются
+register('claim_update_shards', """
+    UPDATE update_shards s
+    SET worker_id = $1, lease_until = NOW() + $2::integer * INTERVAL '1 second'
+    FROM (
+        SELECT shard FROM update_shards
+        WHERE shard < $4 AND (worker_id IS NULL OR lease_until < NOW())
+        ORDER BY shard
+        LIMIT $3
+        FOR UPDATE SKIP LOCKED
+    ) free
+    WHERE s.shard = free.shard
+    RETURNING s.shard
+""")
+
+# Возвращает шарды, которые всё ещё принадлежат воркеру
+register('renew_update_shards', """
+    UPDATE update_shards
+    SET lease_until = NOW() + $2::integer * INTERVAL '1 second'
+    WHERE worker_id = $1 AND shard = ANY($3::smallint[])
+    RETURNING shard
+""")
+
+register('release_update_shards', """
+    UPDATE update_shards SET worker_id = NULL, lease_until = NULL
+    WHERE worker_id = $1 AND shard = ANY($2::smallint[])
+""")
+
+# --- Рассылки (utils/broadcast.py) ---
+# Получатели — активные пользователи с постоянным ID; задачу выполняет процесс, держащий аренду
+
+register('broadcast_create', """
+    INSERT INTO broadcast_jobs (created_by, text, progress_chat_id)
+    VALUES ($1, $2, $3)
+    RETURNING id
+""")
+
+register('broadcast_set_progress_message', """
+    UPDATE broadcast_jobs SET progress_message_id = $2 WHERE id = $1
+""")
+
+register('broadcast_start', """
+    UPDATE broadcast_jobs
+    SET status = 'running', started_at = NOW(),
+        total = (SELECT COUNT(*) FROM users WHERE allowed = TRUE AND user_id > 0)
+    WHERE id = $1 AND status = 'draft'
+    RETURNING total
+""")
+
+register('broadcast_cancel', """
+    UPDATE broadcast_jobs
+    SET status = 'cancelled', finished_at = NOW(), owner = NULL, lease_until = NULL
+    WHERE id = $1 AND status IN ('draft', 'running')
+    RETURNING id
+""")
+
+register('broadcast_get', """
+    SELECT * FROM broadcast_jobs WHERE id = $1
+""")
+
+register('broadcast_recent', """
+    SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT $1
+""")
+
+# Запущенные задачи без владельца или с истёкшей арендой (процесс перезапущен или упал)
+register('broadcast_claim', """
+    UPDATE broadcast_jobs j
+    SET owner = $1, lease_until = NOW() + $2::integer * INTERVAL '1 second'
+    FROM (
+        SELECT id FROM broadcast_jobs
+        WHERE status = 'running' AND (owner IS NULL OR lease_until < NOW())
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+    ) free
+    WHERE j.id = free.id
+    RETURNING j.*
+""")
+
+# Продление аренды и сохранение позиции; возвращает статус (NULL — аренду забрал другой процесс)
+register('broadcast_renew', """
+    UPDATE broadcast_jobs
+    SET lease_until = NOW() + $3::integer * INTERVAL '1 second', cursor_user_id = $4
+    WHERE id = $1 AND owner = $2
+    RETURNING status
+""")
+
+register('broadcast_release', """
+    UPDATE broadcast_jobs SET owner = NULL, lease_until = NULL WHERE owner = $1
+""")
+
+register('broadcast_finish', """
+    UPDATE broadcast_jobs
+    SET status = 'completed', finished_at = NOW(), owner = NULL, lease_until = NULL
+    WHERE id = $1 AND owner = $2 AND status = 'running'
+""")
+
+# Следующие получатели после cursor; уже записанные (до перезапуска) пропускаются
+register('broadcast_recipients_page', """
+    SELECT u.user_id
+    FROM users u
+    WHERE u.user_id > $2 AND u.allowed = TRUE
+      AND NOT EXISTS (
+          SELECT 1 FROM broadcast_recipients r WHERE r.job_id = $1 AND r.user_id = u.user_id
+      )
+    ORDER BY u.user_id
+    LIMIT $3
+""")
+
+# Пакет статусов получателей и счётчики задач одним запросом
+register('broadcast_record', """
+    WITH inserted AS (
+        INSERT INTO broadcast_recipients (job_id, user_id, status, error)
+        SELECT * FROM unnest($1::integer[], $2::bigint[], $3::text[], $4::text[])
+        ON CONFLICT (job_id, user_id) DO NOTHING
+        RETURNING job_id, status
+    ),
+    counts AS (
+        SELECT job_id,
+               COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+               COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+               COUNT(*) FILTER (WHERE status = 'blocked') AS blocked
+        FROM inserted
+        GROUP BY job_id
+    )
+    UPDATE broadcast_jobs j
+    SET sent = j.sent + c.sent, failed = j.failed + c.failed, blocked = j.blocked + c.blocked
+    FROM counts c
+    WHERE j.id = c.job_id
+""")
+
+# --- События ---
+
+register('update_last_seen', """
+    UPDATE users u
+    SET last_seen_at = v.seen_at
+    FROM unnest($1::bigint[], $2::timestamp[]) AS v(user_id, seen_at)
+    WHERE u.user_id = v.user_id
+      AND (u.last_seen_at IS NULL OR u.last_seen_at < v.seen_at)
+""")
+
+# --- Привлечение пользователей ---
+
+register('save_user_acquisition', """
+    INSERT INTO user_acquisition (user_id, payload_raw, payload_decoded, src, campaign, ad, language_code)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (user_id) DO NOTHING
+""")
+
+register('get_user_acquisition', """
+    SELECT user_id, payload_raw, payload_decoded, src, campaign, ad, language_code
+    FROM user_acquisition WHERE user_id = $1
+""")
+
+# --- Лимиты ---
+
+register('get_user_limits', """
+    SELECT absolute_limit, absolute_used, weekly_limit, weekly_used, week_start
+    FROM user_limits WHERE user_id = $1
+""")
+
+register('create_user_limits', """
+    INSERT INTO user_limits (user_id)
+    VALUES ($1)
+""")
+
+register('reset_weekly_limit', """
+    UPDATE user_limits
+    SET weekly_used = 0, week_start = NOW()
+    WHERE user_id = $1
+""")
+
+register('increment_limits', """
+    UPDATE user_limits
+    SET absolute_used = absolute_used + 1,
+        weekly_used = weekly_used + 1,
+        week_start = COALESCE(week_start, NOW())
+    WHERE user_id = $1
+""")
+
+register('update_user_limits', """
+    UPDATE user_limits
+    SET absolute_limit = $1, weekly_limit = $2
+    WHERE user_id = $3
+""")
+
+register('update_all_users_limits', """
+    UPDATE user_limits
+    SET absolute_limit = $1, weekly_limit = $2
+""")
+
+# --- Статистика (пул аналитики) ---
+# Период передаётся параметром-строкой ('1 day', '1 month', ...) и приводится к interval
+
+register('stat_users', """
+    SELECT COUNT(*) AS total_users,
+           COUNT(*) FILTER (WHERE created_at >= NOW() - $1::text::interval) AS new_users
+    FROM users
+""", POOL_ANALYTICS)
+
+register('stat_events', """
+    SELECT COUNT(DISTINCT user_id) FILTER (WHERE event_type = ANY($2::smallint[])) AS active_users,
+           COUNT(*) FILTER (WHERE event_type = ANY($2::smallint[])) AS total_messages,
+           COUNT(*) FILTER (WHERE event_type = $3) AS commands,
+           COUNT(*) FILTER (WHERE event_type = $4) AS text_messages,
+           COUNT(*) FILTER (WHERE event_type = $5) AS limits_exhausted
+    FROM events
+    WHERE created_at >= NOW() - $1::text::interval
+""", POOL_ANALYTICS)
+
+register('stat_rag', """
+    SELECT COUNT(*) AS rag_requests,
+           COUNT(*) FILTER (WHERE status = 'failed') AS rag_failed
+    FROM rag_requests
+    WHERE created_at >= NOW() - $1::text::interval
+""", POOL_ANALYTICS)
+
+# Ответы RAG (database/answers.py); записываются в одной транзакции с complete_rag_requests
+register('save_rag_answers', """
+    INSERT INTO rag_answers (request_id, user_id, lookup_key, question, car, answer, compressed, answer_length)
+    SELECT * FROM unnest($1::text[], $2::bigint[], $3::bytea[], $4::text[], $5::text[],
+                         $6::bytea[], $7::boolean[], $8::int[])
+    ON CONFLICT (request_id) DO NOTHING
+""")
+
+register('rag_answer_by_request', """
+    SELECT request_id, user_id, question, car, answer AS answer_data, compressed, answer_length, created_at
+    FROM rag_answers
+    WHERE request_id = $1
+""")
+
+# Последний ответ по ключу вопроса; $2 — наибольший возраст в секундах (NULL — любой)
+register('rag_answer_latest', """
+    SELECT request_id, user_id, question, car, answer AS answer_data, compressed, answer_length, created_at,
+           EXTRACT(EPOCH FROM NOW() - created_at)::float8 AS age_sec
+    FROM rag_answers
+    WHERE lookup_key = $1
+      AND ($2::float8 IS NULL OR created_at >= NOW() - make_interval(secs => $2::float8))
+    ORDER BY created_at DESC
+    LIMIT 1
+""")
+
+# Последние ответы пользователя для контекста диалога (utils/conversation.py); возраст — в секундах
+register('rag_answers_recent', """
+    SELECT question, car, answer AS answer_data, compressed,
+           EXTRACT(EPOCH FROM NOW() - created_at)::float8 AS age_sec
+    FROM rag_answers
+    WHERE user_id = $1
+      AND created_at >= NOW() - make_interval(secs => $3::float8)
+    ORDER BY created_at DESC
+    LIMIT $2
+""")
+
+register('rag_answers_purge', """
+    DELETE FROM rag_answers
+    WHERE request_id IN (
+        SELECT request_id FROM rag_answers
+        WHERE created_at < NOW() - make_interval(days => $1)
+        LIMIT $2
+    )
+""")
+
+# Время ответа RAG API (от принятия запроса до завершения) за последние 14 дней периода; $2 — SLO в секундах,
+# нарушением считается и ответ дольше SLO, и неудачный запрос
+register('stat_rag_latency', """
+    SELECT created_at::date AS day,
+           COUNT(*) AS completed,
+           COUNT(*) FILTER (WHERE status <> 'success') AS failed,
+           percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (
+               ORDER BY EXTRACT(EPOCH FROM completed_at - COALESCE(accepted_at, created_at))::float8
+           ) AS latency,
+           COUNT(*) FILTER (
+               WHERE status <> 'success'
+                  OR completed_at - COALESCE(accepted_at, created_at) > make_interval(secs => $2)
+           ) AS slo_breaches,
+           AVG(poll_count)::float8 AS avg_polls
+    FROM rag_requests
+    WHERE created_at >= NOW() - $1::text::interval AND completed_at IS NOT NULL
+    GROUP BY day
+    ORDER BY day DESC
+    LIMIT 14
+""", POOL_ANALYTICS)
+
+register('stat_top_users', """
+    SELECT u.username, u.user_id, e.message_count
+    FROM (
+        SELECT user_id, COUNT(*) AS message_count
+        FROM events
+        WHERE event_type = ANY($2::smallint[]) AND created_at >= NOW() - $1::text::interval
+        GROUP BY user_id
+        ORDER BY message_count DESC
+        LIMIT 5
+    ) e
+    JOIN users u ON u.user_id = e.user_id
+    ORDER BY e.message_count DESC
+""", POOL_ANALYTICS)
+
+register('stat_roles', """
+    SELECT role, COUNT(*) as count
+    FROM users
+    WHERE created_at >= NOW() - $1::text::interval
+    GROUP BY role
+""", POOL_ANALYTICS)
+
+register('user_stat_events', """
+    SELECT COUNT(*) FILTER (WHERE event_type = ANY($3::smallint[])) AS total_messages,
+           COUNT(*) FILTER (WHERE event_type = $4) AS commands,
+           COUNT(*) FILTER (WHERE event_type = $5) AS text_messages,
+           COUNT(*) FILTER (WHERE event_type = $6) AS limits_exhausted
+    FROM events
+    WHERE user_id = $1 AND created_at >= NOW() - $2::text::interval
+""", POOL_ANALYTICS)
+
+register('user_stat_rag', """
+    SELECT COUNT(*) AS rag_requests,
+           COUNT(*) FILTER (WHERE status = 'failed') AS rag_failed
+    FROM rag_requests
+    WHERE user_id = $1 AND created_at >= NOW() - $2::text::interval
+""", POOL_ANALYTICS)
+
+# --- Выгрузки (пул аналитики, читаются курсором) ---
+
+register('export_users', """
+    SELECT u.user_id, u.username, u.role, u.allowed, u.car, u.created_at,
+           u.question_count,
+           ua.src, ua.campaign, ua.ad
+    FROM users u
+    LEFT JOIN user_acquisition ua ON u.user_id = ua.user_id
+    ORDER BY u.created_at DESC
+""", POOL_ANALYTICS)
+
+register('export_user_analytics', """
+    SELECT u.user_id, u.username, u.created_at AS first_seen_at, u.last_seen_at,
+           COALESCE(e.total_messages, 0) AS total_messages,
+           COALESCE(e.commands, 0) AS command_messages,
+           COALESCE(e.text_messages, 0) AS text_messages,
+           COALESCE(r.rag_requests, 0) AS rag_requests,
+           COALESCE(r.rag_failed, 0) AS rag_failed,
+           NOT COALESCE(u.allowed, FALSE) AS is_blocked,
+           COALESCE(u.role = 'admin', FALSE) AS is_admin,
+           u.car,
+           COALESCE((l.absolute_limit IS NOT NULL AND l.absolute_used >= l.absolute_limit)
+                    OR (l.weekly_limit IS NOT NULL AND l.weekly_used >= l.weekly_limit), FALSE) AS limits_reached,
+           ua.src, ua.campaign, ua.ad,
+           COALESCE(e.commands, 0) AS car_setted,
+           COALESCE(e.limits_exhausted, 0) AS limits_exhausted
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id,
+               COUNT(*) FILTER (WHERE event_type = ANY($2::smallint[])) AS total_messages,
+               COUNT(*) FILTER (WHERE event_type = $3) AS commands,
+               COUNT(*) FILTER (WHERE event_type = $4) AS text_messages,
+               COUNT(*) FILTER (WHERE event_type = $5) AS limits_exhausted
+        FROM events
+        WHERE created_at >= NOW() - $1::text::interval
+        GROUP BY user_id
+    ) e ON e.user_id = u.user_id
+    LEFT JOIN (
+        SELECT user_id,
+               COUNT(*) AS rag_requests,
+               COUNT(*) FILTER (WHERE status = 'failed') AS rag_failed
+        FROM rag_requests
+        WHERE created_at >= NOW() - $1::text::interval
+        GROUP BY user_id
+    ) r ON r.user_id = u.user_id
+    LEFT JOIN user_limits l ON l.user_id = u.user_id
+    LEFT JOIN user_acquisition ua ON ua.user_id = u.user_id
+    ORDER BY u.created_at DESC
+""", POOL_ANALYTICS)
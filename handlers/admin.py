@@ -1,18 +1,46 @@
 from aiogram import Router, F, Bot
-from aiogram.types import Message
+from aiogram.types import Message, FSInputFile, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
+from aiogram.exceptions import TelegramBadRequest
+import html
 import os
-import csv
-import io
 from datetime import datetime
+from typing import Optional, Tuple
 
 from database.db import db
-from utils.helpers import parse_command_args, extract_user_id, format_users_list, validate_deep_link_params, parse_deep_link_params, generate_deep_link
+from utils.broadcast import broadcaster, format_progress
+from utils.conversation import conversation_memory
+from utils.csv_export import export_csv_gz, single_chunk, remove_export
+from utils.helpers import parse_command_args, extract_user_id, format_users_list, validate_deep_link_params, parse_deep_link_params, generate_deep_link, datetime_to_cursor, cursor_to_datetime
 from utils.logger import get_logger
+from utils.loop_watchdog import loop_watchdog
+from utils.profiling import PROFILE_DEFAULT_SEC, PROFILE_MAX_SEC, ProfilerBusy, profiler, remove_report
+from utils.scheduler import scheduler
+from utils.telegram_limiter import telegram_limiter
+from utils.throttling import throttling
 
 logger = get_logger(__name__)
 router = Router()
 
+# Размер страницы /list_users и /pending_users (страница должна помещаться в одно сообщение)
+USERS_PAGE_SIZE = 20
+# Лимит сообщения Telegram — 4096 символов; с запасом на разметку
+USERS_PAGE_MAX_CHARS = 4000
+USERS_PAGE_CAR_CHARS = 200
+
+class UsersPage(CallbackData, prefix="users"):
+    """Навигация по страницам списка пользователей"""
+    kind: str        # 'all' или 'pending'
+    direction: str   # 'n' - следующая страница, 'p' - предыдущая
+    created_at: int  # created_at граничной строки в микросекундах
+    user_id: int     # user_id граничной строки
+
+class BroadcastAction(CallbackData, prefix="broadcast"):
+    """Подтверждение или отмена рассылки"""
+    action: str  # 'start' или 'cancel'
+    job_id: int
+
 def get_root_admins() -> list:
     """Получение списка корневых админов из переменной окружения"""
     admin_ids_str = os.getenv('ADMIN_USER_IDS', '')
@@ -133,7 +161,7 @@ async def cmd_delete_user(message: Message):
 async def cmd_list_users(message: Message):
     """Команда просмотра списка пользователей (только для админов)
     
-    /list_users - последние 50 пользователей
+    /list_users - последние пользователи постранично (кнопки ⬅️/➡️)
     /list_users top - топ 50 по количеству вопросов
     /list_users csv - выгрузка CSV
     """
@@ -147,47 +175,30 @@ async def cmd_list_users(message: Message):
     
     try:
         if mode == "csv":
-            # CSV выгрузка
-            users = await db.list_all_users_for_csv()
-            
-            if not users:
-                await message.reply("📋 Пользователи не найдены.")
-                return
-            
-            # Формируем CSV
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Заголовок
-            writer.writerow([
-                'user_id', 'username', 'role', 'allowed', 'car', 'created_at',
-                'question_count', 'src', 'campaign', 'ad'
-            ])
-            
-            # Данные
-            for user in users:
-                writer.writerow([
-                    user['user_id'],
-                    user['username'],
-                    user['role'],
-                    user['allowed'],
-                    user.get('car', ''),
-                    user['created_at'],
-                    user.get('question_count', 0),
-                    user.get('src', ''),
-                    user.get('campaign', ''),
-                    user.get('ad', '')
-                ])
-            
-            csv_content = output.getvalue()
-            csv_bytes = csv_content.encode('utf-8')
-            
-            from aiogram.types import BufferedInputFile
-            await message.reply_document(
-                BufferedInputFile(csv_bytes, filename="users.csv"),
-                caption="📊 Список всех пользователей"
+            # CSV выгрузка: строки читаются курсором и пишутся в gzip-файл вне event loop
+            path, rows = await export_csv_gz(
+                ['user_id', 'username', 'role', 'allowed', 'car', 'created_at',
+                 'question_count', 'src', 'campaign', 'ad'],
+                db.iter_users_for_csv(),
+                lambda user: (
+                    user['user_id'], user['username'], user['role'], user['allowed'],
+                    user['car'] or '', user['created_at'], user['question_count'],
+                    user['src'] or '', user['campaign'] or '', user['ad'] or '',
+                ),
             )
             
+            try:
+                if not rows:
+                    await message.reply("📋 Пользователи не найдены.")
+                    return
+                
+                await message.reply_document(
+                    FSInputFile(path, filename="users.csv.gz"),
+                    caption=f"📊 Список всех пользователей ({rows})"
+                )
+            finally:
+                remove_export(path)
+            
         elif mode == "top":
             # Топ 50 по количеству вопросов
             users = await db.list_users_top(50)
@@ -215,39 +226,146 @@ async def cmd_list_users(message: Message):
                 await message.reply(response, parse_mode="HTML")
                 
         else:
-            # По умолчанию - последние 50 пользователей
-            users = await db.list_users(limit=50, offset=0)
+            # По умолчанию - последние пользователи постранично
+            text, keyboard = await build_users_page("all")
             
-            if not users:
+            if not text:
                 await message.reply("📋 Пользователи не найдены.")
                 return
             
-            response = "📋 <b>Последние пользователи:</b>\n\n"
-            
-            for i, user in enumerate(users, 1):
-                username = user.get('username', 'N/A')
-                user_id = user['user_id']
-                role = user['role']
-                allowed = "✅" if user['allowed'] else "❌"
-                car = user.get('car', '')
-                
-                response += f"{i}. @{username} (ID: {user_id})\n"
-                response += f"   Роль: {role} {allowed}\n"
-                if car:
-                    response += f"   🚗 {car}\n"
-                response += "\n"
-                
-                if len(response) > 3500:
-                    await message.reply(response, parse_mode="HTML")
-                    response = ""
-            
-            if response:
-                await message.reply(response, parse_mode="HTML")
+            await message.reply(text, reply_markup=keyboard, parse_mode="HTML")
             
     except Exception as e:
         logger.error(f"Error listing users: {e}")
         await message.reply("❌ Произошла ошибка при получении списка пользователей.")
 
+def format_user_entry(kind: str, user: dict) -> str:
+    """Строка пользователя на странице списка (машина обрезается до USERS_PAGE_CAR_CHARS)"""
+    username = html.escape(str(user.get('username') or 'N/A'))
+    if kind == "pending":
+        return (f"• @{username}\n"
+                f"   Добавлен: {user.get('created_at') or 'N/A'}\n"
+                f"   Статус: Ожидает первого обращения к боту\n\n")
+    allowed = "✅" if user['allowed'] else "❌"
+    entry = f"• @{username} (ID: {user['user_id']})\n   Роль: {html.escape(str(user['role']))} {allowed}\n"
+    car = user.get('car')
+    if car:
+        if len(car) > USERS_PAGE_CAR_CHARS:
+            car = car[:USERS_PAGE_CAR_CHARS - 1] + "…"
+        entry += f"   🚗 {html.escape(car)}\n"
+    return entry + "\n"
+
+def format_users_page(kind: str, users: list, keep_last: bool = False) -> Tuple[str, list]:
+    """
+    Форматирование страницы списка пользователей в пределах USERS_PAGE_MAX_CHARS
+    
+    Args:
+        kind: 'all' или 'pending'
+        users: Строки страницы в порядке отображения
+        keep_last: Не поместившиеся строки отбрасываются с начала (листание назад)
+        
+    Returns:
+        Кортеж (текст, показанные пользователи) — по показанным строятся ключи соседних страниц
+    """
+    if kind == "pending":
+        header = "📋 <b>Пользователи в ожидании активации:</b>\n\n"
+    else:
+        header = "📋 <b>Последние пользователи:</b>\n\n"
+    
+    entries = []
+    length = len(header)
+    for user in (reversed(users) if keep_last else users):
+        entry = format_user_entry(kind, user)
+        if entries and length + len(entry) > USERS_PAGE_MAX_CHARS:
+            break
+        entries.append((user, entry))
+        length += len(entry)
+    if keep_last:
+        entries.reverse()
+    return header + "".join(entry for _, entry in entries), [user for user, _ in entries]
+
+def users_page_cursor(user: dict) -> int:
+    """Ключ строки для callback_data; created_at без значения — как у строк, заполненных миграцией 014"""
+    return datetime_to_cursor(user['created_at']) if user['created_at'] is not None else 0
+
+def users_page_keyboard(kind: str, users: list, has_prev: bool, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки перехода на соседние страницы (ключи — первая и последняя строки страницы)"""
+    buttons = []
+    if has_prev:
+        first = users[0]
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Назад",
+            callback_data=UsersPage(kind=kind, direction="p", created_at=users_page_cursor(first),
+                                    user_id=first['user_id']).pack()
+        ))
+    if has_next:
+        last = users[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Вперёд ➡️",
+            callback_data=UsersPage(kind=kind, direction="n", created_at=users_page_cursor(last),
+                                    user_id=last['user_id']).pack()
+        ))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+async def build_users_page(kind: str, after: Optional[Tuple[datetime, int]] = None,
+                           before: Optional[Tuple[datetime, int]] = None) -> Tuple[Optional[str], Optional[InlineKeyboardMarkup]]:
+    """
+    Получение страницы пользователей одним индексным запросом
+    
+    Returns:
+        Кортеж (текст, клавиатура); текст None, если страница пуста
+    """
+    if kind == "pending":
+        users, has_more = await db.get_pending_users(limit=USERS_PAGE_SIZE, after=after, before=before)
+    else:
+        users, has_more = await db.list_users(limit=USERS_PAGE_SIZE, after=after, before=before)
+    
+    if not users:
+        return None, None
+    
+    if before is None:
+        has_prev, has_next = after is not None, has_more
+    else:
+        has_prev, has_next = has_more, True
+    
+    # Длинные описания машин: страница укорачивается, соседняя начинается с первого не показанного
+    text, shown = format_users_page(kind, users, keep_last=before is not None)
+    if len(shown) < len(users):
+        if before is None:
+            has_next = True
+        else:
+            has_prev = True
+    return text, users_page_keyboard(kind, shown, has_prev, has_next)
+
+@router.callback_query(UsersPage.filter())
+async def users_page_callback(callback: CallbackQuery, callback_data: UsersPage):
+    """Переход по страницам /list_users и /pending_users (редактирует то же сообщение)"""
+    if not await db.is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав для выполнения этой команды.", show_alert=True)
+        return
+    
+    cursor = (cursor_to_datetime(callback_data.created_at), callback_data.user_id)
+    
+    try:
+        if callback_data.direction == "p":
+            text, keyboard = await build_users_page(callback_data.kind, before=cursor)
+        else:
+            text, keyboard = await build_users_page(callback_data.kind, after=cursor)
+        
+        if not text:
+            await callback.answer("📋 Больше пользователей нет.")
+            return
+        
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+        await callback.answer()
+    except TelegramBadRequest as e:
+        # Например, страница не изменилась
+        logger.debug(f"Users page was not edited: {e}")
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Error paging users: {e}")
+        await callback.answer("❌ Произошла ошибка при получении списка пользователей.", show_alert=True)
+
 @router.message(Command("generate_link"))
 async def cmd_generate_link(message: Message):
     """Команда генерации deep-link для отслеживания источников трафика"""
@@ -351,7 +469,7 @@ async def cmd_help(message: Message):
 /del_admin @username - Удалить права администратора
 /block_user tg_id/@username - Заблокировать пользователя
 /unblock_user tg_id/@username - Разблокировать пользователя
-/list_users - Последние 50 пользователей
+/list_users - Последние пользователи (постранично)
 /list_users top - Топ 50 по количеству вопросов
 /list_users csv - Выгрузка всех пользователей в CSV
 /change_user_week_limit N - Изменить недельный лимит для всех
@@ -366,6 +484,14 @@ async def cmd_help(message: Message):
 /stat [период] - Базовая статистика
 /stat users [период] csv - Суммаризация (CSV)
 /stat users_per_day [период] csv - По пользователям (CSV)
+/load - Текущая нагрузка: обработчики, отправка в Telegram, цикл событий, пулы БД
+/profile cpu|cprofile|mem [сек] - Профилирование (отчёт документом)
+/profile tasks - Задачи asyncio по корутинам
+
+<b>📣 Рассылки:</b>
+/broadcast текст - Рассылка всем активным пользователям (после подтверждения)
+/broadcast status [id] - Ход рассылки или последние рассылки
+/broadcast cancel id - Отменить рассылку
 
 <b>Примеры:</b>
 /generate_link cmp=winter_2025&src=tg&ad=banner1
@@ -436,22 +562,13 @@ async def cmd_pending_users(message: Message):
         return
     
     try:
-        pending_users = await db.get_pending_users()
+        text, keyboard = await build_users_page("pending")
         
-        if not pending_users:
+        if not text:
             await message.reply("📋 Пользователей в ожидании активации нет.")
             return
         
-        response = "📋 <b>Пользователи в ожидании активации:</b>\n\n"
-        
-        for i, user in enumerate(pending_users, 1):
-            username = user.get('username', 'N/A')
-            created_at = user.get('created_at', 'N/A')
-            response += f"{i}. @{username}\n"
-            response += f"   Добавлен: {created_at}\n"
-            response += f"   Статус: Ожидает первого обращения к боту\n\n"
-        
-        await message.reply(response, parse_mode="HTML")
+        await message.reply(text, reply_markup=keyboard, parse_mode="HTML")
 
     except Exception as e:
         logger.error(f"Error getting pending users: {e}")
@@ -479,36 +596,22 @@ async def cmd_add_admin(message: Message):
     normalized_username = f"@{username}"
     
     try:
-        async with db.pool.acquire() as conn:
-            # Проверяем, есть ли пользователь с таким username в базе
-            existing_user = await conn.fetchrow("""
-                SELECT user_id, role FROM users WHERE username = $1
-            """, normalized_username)
-            
-            if existing_user:
-                # Пользователь уже есть - обновляем роль
-                await conn.execute("""
-                    UPDATE users
-                    SET role = 'admin', allowed = TRUE
-                    WHERE user_id = $1
-                """, existing_user['user_id'])
-                
-                if existing_user['user_id'] < 0:
-                    await message.reply(f"✅ Пользователь {normalized_username} добавлен как администратор. Получит права при первом обращении к боту.")
-                else:
-                    await message.reply(f"✅ Пользователь {normalized_username} (ID: {existing_user['user_id']}) теперь администратор.")
-            else:
-                # Пользователя нет - создаем с уникальным временным ID (отрицательный хеш от username)
-                # Используем простой хеш для генерации уникального отрицательного ID
-                temp_id = -abs(hash(username)) % (10 ** 10)
-                
-                await conn.execute("""
-                    INSERT INTO users (user_id, username, role, allowed)
-                    VALUES ($1, $2, 'admin', TRUE)
-                    ON CONFLICT (user_id) DO NOTHING
-                """, temp_id, normalized_username)
-                
+        # Проверяем, есть ли пользователь с таким username в базе
+        existing_user = await db.get_user_by_username(normalized_username)
+        
+        if existing_user:
+            # Пользователь уже есть - обновляем роль
+            await db.set_user_role(existing_user['user_id'], 'admin', allow=True)
+            
+            if existing_user['user_id'] < 0:
                 await message.reply(f"✅ Пользователь {normalized_username} добавлен как администратор. Получит права при первом обращении к боту.")
+            else:
+                await message.reply(f"✅ Пользователь {normalized_username} (ID: {existing_user['user_id']}) теперь администратор.")
+        else:
+            # Пользователя нет - создаем с временным отрицательным ID (хеш от username)
+            await db.add_user_by_username(normalized_username, role='admin')
+            
+            await message.reply(f"✅ Пользователь {normalized_username} добавлен как администратор. Получит права при первом обращении к боту.")
         
     except Exception as e:
         logger.error(f"Error adding admin: {e}")
@@ -536,41 +639,34 @@ async def cmd_del_admin(message: Message):
     normalized_username = f"@{username}"
     
     try:
-        async with db.pool.acquire() as conn:
-            # Ищем пользователя по username (может быть с временным ID)
-            target_user = await conn.fetchrow("""
-                SELECT user_id, role FROM users WHERE username = $1
-            """, normalized_username)
-            
-            if not target_user:
-                await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
-                return
-            
-            target_user_id = target_user['user_id']
-            
-            # Проверяем, не пытается ли админ удалить самого себя
-            if target_user_id == user_id:
-                await message.reply("❌ Нельзя удалить права администратора у самого себя.")
+        # Ищем пользователя по username (может быть с временным ID)
+        target_user = await db.get_user_by_username(normalized_username)
+        
+        if not target_user:
+            await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
+            return
+        
+        target_user_id = target_user['user_id']
+        
+        # Проверяем, не пытается ли админ удалить самого себя
+        if target_user_id == user_id:
+            await message.reply("❌ Нельзя удалить права администратора у самого себя.")
+            return
+        
+        # Проверяем, не является ли удаляемый пользователь корневым админом
+        if target_user_id in root_admins or target_user_id < 0:
+            # Для пользователей с временным ID или корневых админов
+            if target_user_id in root_admins:
+                await message.reply("❌ Нельзя удалить права у корневого администратора.")
                 return
-            
-            # Проверяем, не является ли удаляемый пользователь корневым админом
-            if target_user_id in root_admins or target_user_id < 0:
-                # Для пользователей с временным ID или корневых админов
-                if target_user_id in root_admins:
-                    await message.reply("❌ Нельзя удалить права у корневого администратора.")
-                    return
-            
-            # Понижаем администратора до обычного пользователя
-            await conn.execute("""
-                UPDATE users
-                SET role = 'user'
-                WHERE user_id = $1
-            """, target_user_id)
-            
-            if target_user_id < 0:
-                await message.reply(f"✅ Права администратора удалены у {normalized_username} (активируется при первом обращении).")
-            else:
-                await message.reply(f"✅ Пользователь {normalized_username} (ID: {target_user_id}) больше не администратор.")
+        
+        # Понижаем администратора до обычного пользователя
+        await db.set_user_role(target_user_id, 'user')
+        
+        if target_user_id < 0:
+            await message.reply(f"✅ Права администратора удалены у {normalized_username} (активируется при первом обращении).")
+        else:
+            await message.reply(f"✅ Пользователь {normalized_username} (ID: {target_user_id}) больше не администратор.")
         
     except Exception as e:
         logger.error(f"Error removing admin: {e}")
@@ -592,39 +688,32 @@ async def cmd_block_user(message: Message):
     try:
         user_identifier = args[0]
         
-        async with db.pool.acquire() as conn:
-            # Если это @username, ищем в базе
-            if user_identifier.startswith('@'):
-                username = user_identifier.lstrip('@')
-                normalized_username = f"@{username}"
-                target_user = await conn.fetchrow("""
-                    SELECT user_id FROM users WHERE username = $1
-                """, normalized_username)
-                
-                if not target_user:
-                    await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
-                    return
-                
-                user_id = target_user['user_id']
-            else:
-                # Извлекаем user_id из числового значения
-                user_id = extract_user_id(user_identifier)
-                if not user_id or not isinstance(user_id, int):
-                    await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
-                    return
+        # Если это @username, ищем в базе
+        if user_identifier.startswith('@'):
+            username = user_identifier.lstrip('@')
+            normalized_username = f"@{username}"
+            target_user = await db.get_user_by_username(normalized_username)
             
-            # Блокируем пользователя
-            result = await conn.execute("""
-                UPDATE users SET allowed = FALSE WHERE user_id = $1
-            """, user_id)
+            if not target_user:
+                await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
+                return
             
-            if result == "UPDATE 0":
-                await message.reply(f"❌ Пользователь с ID {user_id} не найден в базе.")
+            user_id = target_user['user_id']
+        else:
+            # Извлекаем user_id из числового значения
+            user_id = extract_user_id(user_identifier)
+            if not user_id or not isinstance(user_id, int):
+                await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
+                return
+        
+        # Блокируем пользователя
+        if not await db.set_user_allowed(user_id, False):
+            await message.reply(f"❌ Пользователь с ID {user_id} не найден в базе.")
+        else:
+            if user_identifier.startswith('@'):
+                await message.reply(f"✅ Пользователь {normalized_username} (ID: {user_id}) заблокирован.")
             else:
-                if user_identifier.startswith('@'):
-                    await message.reply(f"✅ Пользователь {normalized_username} (ID: {user_id}) заблокирован.")
-                else:
-                    await message.reply(f"✅ Пользователь {user_id} заблокирован.")
+                await message.reply(f"✅ Пользователь {user_id} заблокирован.")
         
     except Exception as e:
         logger.error(f"Error blocking user: {e}")
@@ -646,39 +735,32 @@ async def cmd_unblock_user(message: Message):
     try:
         user_identifier = args[0]
         
-        async with db.pool.acquire() as conn:
-            # Если это @username, ищем в базе
-            if user_identifier.startswith('@'):
-                username = user_identifier.lstrip('@')
-                normalized_username = f"@{username}"
-                target_user = await conn.fetchrow("""
-                    SELECT user_id FROM users WHERE username = $1
-                """, normalized_username)
-                
-                if not target_user:
-                    await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
-                    return
-                
-                user_id = target_user['user_id']
-            else:
-                # Извлекаем user_id из числового значения
-                user_id = extract_user_id(user_identifier)
-                if not user_id or not isinstance(user_id, int):
-                    await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
-                    return
+        # Если это @username, ищем в базе
+        if user_identifier.startswith('@'):
+            username = user_identifier.lstrip('@')
+            normalized_username = f"@{username}"
+            target_user = await db.get_user_by_username(normalized_username)
             
-            # Разблокируем пользователя
-            result = await conn.execute("""
-                UPDATE users SET allowed = TRUE WHERE user_id = $1
-            """, user_id)
+            if not target_user:
+                await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
+                return
             
-            if result == "UPDATE 0":
-                await message.reply(f"❌ Пользователь с ID {user_id} не найден в базе.")
+            user_id = target_user['user_id']
+        else:
+            # Извлекаем user_id из числового значения
+            user_id = extract_user_id(user_identifier)
+            if not user_id or not isinstance(user_id, int):
+                await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
+                return
+        
+        # Разблокируем пользователя
+        if not await db.set_user_allowed(user_id, True):
+            await message.reply(f"❌ Пользователь с ID {user_id} не найден в базе.")
+        else:
+            if user_identifier.startswith('@'):
+                await message.reply(f"✅ Пользователь {normalized_username} (ID: {user_id}) разблокирован.")
             else:
-                if user_identifier.startswith('@'):
-                    await message.reply(f"✅ Пользователь {normalized_username} (ID: {user_id}) разблокирован.")
-                else:
-                    await message.reply(f"✅ Пользователь {user_id} разблокирован.")
+                await message.reply(f"✅ Пользователь {user_id} разблокирован.")
         
     except Exception as e:
         logger.error(f"Error unblocking user: {e}")
@@ -718,24 +800,21 @@ async def cmd_change_user_week_limit(message: Message):
             limit_value = args[1]
             
             # Получаем user_id
-            async with db.pool.acquire() as conn:
-                if user_identifier.startswith('@'):
-                    username = user_identifier.lstrip('@')
-                    normalized_username = f"@{username}"
-                    target_user = await conn.fetchrow("""
-                        SELECT user_id FROM users WHERE username = $1
-                    """, normalized_username)
-                    
-                    if not target_user:
-                        await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
-                        return
-                    
-                    user_id = target_user['user_id']
-                else:
-                    user_id = extract_user_id(user_identifier)
-                    if not user_id or not isinstance(user_id, int):
-                        await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
-                        return
+            if user_identifier.startswith('@'):
+                username = user_identifier.lstrip('@')
+                normalized_username = f"@{username}"
+                target_user = await db.get_user_by_username(normalized_username)
+                
+                if not target_user:
+                    await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
+                    return
+                
+                user_id = target_user['user_id']
+            else:
+                user_id = extract_user_id(user_identifier)
+                if not user_id or not isinstance(user_id, int):
+                    await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
+                    return
             
             # Парсим лимит
             if limit_value.lower() == 'off':
@@ -793,24 +872,21 @@ async def cmd_change_user_abs_limit(message: Message):
             limit_value = args[1]
             
             # Получаем user_id
-            async with db.pool.acquire() as conn:
-                if user_identifier.startswith('@'):
-                    username = user_identifier.lstrip('@')
-                    normalized_username = f"@{username}"
-                    target_user = await conn.fetchrow("""
-                        SELECT user_id FROM users WHERE username = $1
-                    """, normalized_username)
-                    
-                    if not target_user:
-                        await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
-                        return
-                    
-                    user_id = target_user['user_id']
-                else:
-                    user_id = extract_user_id(user_identifier)
-                    if not user_id or not isinstance(user_id, int):
-                        await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
-                        return
+            if user_identifier.startswith('@'):
+                username = user_identifier.lstrip('@')
+                normalized_username = f"@{username}"
+                target_user = await db.get_user_by_username(normalized_username)
+                
+                if not target_user:
+                    await message.reply(f"❌ Пользователь {normalized_username} не найден в базе.")
+                    return
+                
+                user_id = target_user['user_id']
+            else:
+                user_id = extract_user_id(user_identifier)
+                if not user_id or not isinstance(user_id, int):
+                    await message.reply("❌ Неверный формат user_id. Используйте числовой ID или @username.", parse_mode=None)
+                    return
             
             # Парсим лимит
             if limit_value.lower() == 'off':
@@ -879,8 +955,19 @@ async def cmd_stat_export(message: Message):
 • Установок машин: {stats['car_setted']}
 • Достижений лимитов: {stats['limits_exhausted']}
 
-👑 <b>Топ пользователей по активности:</b>
+⏱ <b>Время ответа RAG по дням (p50 / p90 / p99):</b>
 """
+            if stats['rag_latency']:
+                for day in stats['rag_latency']:
+                    p50, p90, p99 = day['latency']
+                    response += (f"• {day['day'].strftime('%d.%m')}: {p50:.1f} / {p90:.1f} / {p99:.1f} с, "
+                                 f"ответов {day['completed']}, сбоев {day['failed']}, "
+                                 f"вне SLO {stats['rag_slo_sec']:.0f} с: {day['slo_breaches']}, "
+                                 f"опросов ср. {day['avg_polls'] or 0:.1f}\n")
+            else:
+                response += "Нет данных\n"
+            
+            response += "\n👑 <b>Топ пользователей по активности:</b>\n"
             
             if stats['top_users']:
                 for i, user in enumerate(stats['top_users'], 1):
@@ -940,65 +1027,275 @@ async def cmd_stat_export(message: Message):
             # Суммаризированная статистика
             stats = await db.get_statistics(period)
             
-            # Формируем CSV
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Заголовок
-            writer.writerow([
-                'period_start', 'period_end', 'total_users', 'active_users', 'new_users',
-                'total_messages', 'command_messages', 'text_messages', 'rag_requests',
-                'rag_failed', 'car_setted', 'limits_exhausted'
-            ])
-            
-            # Данные
-            writer.writerow([
-                period_start_str, period_end_str, stats['total_users'], stats['active_users'], stats['new_users'],
-                stats['total_messages'], stats['commands'], stats['text_messages'], stats['rag_requests'],
-                stats['rag_failed'], stats['car_setted'], stats['limits_exhausted']
-            ])
-            
-            csv_content = output.getvalue()
+            path, _ = await export_csv_gz(
+                ['period_start', 'period_end', 'total_users', 'active_users', 'new_users',
+                 'total_messages', 'command_messages', 'text_messages', 'rag_requests',
+                 'rag_failed', 'car_setted', 'limits_exhausted'],
+                single_chunk([[
+                    period_start_str, period_end_str, stats['total_users'], stats['active_users'], stats['new_users'],
+                    stats['total_messages'], stats['commands'], stats['text_messages'], stats['rag_requests'],
+                    stats['rag_failed'], stats['car_setted'], stats['limits_exhausted']
+                ]]),
+            )
             
         elif subcommand == "users_per_day":
-            # Статистика по пользователям
-            users = await db.list_users()
-            
-            # Формируем CSV
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Заголовок
-            writer.writerow([
-                'period_start', 'period_end', 'user_id', 'username', 'first_seen_at', 'last_seen_at', 
-                'total_messages', 'command_messages', 'text_messages', 'rag_requests', 'rag_failed',
-                'is_blocked', 'is_admin', 'car', 'limits_reached', 'src', 'campaign', 'ad',
-                'car_setted', 'limits_exhausted'
-            ])
-            
-            # Данные для каждого пользователя
-            for user_id in [u['user_id'] for u in users]:
-                analytics = await db.get_user_analytics(user_id, period)
-                writer.writerow([
+            # Статистика по пользователям: один агрегирующий запрос, строки читаются курсором
+            path, _ = await export_csv_gz(
+                ['period_start', 'period_end', 'user_id', 'username', 'first_seen_at', 'last_seen_at',
+                 'total_messages', 'command_messages', 'text_messages', 'rag_requests', 'rag_failed',
+                 'is_blocked', 'is_admin', 'car', 'limits_reached', 'src', 'campaign', 'ad',
+                 'car_setted', 'limits_exhausted'],
+                db.iter_user_analytics_for_csv(period),
+                lambda analytics: (
                     period_start_str, period_end_str,
                     analytics['user_id'], analytics['username'], analytics['first_seen_at'],
                     analytics['last_seen_at'], analytics['total_messages'], analytics['command_messages'],
                     analytics['text_messages'], analytics['rag_requests'], analytics['rag_failed'],
                     analytics['is_blocked'], analytics['is_admin'], analytics['car'],
                     analytics['limits_reached'], analytics['src'], analytics['campaign'], analytics['ad'],
-                    analytics['car_setted'], analytics['limits_exhausted']
-                ])
-            
-            csv_content = output.getvalue()
+                    analytics['car_setted'], analytics['limits_exhausted'],
+                ),
+            )
         
-        # Отправляем файл
-        csv_bytes = csv_content.encode('utf-8')
-        from aiogram.types import BufferedInputFile
-        await message.reply_document(
-            BufferedInputFile(csv_bytes, filename=f"stat_{period}.csv"),
-            caption=f"📊 Статистика за {period}"
-        )
+        # Отправляем файл с диска
+        try:
+            await message.reply_document(
+                FSInputFile(path, filename=f"stat_{subcommand}_{period}.csv.gz"),
+                caption=f"📊 Статистика за {period}"
+            )
+        finally:
+            remove_export(path)
         
     except Exception as e:
         logger.error(f"Error exporting statistics: {e}")
         await message.reply("❌ Произошла ошибка при экспорте статистики.")
+
+@router.message(Command("load"))
+async def cmd_load(message: Message):
+    """Текущая нагрузка: обработчики, отправка в Telegram, цикл событий и пулы БД"""
+    if not await db.is_admin(message.from_user.id):
+        await message.reply("❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    stats = scheduler.snapshot()
+    lane_titles = {'fast': 'Команды и кнопки', 'default': 'Вопросы'}
+    lines = ["📈 <b>Нагрузка</b>", "", "<b>Обработчики (выполняется/лимит, в очереди):</b>"]
+    for name, lane in stats['lanes'].items():
+        lines.append(f"• {lane_titles.get(name, name)}: {lane['active']}/{lane['limit']}, "
+                     f"в очереди {lane['waiting']} (ожидание ср. {lane['avg_wait_ms']:.0f} мс)")
+    rag = stats['rag_wait']
+    lines.append(f"• Ожидание RAG: {rag['active']}/{rag['limit']}, в очереди {rag['waiting']}")
+    lines.append(f"• Всего в обработке: {stats['pending']}/{stats['max_pending']}, ошибок {stats['failed']}")
+    flood = throttling.snapshot()
+    lines.append(f"• Отброшено флуда: {flood['throttled']}, повторов: {flood['duplicates']} "
+                 f"(отслеживается пользователей: {flood['users']})")
+    
+    telegram = telegram_limiter.snapshot()
+    lines += ["", "<b>Отправка в Telegram:</b>",
+              f"• Отправлено {telegram['sent']}, в очереди {telegram['queued']}, ошибок {telegram['failed']}",
+              f"• Задержано лимитом {telegram['throttled']}, ответов 429: {telegram['retry_after']}",
+              f"• Ожидание ср. {telegram['avg_wait_ms']:.0f} мс (макс. {telegram['max_wait_ms']:.0f}), "
+              f"отправка ср. {telegram['avg_latency_ms']:.0f} мс"]
+    
+    loop = loop_watchdog.snapshot()
+    lines += ["", "<b>Цикл событий:</b>",
+              f"• Задержка p50 {loop['p50_ms']:.1f} мс, p99 {loop['p99_ms']:.1f} мс, "
+              f"макс. {loop['max_ms']:.0f} мс ({loop['loop']})",
+              f"• Блокировок: {loop['stalls']}"]
+    if loop['last_stall']:
+        stall = loop['last_stall']
+        lines.append(f"• Последняя: {stall['lag']:.1f} с в {html.escape(stall['task'])}, "
+                     f"{html.escape(stall['where'])}")
+    
+    from utils.rag_client import rag_client
+    stale = rag_client.snapshot()
+    lines += ["", "<b>Сохранённые ответы при сбоях RAG:</b>",
+              f"• Отдано {stale['stale_served']} (самый старый {stale['stale_age_max'] / 3600:.1f} ч), "
+              f"не найдено {stale['misses']:.0f}",
+              f"• Обновлено в фоне {stale['refreshed']:.0f}, неудачно {stale['refresh_failed']:.0f}, "
+              f"выполняется {stale['refreshing']}"]
+    
+    memory = conversation_memory.snapshot()
+    if memory['enabled']:
+        lines += ["", "<b>Контекст диалогов:</b>",
+                  f"• Пользователей в памяти: {memory['users']}, {memory['bytes'] / 1024 / 1024:.1f} из "
+                  f"{memory['max_bytes'] / 1024 / 1024:.0f} МБ ({memory['bytes_per_user'] / 1024:.1f} КБ на пользователя)",
+                  f"• Из памяти {memory['hits']}, загружено из БД {memory['loads']}, вытеснено {memory['evicted']}"]
+    
+    lines += ["", "<b>Пулы БД (занято/открыто/максимум):</b>"]
+    for name, pool in db.pool_stats().items():
+        lines.append(f"• {name}: {pool['size'] - pool['idle']}/{pool['size']}/{pool['max_size']}")
+    
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message):
+    """Профилирование: /profile cpu|cprofile|mem [сек], /profile tasks"""
+    if not await db.is_admin(message.from_user.id):
+        await message.reply("❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    command, args = parse_command_args(message.text)
+    kind = args[0] if args else None
+    if kind not in ('cpu', 'cprofile', 'mem', 'tasks'):
+        status = profiler.status()
+        await message.reply(
+            (f"⏳ Выполняется замер: {status}\n\n" if status else "") +
+            "❌ Использование:\n"
+            f"/profile cpu [сек] - семплирующий профилировщик (по умолчанию {PROFILE_DEFAULT_SEC} с, "
+            f"не больше {PROFILE_MAX_SEC})\n"
+            "/profile cprofile [сек] - cProfile: точные вызовы, но замедляет бота\n"
+            "/profile mem [сек] - прирост памяти по местам выделения (tracemalloc)\n"
+            "/profile tasks - задачи asyncio по корутинам"
+        )
+        return
+    
+    seconds = PROFILE_DEFAULT_SEC
+    if len(args) > 1:
+        try:
+            seconds = int(args[1])
+            if seconds <= 0:
+                raise ValueError
+        except ValueError:
+            await message.reply("❌ Длительность должна быть положительным числом секунд.")
+            return
+    if seconds > PROFILE_MAX_SEC:
+        seconds = PROFILE_MAX_SEC
+    
+    if profiler.running is not None:
+        await message.reply(f"⏳ Уже выполняется замер: {profiler.status()}")
+        return
+    if kind != 'tasks':
+        await message.reply(f"⏱ Замер {kind} на {seconds} с запущен, отчёт придёт документом.")
+    # Отчёт отправляется из фоновой задачи: замер идёт дольше обработчика команды
+    profiler.spawn(send_profile(message, kind, seconds))
+
+async def send_profile(message: Message, kind: str, seconds: int):
+    """Замер и отправка отчёта документом"""
+    try:
+        path = await profiler.run(kind, seconds)
+    except ProfilerBusy as e:
+        await message.reply(f"⏳ Уже выполняется замер: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Error profiling ({kind}): {e}")
+        await message.reply("❌ Произошла ошибка при профилировании.")
+        return
+    try:
+        await message.reply_document(
+            FSInputFile(path, filename=f"profile_{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"),
+            caption=f"🔬 Профиль {kind}" + (f" за {seconds} с" if kind != 'tasks' else "")
+        )
+    except Exception as e:
+        logger.error(f"Error sending profile report: {e}")
+    finally:
+        remove_report(path)
+
+def broadcast_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    """Кнопки подтверждения рассылки"""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Отправить",
+                             callback_data=BroadcastAction(action="start", job_id=job_id).pack()),
+        InlineKeyboardButton(text="❌ Отмена",
+                             callback_data=BroadcastAction(action="cancel", job_id=job_id).pack()),
+    ]])
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message):
+    """Рассылка: /broadcast текст, /broadcast status [id], /broadcast cancel id"""
+    if not await db.is_admin(message.from_user.id):
+        await message.reply("❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    command, args = parse_command_args(message.text)
+    if not args:
+        await message.reply(
+            "❌ Использование:\n"
+            "/broadcast текст - рассылка всем активным пользователям\n"
+            "/broadcast status [id] - ход рассылки\n"
+            "/broadcast cancel id - отменить рассылку"
+        )
+        return
+    
+    try:
+        if args[0] == "status":
+            await broadcast_status(message, args[1] if len(args) > 1 else None)
+            return
+        
+        if args[0] == "cancel":
+            if len(args) < 2 or not args[1].isdigit():
+                await message.reply("❌ Использование: /broadcast cancel id")
+                return
+            job_id = int(args[1])
+            if await broadcaster.cancel(job_id):
+                await message.reply(f"✅ Рассылка #{job_id} отменена.")
+            else:
+                await message.reply(f"❌ Рассылка #{job_id} не найдена или уже завершена.")
+            return
+        
+        # Текст с форматированием (HTML) без команды; переносы строк сохраняются
+        text = message.html_text.split(maxsplit=1)[1]
+        job_id = await db.create_broadcast(message.from_user.id, text, message.chat.id)
+        preview = await message.reply(
+            f"📣 <b>Рассылка #{job_id}</b> — предпросмотр:\n\n{text}",
+            reply_markup=broadcast_keyboard(job_id),
+            parse_mode="HTML",
+        )
+        # Это же сообщение после подтверждения показывает ход рассылки
+        await db.set_broadcast_progress_message(job_id, preview.message_id)
+        logger.info(f"Broadcast {job_id} drafted by {message.from_user.id}")
+    except Exception as e:
+        logger.error(f"Error in broadcast command: {e}")
+        await message.reply("❌ Произошла ошибка при работе с рассылкой.")
+
+async def broadcast_status(message: Message, job_id: Optional[str]):
+    """Ход одной рассылки или список последних"""
+    if job_id is not None:
+        if not job_id.isdigit():
+            await message.reply("❌ Использование: /broadcast status [id]")
+            return
+        job = await db.get_broadcast(int(job_id))
+        if job is None:
+            await message.reply(f"❌ Рассылка #{job_id} не найдена.")
+            return
+        jobs = [job]
+    else:
+        jobs = await db.get_recent_broadcasts()
+        if not jobs:
+            await message.reply("📣 Рассылок ещё не было.")
+            return
+    
+    # Счётчики выполняемой здесь рассылки свежее записанных в базу
+    texts = [format_progress(broadcaster.live_progress(job['id']) or job) for job in jobs]
+    await message.reply("\n\n".join(texts), parse_mode="HTML")
+
+@router.callback_query(BroadcastAction.filter())
+async def broadcast_callback(callback: CallbackQuery, callback_data: BroadcastAction):
+    """Подтверждение или отмена черновика рассылки"""
+    if not await db.is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав для выполнения этой команды.", show_alert=True)
+        return
+    
+    job_id = callback_data.job_id
+    try:
+        if callback_data.action == "start":
+            total = await db.start_broadcast(job_id)
+            if total is None:
+                await callback.answer("Рассылка уже запущена или отменена.", show_alert=True)
+                return
+            broadcaster.wake()
+            logger.info(f"Broadcast {job_id} started by {callback.from_user.id}: {total} recipient(s)")
+        elif not await broadcaster.cancel(job_id):
+            await callback.answer("Рассылка уже завершена или отменена.", show_alert=True)
+            return
+        
+        job = await db.get_broadcast(job_id)
+        await callback.message.edit_text(format_progress(job), parse_mode="HTML")
+        await callback.answer()
+    except TelegramBadRequest as e:
+        # Исполнитель успел обновить сообщение раньше
+        logger.debug(f"Broadcast message was not edited: {e}")
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Error handling broadcast action: {e}")
+        await callback.answer("❌ Произошла ошибка при работе с рассылкой.", show_alert=True)
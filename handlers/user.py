@@ -7,13 +7,21 @@ import base64
 from urllib.parse import parse_qs
 from datetime import datetime
 
+from database.answers import QuestionContext
 from database.db import db
-from utils.helpers import parse_command_args, validate_car_description, sanitize_text
+from utils.conversation import build_question, conversation_memory, format_history
+from utils.helpers import format_age, parse_command_args, validate_car_description, sanitize_text
 from utils.logger import get_logger
+from utils.scheduler import scheduler
+from utils.shutdown import ReplyTarget
+from utils.telegram_limiter import PRIORITY_STATUS, send_priority
 
 logger = get_logger(__name__)
 router = Router()
 
+# Кнопки меню отвечают сразу и не ждут в очереди вопросов к RAG
+scheduler.fast_texts.update({"Моя машина 🚘", "Написать в поддержку"})
+
 class CarStates(StatesGroup):
     waiting_for_car_description = State()
 
@@ -69,13 +77,13 @@ async def cmd_start(message: Message):
             # Fallback для старого метода
             payload = ' '.join(message.args) if isinstance(message.args, list) else message.args
     
-    logger.info(f"Start command received for user {user_id} (@{username}), payload: {payload}, full text: {message.text}")
+    logger.info("Start command received for user %s (@%s), payload: %s, full text: %s", user_id, username, payload, message.text)
     
     acquisition_data = {}
     if payload:
         # Декодируем payload
         acquisition_data = await decode_start_payload(payload)
-        logger.info(f"Decoded acquisition data for user {user_id}: {acquisition_data}")
+        logger.info("Decoded acquisition data for user %s: %s", user_id, acquisition_data)
     
     try:
         # Проверяем, есть ли пользователь с временным ID по username
@@ -83,36 +91,17 @@ async def cmd_start(message: Message):
             # Нормализуем username - всегда храним с @
             normalized_username = f"@{username.lstrip('@')}"
             
-            async with db.pool.acquire() as conn:
-                temp_user = await conn.fetchrow("""
-                    SELECT user_id, role, allowed FROM users 
-                    WHERE username = $1 AND user_id < 0
-                """, normalized_username)
-                
-                if temp_user:
-                    # Обновляем временный ID на реальный
-                    await conn.execute("""
-                        DELETE FROM users WHERE user_id = $1
-                    """, temp_user['user_id'])
-                    
-                    await conn.execute("""
-                        INSERT INTO users (user_id, username, role, allowed)
-                        VALUES ($1, $2, $3, $4)
-                        ON CONFLICT (user_id) DO UPDATE 
-                        SET username = EXCLUDED.username, role = EXCLUDED.role, allowed = EXCLUDED.allowed
-                    """, user_id, normalized_username, temp_user['role'], temp_user['allowed'])
-                    
-                    logger.info(f"User {user_id} ({normalized_username}) activated from temporary ID {temp_user['user_id']}")
-                else:
-                    # Добавляем пользователя обычным способом
-                    await db.add_user(user_id, username)
+            # Обновляем временный ID на реальный или добавляем пользователя обычным способом
+            if not await db.activate_pending_user(user_id, normalized_username):
+                await db.add_user(user_id, username)
         else:
             # Если нет username, просто добавляем пользователя
             await db.add_user(user_id, username or f"user_{user_id}")
         
         # Сохраняем информацию о привлечении если есть
         if acquisition_data and (acquisition_data.get('src') or acquisition_data.get('campaign')):
-            logger.info(f"Saving acquisition data for user {user_id}: src={acquisition_data.get('src')}, campaign={acquisition_data.get('campaign')}, ad={acquisition_data.get('ad')}")
+            logger.info("Saving acquisition data for user %s: src=%s, campaign=%s, ad=%s", user_id,
+                        acquisition_data.get('src'), acquisition_data.get('campaign'), acquisition_data.get('ad'))
             await db.save_user_acquisition(
                 user_id=user_id,
                 payload_raw=payload,
@@ -124,9 +113,9 @@ async def cmd_start(message: Message):
             )
         else:
             if payload:
-                logger.warning(f"Payload present but acquisition_data is empty for user {user_id}. Payload: {payload[:100]}")
+                logger.warning("Payload present but acquisition_data is empty for user %s. Payload: %.100s", user_id, payload)
             else:
-                logger.info(f"No payload for user {user_id}, acquisition data not saved")
+                logger.info("No payload for user %s, acquisition data not saved", user_id)
         
         # Логируем действие
         await db.log_action(user_id, "start", payload)
@@ -313,7 +302,6 @@ async def process_car_description(message: Message, state: FSMContext):
     
     try:
         await db.set_car(user_id, car_description)
-        await db.log_message(user_id, "command", f"set_car: {car_description[:100]}...")
         await db.log_action(user_id, "set_car", car_description[:100])
         await message.reply(f"✅ Информация об автомобиле сохранена:\n🚗 {car_description}")
         
@@ -353,7 +341,6 @@ async def handle_media_message(message: Message):
         media_type = "video_note"
     
     await db.log_action(user_id, "media_message", media_type)
-    await db.log_message(user_id, "media", media_type)
     
     # Получаем текст из шаблона
     media_text = await db.get_template('media_not_supported_text')
@@ -378,29 +365,11 @@ async def handle_text_message(message: Message):
         # Нормализуем username - всегда храним с @
         normalized_username = f"@{username.lstrip('@')}"
         
-        # Проверяем, есть ли пользователь с временным ID
-        async with db.pool.acquire() as conn:
-            temp_user = await conn.fetchrow("""
-                SELECT user_id, role, allowed FROM users 
-                WHERE username = $1 AND user_id < 0
-            """, normalized_username)
-            
-            if temp_user:
-                # Обновляем временный ID на реальный
-                await conn.execute("""
-                    DELETE FROM users WHERE user_id = $1
-                """, temp_user['user_id'])
-                
-                await conn.execute("""
-                    INSERT INTO users (user_id, username, role, allowed)
-                    VALUES ($1, $2, $3, $4)
-                """, user_id, normalized_username, temp_user['role'], temp_user['allowed'])
-                
-                logger.info(f"User {user_id} ({normalized_username}) activated from temporary ID {temp_user['user_id']}")
-                user = await db.get_user(user_id)
-            else:
-                await db.add_user(user_id, username or f"user_{user_id}")
-                user = await db.get_user(user_id)
+        # Проверяем, есть ли пользователь с временным ID, и переносим его на реальный
+        user = await db.activate_pending_user(user_id, normalized_username)
+        if not user:
+            await db.add_user(user_id, username or f"user_{user_id}")
+            user = await db.get_user(user_id)
     elif not user:
         await db.add_user(user_id, username or f"user_{user_id}")
         user = await db.get_user(user_id)
@@ -417,7 +386,6 @@ async def handle_text_message(message: Message):
     
     # Логируем текстовое сообщение
     await db.log_action(user_id, "text_question", question[:100])
-    await db.log_message(user_id, "text", question[:100])
     
     # Проверяем лимиты
     can_proceed, error = await db.check_and_increment_limits(user_id)
@@ -435,33 +403,45 @@ async def handle_text_message(message: Message):
     if not processing_text:
         processing_text = "🤔 Обрабатываю ваш вопрос..."
     
-    processing_msg = await message.reply(processing_text)
+    # Служебное сообщение пропускает вперёд ответы другим пользователям
+    with send_priority(PRIORITY_STATUS):
+        processing_msg = await message.reply(processing_text)
     
     try:
         # Получаем информацию о пользователе для контекста
         user = await db.get_user(user_id)
         car_info = user.get('car') if user else None
         
-        # Формируем контекстный вопрос
-        if car_info:
-            contextual_question = f"Автомобиль пользователя: {car_info}\n\nВопрос: {question}"
-        else:
-            contextual_question = question
+        # Формируем контекстный вопрос: машина и предыдущие вопросы о ней (если включено)
+        history = format_history(await conversation_memory.context(user_id, car_info))
+        contextual_question = build_question(question, car_info, history)
         
         # Отправляем запрос в RAG API
         from utils.rag_client import rag_client
-        response = await rag_client.send_request(
+        response = await rag_client.answer(
             contextual_question,
             user_id,
-            username
+            username,
+            # Если бот остановится раньше ответа, он будет доставлен после запуска
+            reply_to=ReplyTarget(message.chat.id, message.message_id, processing_msg.message_id),
+            # Ответ с историей разговора сохраняется под своим ключом и не отдаётся на другие вопросы
+            context=QuestionContext(question, car_info, history),
         )
         
         # Удаляем сообщение о обработке
         await processing_msg.delete()
         
         if response:
+            conversation_memory.remember(user_id, car_info, question, response.text)
+            text = response.text
+            if response.cached:
+                # Ответ из rag_answers: RAG API не ответил вовремя или вернул ошибку
+                cached_note = await db.get_template('rag_cached_text')
+                if not cached_note:
+                    cached_note = "ℹ️ Сервис ответов сейчас недоступен, это сохранённый ответ на такой же вопрос"
+                text = f"{text}\n\n{cached_note} ({format_age(response.age_sec)} назад)"
             # Отправляем ответ реплаем
-            await message.reply(f"{response}")
+            await message.reply(text)
         else:
             error_text = await db.get_template('rag_error_text')
             if not error_text:
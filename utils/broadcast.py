@@ -0,0 +1,236 @@
+"""
+Рассылки администраторов
+
+Задача хранится в broadcast_jobs, результат по каждому получателю — в broadcast_recipients
+(пакетами через BatchWriter). Получатели читаются страницами по user_id (keyset), сообщения
+уходят с частотой BROADCAST_RATE — ниже общего лимита Telegram, чтобы оставался запас для
+ответов пользователям; к тому же рассылка идёт с низшим приоритетом (utils/telegram_limiter.py).
+
+Рассылку выполняет процесс, держащий аренду задачи. После перезапуска (или падения процесса —
+по истечении аренды) задача продолжается с сохранённой позиции, получатели с уже записанным
+результатом пропускаются. Повторно может прийти только сообщение, отправленное в последнюю
+секунду перед падением.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from contextlib import suppress
+from typing import Any, Dict, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from database.batch_writer import BatchWriter
+from database.db import Database, db
+from utils.logger import get_logger
+from utils.telegram_limiter import PRIORITY_BULK, RateLimit, send_priority
+
+logger = get_logger(__name__)
+
+# Сообщений в секунду (общий лимит Telegram — около 30)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 20))
+# Одновременных запросов sendMessage (нужно, чтобы задержка сети не снижала частоту)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', 200))
+BROADCAST_LEASE_SEC = int(os.getenv('BROADCAST_LEASE_SEC', 60))
+BROADCAST_PROGRESS_INTERVAL_SEC = float(os.getenv('BROADCAST_PROGRESS_INTERVAL_SEC', 5))
+# Как часто искать задачи, брошенные упавшими процессами
+BROADCAST_POLL_INTERVAL_SEC = float(os.getenv('BROADCAST_POLL_INTERVAL_SEC', 30))
+
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+STATUS_BLOCKED = 'blocked'
+
+STATUS_TITLES = {
+    'draft': 'черновик',
+    'running': 'выполняется',
+    'completed': 'завершена',
+    'cancelled': 'отменена',
+}
+
+
+def format_progress(job: Dict[str, Any]) -> str:
+    """Текст сообщения о ходе рассылки"""
+    total = job.get('total') or 0
+    done = job['sent'] + job['failed'] + job['blocked']
+    percent = f" ({done * 100 // total}%)" if total else ""
+    return (
+        f"📣 <b>Рассылка #{job['id']}</b> — {STATUS_TITLES.get(job['status'], job['status'])}\n"
+        f"Обработано: {done} из {total}{percent}\n"
+        f"Доставлено: {job['sent']}, ошибок: {job['failed']}, заблокировали бота: {job['blocked']}"
+    )
+
+
+class Broadcaster:
+    """Выполнение рассылок с ограничением частоты и возобновлением после перезапуска"""
+
+    def __init__(self, database: Database = db):
+        self.db = database
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.results = BatchWriter('broadcast_recipients', self.db.record_broadcast_results, flush_interval=1.0)
+        self.bot: Optional[Bot] = None
+        # job_id -> задача выполнения и текущее состояние (счётчики обновляются на лету)
+        self._jobs: Dict[int, asyncio.Task] = {}
+        self._live: Dict[int, Dict[str, Any]] = {}
+        self._cancelled: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot) -> None:
+        """Запуск поиска и выполнения задач (после подключения к базе)"""
+        self.bot = bot
+        self.results.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="broadcaster")
+
+    async def stop(self) -> None:
+        """Остановка: текущие рассылки прерываются и продолжатся после перезапуска"""
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        jobs = list(self._jobs.values())
+        for task in jobs:
+            task.cancel()
+        if jobs:
+            await asyncio.gather(*jobs, return_exceptions=True)
+        await self.results.stop()
+        try:
+            # Аренда снимается, чтобы следующий запуск продолжил рассылку сразу
+            await self.db.release_broadcasts(self.owner)
+        except Exception as e:
+            logger.warning(f"Failed to release broadcast leases: {e}")
+
+    def wake(self) -> None:
+        """Немедленный поиск задач (после запуска рассылки администратором)"""
+        self._wakeup.set()
+
+    def live_progress(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Состояние рассылки, выполняемой этим процессом"""
+        return self._live.get(job_id)
+
+    async def cancel(self, job_id: int) -> bool:
+        """Отмена рассылки; выполняемая в другом процессе остановится на следующей странице"""
+        cancelled = await self.db.cancel_broadcast(job_id)
+        if cancelled:
+            self._cancelled.add(job_id)
+        return cancelled
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                for job in await self.db.claim_broadcasts(self.owner, BROADCAST_LEASE_SEC):
+                    if job['id'] not in self._jobs:
+                        self._jobs[job['id']] = asyncio.create_task(
+                            self._run_job(job), name=f"broadcast-{job['id']}",
+                        )
+            except Exception as e:
+                logger.warning(f"Broadcast claim failed: {e}")
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=BROADCAST_POLL_INTERVAL_SEC)
+            self._wakeup.clear()
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        job_id = job['id']
+        live = self._live[job_id] = job
+        cursor = job['cursor_user_id']
+        rate = RateLimit(BROADCAST_RATE, 1)
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        progress = asyncio.create_task(self._progress_loop(live))
+        sends: Set[asyncio.Task] = set()
+        logger.info(f"Broadcast {job_id}: {'resuming after user ' + str(cursor) if cursor else 'starting'}, "
+                    f"{job['total']} recipient(s)")
+        try:
+            while job_id not in self._cancelled:
+                status = await self.db.renew_broadcast(job_id, self.owner, BROADCAST_LEASE_SEC, cursor)
+                if status != 'running':
+                    # Отменена или аренду забрал другой процесс (этот слишком долго не продлевал её)
+                    live['status'] = status or live['status']
+                    break
+                recipients = await self.db.get_broadcast_recipients(job_id, cursor, BROADCAST_PAGE_SIZE)
+                if not recipients:
+                    await self.results.flush()
+                    await self.db.finish_broadcast(job_id, self.owner)
+                    live['status'] = 'completed'
+                    logger.info(f"Broadcast {job_id} completed: sent {live['sent']}, "
+                                f"failed {live['failed']}, blocked {live['blocked']}")
+                    break
+
+                for user_id in recipients:
+                    if job_id in self._cancelled:
+                        break
+                    delay = rate.reserve(time.monotonic())
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await semaphore.acquire()
+                    sends.add(asyncio.create_task(self._send(live, user_id, semaphore)))
+                if sends:
+                    await asyncio.wait(sends)
+                    sends.clear()
+                # Позиция сдвигается после записи результатов страницы
+                await self.results.flush()
+                cursor = recipients[-1]
+            if job_id in self._cancelled:
+                live['status'] = 'cancelled'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Задача остаётся running: её подхватит поиск после истечения аренды
+            logger.error(f"Broadcast {job_id} interrupted: {e}")
+        finally:
+            # Начатые отправки (в том числе при остановке) дожидаются, чтобы их результат был записан
+            # и сообщение не ушло повторно после возобновления
+            if sends:
+                await asyncio.wait(sends)
+            progress.cancel()
+            self._jobs.pop(job_id, None)
+            self._live.pop(job_id, None)
+            self._cancelled.discard(job_id)
+            if live['status'] != 'running':
+                await self._edit_progress(live)
+
+    async def _send(self, live: Dict[str, Any], user_id: int, semaphore: asyncio.Semaphore) -> None:
+        error = None
+        try:
+            with send_priority(PRIORITY_BULK):
+                await self.bot.send_message(user_id, live['text'])
+            status = STATUS_SENT
+        except TelegramForbiddenError as e:
+            status, error = STATUS_BLOCKED, str(e)[:200]
+        except Exception as e:
+            status, error = STATUS_FAILED, str(e)[:200]
+        finally:
+            semaphore.release()
+        live[status] += 1
+        self.results.add((live['id'], user_id, status, error))
+
+    async def _progress_loop(self, live: Dict[str, Any]) -> None:
+        shown = None
+        while True:
+            counters = (live['sent'], live['failed'], live['blocked'])
+            if counters != shown:
+                await self._edit_progress(live)
+                shown = counters
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL_SEC)
+
+    async def _edit_progress(self, live: Dict[str, Any]) -> None:
+        if not live.get('progress_chat_id') or not live.get('progress_message_id'):
+            return
+        try:
+            await self.bot.edit_message_text(
+                format_progress(live),
+                chat_id=live['progress_chat_id'],
+                message_id=live['progress_message_id'],
+            )
+        except TelegramBadRequest as e:
+            # Текст не изменился или сообщение удалено
+            logger.debug(f"Broadcast {live['id']} progress not updated: {e}")
+        except Exception as e:
+            logger.warning(f"Broadcast {live['id']} progress update failed: {e}")
+
+
+# Глобальный исполнитель рассылок
+broadcaster = Broadcaster()
@@ -0,0 +1,201 @@
+"""
+Контекст диалога: последние вопросы и ответы пользователя в запросе к RAG
+
+На пользователя хранится кольцевой буфер из CONTEXT_WINDOW_TURNS последних пар «вопрос —
+ответ» о текущей машине. Буферы лежат в LRU, ограниченном CONTEXT_CACHE_MAX_BYTES: размер
+каждого буфера считается при изменении, и при превышении вытесняются давно не писавшие
+пользователи. Для пользователя, которого нет в памяти (после перезапуска или вытеснения),
+буфер загружается из rag_answers — ответы туда уже пишутся (database/answers.py), отдельной
+записи контекст не требует.
+
+В запрос попадают только пары не старше CONTEXT_MAX_AGE_SEC, от новых к старым, пока
+укладываются в CONTEXT_TOKEN_BUDGET (оценка — символов / 3 для русского текста).
+Включается на развёртывание: CONTEXT_WINDOW_ENABLED.
+"""
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+
+from database.answers import normalize_question
+from database.db import Database, db
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+CONTEXT_WINDOW_ENABLED = os.getenv('CONTEXT_WINDOW_ENABLED', '').lower() in ['true', '1', 'yes', 'on']
+# Пар «вопрос — ответ» в буфере пользователя
+CONTEXT_WINDOW_TURNS = int(os.getenv('CONTEXT_WINDOW_TURNS', 3))
+# Оценка токенов предыдущих пар, добавляемых к вопросу
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1000))
+# Более старые пары не относятся к текущему разговору
+CONTEXT_MAX_AGE_SEC = float(os.getenv('CONTEXT_MAX_AGE_SEC', 3600))
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv('CONTEXT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Символов на токен (оценка для русского текста)
+CHARS_PER_TOKEN = 3
+# Постоянная часть буфера пользователя: запись LRU, deque, ключ
+_BUFFER_OVERHEAD = sys.getsizeof(deque(maxlen=1)) + 100
+
+
+class Turn(NamedTuple):
+    question: str
+    answer: str
+    car: Optional[str]
+    at: float  # time.time()
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _turn_size(turn: Turn) -> int:
+    return sys.getsizeof(turn) + sys.getsizeof(turn.question) + sys.getsizeof(turn.answer) + sys.getsizeof(turn.car)
+
+
+class _Buffer:
+    __slots__ = ('turns', 'size')
+
+    def __init__(self, turns: Deque[Turn]):
+        self.turns = turns
+        self.size = _BUFFER_OVERHEAD + sum(_turn_size(turn) for turn in turns)
+
+
+class ConversationMemory:
+    """Последние пары «вопрос — ответ» пользователей в LRU с ограничением по памяти"""
+
+    def __init__(self, database: Database = db, enabled: bool = CONTEXT_WINDOW_ENABLED,
+                 turns: int = CONTEXT_WINDOW_TURNS, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 max_age: float = CONTEXT_MAX_AGE_SEC, max_bytes: int = CONTEXT_CACHE_MAX_BYTES):
+        self.db = database
+        self.enabled = enabled and turns > 0
+        self.turns = turns
+        self.token_budget = token_budget
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        # user_id -> буфер; порядок — от давно не обращавшихся к недавним
+        self._buffers: 'OrderedDict[int, _Buffer]' = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.loads = 0
+        self.evicted = 0
+
+    async def _buffer(self, user_id: int) -> _Buffer:
+        buffer = self._buffers.get(user_id)
+        if buffer is not None:
+            self._buffers.move_to_end(user_id)
+            self.hits += 1
+            return buffer
+        self.loads += 1
+        turns: Deque[Turn] = deque(maxlen=self.turns)
+        try:
+            rows = await self.db.recent_rag_answers(user_id, self.turns, self.max_age)
+        except Exception as e:
+            # Без истории вопрос отправляется как раньше; буфер не кэшируется, чтобы повторить загрузку
+            logger.warning(f"Failed to load conversation context for user {user_id}: {e}")
+            return _Buffer(turns)
+        now = time.time()
+        for row in reversed(rows):
+            turns.append(Turn(row['question'], row['answer'], row['car'], now - row['age_sec']))
+        # Пользователь мог уже получить ответ, пока шла загрузка
+        buffer = self._buffers.get(user_id)
+        if buffer is None:
+            buffer = _Buffer(turns)
+            self._store(user_id, buffer)
+        return buffer
+
+    def _store(self, user_id: int, buffer: _Buffer) -> None:
+        self._buffers[user_id] = buffer
+        self.bytes += buffer.size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes and len(self._buffers) > 1:
+            _, buffer = self._buffers.popitem(last=False)
+            self.bytes -= buffer.size
+            self.evicted += 1
+
+    async def context(self, user_id: int, car: Optional[str]) -> List[Turn]:
+        """Предыдущие пары о той же машине в пределах бюджета, от старых к новым"""
+        if not self.enabled:
+            return []
+        buffer = await self._buffer(user_id)
+        oldest = time.time() - self.max_age
+        car_key = normalize_question(car or '')
+        selected: List[Turn] = []
+        budget = self.token_budget
+        for turn in reversed(buffer.turns):
+            if turn.at < oldest or normalize_question(turn.car or '') != car_key:
+                break
+            cost = estimate_tokens(turn.question) + estimate_tokens(turn.answer)
+            if cost > budget:
+                break
+            budget -= cost
+            selected.append(turn)
+        selected.reverse()
+        return selected
+
+    def remember(self, user_id: int, car: Optional[str], question: str, answer: str) -> None:
+        """Новая пара в буфере пользователя (в базу ответ пишется вместе с завершением запроса)"""
+        if not self.enabled:
+            return
+        turn = Turn(question, answer, car, time.time())
+        buffer = self._buffers.get(user_id)
+        if buffer is None:
+            # Холодный пользователь: остальная история загрузится из базы при следующем вопросе
+            # не раньше, чем буфер будет вытеснен, поэтому загружать её сейчас незачем
+            self._store(user_id, _Buffer(deque([turn], maxlen=self.turns)))
+            return
+        self._buffers.move_to_end(user_id)
+        if len(buffer.turns) == buffer.turns.maxlen:
+            dropped = _turn_size(buffer.turns[0])
+            buffer.size -= dropped
+            self.bytes -= dropped
+        buffer.turns.append(turn)
+        added = _turn_size(turn)
+        buffer.size += added
+        self.bytes += added
+        self._evict()
+
+    def forget(self, user_id: int) -> None:
+        buffer = self._buffers.pop(user_id, None)
+        if buffer is not None:
+            self.bytes -= buffer.size
+
+    def snapshot(self) -> Dict[str, Any]:
+        users = len(self._buffers)
+        return {
+            'enabled': self.enabled,
+            'users': users,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'bytes_per_user': self.bytes / users if users else 0.0,
+            'hits': self.hits,
+            'loads': self.loads,
+            'evicted': self.evicted,
+        }
+
+
+def format_history(turns: List[Turn]) -> Optional[str]:
+    """Предыдущие пары в тексте запроса (None, если их нет)"""
+    if not turns:
+        return None
+    return "\n\n".join(f"Вопрос: {turn.question}\nОтвет: {turn.answer}" for turn in turns)
+
+
+def build_question(question: str, car: Optional[str], history: Optional[str]) -> str:
+    """Текст запроса к RAG: машина, предыдущие пары (format_history) и вопрос"""
+    parts = []
+    if car:
+        parts.append(f"Автомобиль пользователя: {car}")
+    if history:
+        parts.append(f"Предыдущие вопросы и ответы:\n{history}")
+    if not parts:
+        return question
+    parts.append(f"Вопрос: {question}")
+    return "\n\n".join(parts)
+
+
+# Глобальная память диалогов (handlers/user.py)
+conversation_memory = ConversationMemory()
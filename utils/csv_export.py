@@ -0,0 +1,76 @@
+"""
+Потоковая выгрузка CSV в сжатый временный файл
+"""
+import asyncio
+import csv
+import gzip
+import os
+import tempfile
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class _GzipCsvFile:
+    """CSV-файл в gzip; все методы вызываются в рабочем потоке"""
+
+    def __init__(self, header: Sequence[str]):
+        fd, self.path = tempfile.mkstemp(prefix='export_', suffix='.csv.gz')
+        os.close(fd)
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+
+    def write_rows(self, rows: Iterable[Sequence[Any]]) -> None:
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+async def export_csv_gz(header: Sequence[str],
+                        chunks: AsyncIterator[List[Any]],
+                        row_fn: Optional[Callable[[Any], Sequence[Any]]] = None) -> Tuple[str, int]:
+    """
+    Выгрузка строк в gzip-CSV без накопления всей таблицы в памяти
+
+    Args:
+        header: Заголовок CSV
+        chunks: Асинхронный итератор пачек строк (например, курсор БД)
+        row_fn: Преобразование строки в список значений (выполняется в рабочем потоке)
+
+    Returns:
+        Кортеж (путь к временному файлу, количество строк). Файл удаляет вызывающий код.
+    """
+    output = await asyncio.to_thread(_GzipCsvFile, header)
+    rows_written = 0
+    try:
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                rows = chunk if row_fn is None else map(row_fn, chunk)
+                # Форматирование, кодирование и сжатие — вне event loop
+                await asyncio.to_thread(output.write_rows, rows)
+                rows_written += len(chunk)
+    except BaseException:
+        await asyncio.to_thread(output.close)
+        remove_export(output.path)
+        raise
+    await asyncio.to_thread(output.close)
+    logger.debug(f"CSV export written: {rows_written} rows, {output.path}")
+    return output.path, rows_written
+
+
+async def single_chunk(rows: List[Any]) -> AsyncIterator[List[Any]]:
+    """Асинхронный итератор из одной готовой пачки строк"""
+    yield rows
+
+
+def remove_export(path: str) -> None:
+    """Удаление временного файла выгрузки"""
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove export file {path}: {e}")
@@ -1,7 +1,12 @@
 import re
+import asyncio
 import base64
+import hashlib
+import signal
 import urllib.parse
-from typing import Optional, Tuple, List
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta
+from typing import Iterator, Optional, Tuple, List
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 def parse_command_args(text: str) -> Tuple[str, List[str]]:
@@ -191,3 +196,82 @@ def validate_deep_link_params(params_str: str) -> bool:
     keys = [p.split('=')[0] for p in params_str.split('&') if '=' in p]
     
     return all(key in keys for key in required_keys)
+
+_EPOCH = datetime(1970, 1, 1)
+
+def datetime_to_cursor(value: datetime) -> int:
+    """
+    Перевод метки времени в целое число микросекунд (для компактной callback_data)
+    
+    Args:
+        value: Метка времени без часового пояса
+        
+    Returns:
+        Количество микросекунд от эпохи
+    """
+    return (value.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+
+def cursor_to_datetime(value: int) -> datetime:
+    """
+    Обратное преобразование микросекунд в метку времени
+    
+    Args:
+        value: Количество микросекунд от эпохи
+        
+    Returns:
+        Метка времени без часового пояса
+    """
+    return _EPOCH + timedelta(microseconds=value)
+
+def format_age(seconds: float) -> str:
+    """
+    Возраст для пользователя: «5 мин», «3 ч», «2 дн.»
+    
+    Args:
+        seconds: Возраст в секундах
+        
+    Returns:
+        Округлённый вниз возраст в наибольших целых единицах
+    """
+    if seconds < 3600:
+        return f"{max(1, int(seconds // 60))} мин"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч"
+    return f"{int(seconds // 86400)} дн."
+
+def temp_user_id(username: str) -> int:
+    """
+    Временный user_id для пользователя, добавленного по @username
+    
+    Детерминированный (не зависит от процесса, в отличие от hash()) и всегда меньше -1,
+    поэтому не пересекается с реальными ID Telegram и со старым временным ID -1.
+    
+    Args:
+        username: Username с @ или без
+        
+    Returns:
+        Отрицательный идентификатор в пределах BIGINT
+    """
+    normalized = username.lstrip('@').lower().encode('utf-8')
+    digest = hashlib.blake2b(normalized, digest_size=8).digest()
+    return -(int.from_bytes(digest, 'big') & ((1 << 62) - 1)) - 2
+
+@contextmanager
+def stop_on_signals(stop: asyncio.Event) -> Iterator[asyncio.Event]:
+    """
+    Установка события stop по SIGTERM/SIGINT на время блока
+    
+    Args:
+        stop: Событие, которого ждёт основной цикл режима запуска
+    """
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # На Windows обработчики сигналов не поддерживаются
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        yield stop
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with suppress(NotImplementedError):
+                loop.remove_signal_handler(sig)
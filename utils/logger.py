@@ -1,17 +1,136 @@
 """
 Модуль для настройки логирования
+
+Записи передаются через очередь (QueueHandler) в поток QueueListener: форматирование
+и вывод в stdout и файл не задерживают цикл событий. Сообщения форматируются только
+в потоке записи, поэтому в горячих местах используется %-форматирование
+(logger.info("... %s", value)) — отброшенная по уровню запись не форматируется вовсе.
+
+LOG_JSON — вывод по JSON-объекту на строку (поля extra=... попадают в объект).
+LOG_FILE — дополнительная запись в ротируемый файл (в Docker — примонтированный ./logs).
+LOG_RATE_LIMIT (по умолчанию выключено) — одинаковые сообщения одного места кода
+ограничиваются LOG_RATE_LIMIT за окно LOG_RATE_LIMIT_WINDOW_SEC; сверх лимита проходит
+каждая LOG_RATE_LIMIT_SAMPLE-я, а число пропущенных указывается в следующей такой записи.
 """
+import atexit
+import json
 import logging
 import os
 import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from typing import Dict, List, Optional, Tuple
+
+# Атрибуты LogRecord, не относящиеся к extra=...
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'suppressed'}
+
+_listener: Optional[QueueListener] = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничение повторяющихся сообщений: ключ — место вызова (логгер, файл, строка) и текст
+
+    Разные события одного места (другой пользователь, другой запрос) не ограничиваются,
+    отбрасываются только повторы одного и того же сообщения. Ошибки уровня ERROR и выше
+    не ограничиваются.
+    """
+
+    def __init__(self, limit: int, window: float, sample: int):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.sample = sample
+        # (место вызова, текст) -> [начало окна, записей в окне, пропущено]
+        self._sites: Dict[Tuple[str, str, int, str], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        try:
+            message = record.getMessage()
+        except Exception:
+            # Ошибку аргументов покажет обработчик при выводе
+            message = str(record.msg)
+        key = (record.name, record.pathname, record.lineno, message)
+        now = time.monotonic()
+        site = self._sites.get(key)
+        if site is None or now - site[0] >= self.window:
+            if len(self._sites) > 10000:
+                # Ограничение памяти: текстов сообщений может быть сколько угодно
+                self._sites.clear()
+            suppressed = site[2] if site is not None else 0
+            site = self._sites[key] = [now, 0, 0]
+        else:
+            suppressed = site[2]
+        site[1] += 1
+        if site[1] > self.limit and not (self.sample and (site[1] - self.limit) % self.sample == 0):
+            site[2] += 1
+            return False
+        if suppressed:
+            record.suppressed = suppressed
+            site[2] = 0
+        return True
+
+
+class _AsyncQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование выполняется в потоке записи; исключение — в виде текста,
+        # чтобы не держать кадры стека до записи
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f" [{suppressed} similar message(s) suppressed]"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """JSON-объект на запись: время, уровень, логгер, сообщение, поля extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
 
 
 def setup_logging():
     """Настройка системы логирования"""
+    global _listener
     # Получаем настройки из переменных окружения
     log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
     log_format = os.getenv('LOG_FORMAT', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
+    log_json = os.getenv('LOG_JSON', '').lower() in ['true', '1', 'yes', 'on']
+    log_file = os.getenv('LOG_FILE', '')
+    log_file_max_bytes = int(os.getenv('LOG_FILE_MAX_BYTES', 50 * 1024 * 1024))
+    log_file_backups = int(os.getenv('LOG_FILE_BACKUPS', 5))
+    rate_limit = int(os.getenv('LOG_RATE_LIMIT', 0))
+    rate_limit_window = float(os.getenv('LOG_RATE_LIMIT_WINDOW_SEC', 60))
+    rate_limit_sample = int(os.getenv('LOG_RATE_LIMIT_SAMPLE', 100))
+
     # Преобразуем строку уровня в константу logging
     level_mapping = {
         'DEBUG': logging.DEBUG,
@@ -20,38 +139,67 @@ def setup_logging():
         'ERROR': logging.ERROR,
         'CRITICAL': logging.CRITICAL
     }
-    
+
     log_level_value = level_mapping.get(log_level, logging.INFO)
-    
+
     # Настраиваем форматтер
-    formatter = logging.Formatter(log_format)
-    
+    formatter = JsonFormatter() if log_json else TextFormatter(log_format)
+
     # Настраиваем root logger
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level_value)
-    
-    # Очищаем существующие обработчики
+
+    # Очищаем существующие обработчики (и останавливаем поток записи при повторной настройке)
+    shutdown_logging()
     for handler in root_logger.handlers[:]:
         root_logger.removeHandler(handler)
-    
-    # Только обработчик для консоли (stdout)
+
+    # Обработчики вывода работают в потоке записи
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(log_level_value)
     console_handler.setFormatter(formatter)
-    root_logger.addHandler(console_handler)
-    
+    handlers = [console_handler]
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = RotatingFileHandler(log_file, maxBytes=log_file_max_bytes,
+                                           backupCount=log_file_backups, encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    queue: SimpleQueue = SimpleQueue()
+    _listener = QueueListener(queue, *handlers)
+    _listener.start()
+    queue_handler = _AsyncQueueHandler(queue)
+    queue_handler.setLevel(log_level_value)
+    if rate_limit > 0:
+        queue_handler.addFilter(RateLimitFilter(rate_limit, rate_limit_window, rate_limit_sample))
+    root_logger.addHandler(queue_handler)
+
     # Настраиваем уровни для конкретных логгеров
     logging.getLogger('aiogram').setLevel(logging.WARNING)
     logging.getLogger('aiohttp').setLevel(logging.WARNING)
     logging.getLogger('asyncpg').setLevel(logging.WARNING)
-    
+
     # Логируем информацию о настройке
     logger = logging.getLogger(__name__)
-    logger.info(f"Logging configured - Level: {log_level}, Output: stdout only")
-    
+    logger.info(f"Logging configured - Level: {log_level}, Format: {'json' if log_json else 'text'}, "
+                f"Output: stdout{', ' + log_file if log_file else ''}")
+
     return logger
 
 
+def shutdown_logging() -> None:
+    """Запись оставшихся сообщений и остановка потока записи (при завершении процесса)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
 def get_logger(name: str) -> logging.Logger:
     """Получение логгера с указанным именем"""
     return logging.getLogger(name)
@@ -0,0 +1,133 @@
+"""
+Задержка цикла событий и поиск блокирующего кода
+
+Задача в цикле событий каждые LOOP_MONITOR_INTERVAL_SEC засыпает и замеряет, насколько
+позже срока проснулась — это задержка планирования любой готовой задачи. Замеры идут
+в метрики Prometheus и в кольцевой буфер для p50/p99 в /load.
+
+Блокирующий код (синхронный CSV, запись в файл, тяжёлый цикл) замер увидит только после
+того, как цикл освободится, — тогда уже неизвестно, кто виноват. Поэтому отдельный поток
+следит за отметкой, которую ставит задача замера: если она не обновлялась дольше
+LOOP_LAG_WARN_SEC, поток снимает стек потока цикла событий (sys._current_frames) и пишет его
+в лог вместе с именем выполняемой задачи — это и есть код, который держит цикл.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from utils.logger import get_logger
+from utils.metrics import LOOP_LAG_HISTOGRAM, LOOP_LAG_SECONDS
+
+logger = get_logger(__name__)
+
+# Период замера задержки цикла событий
+LOOP_MONITOR_INTERVAL_SEC = float(os.getenv('LOOP_MONITOR_INTERVAL_SEC', 0.5))
+# Задержка, при которой в лог пишется стек блокирующего кода (0 — не следить)
+LOOP_LAG_WARN_SEC = float(os.getenv('LOOP_LAG_WARN_SEC', 0.5))
+# Замеров в буфере для процентилей (при периоде 0.5 с — последние 10 минут)
+LOOP_LAG_SAMPLES = 1200
+# Кадров стека в сообщении
+STACK_LIMIT = 25
+
+
+class LoopWatchdog:
+    """Замер задержки цикла событий и стек кода, блокирующего цикл"""
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL_SEC, warn_after: float = LOOP_LAG_WARN_SEC):
+        self.interval = interval
+        self.warn_after = warn_after
+        self._samples: Deque[float] = deque(maxlen=LOOP_LAG_SAMPLES)
+        self._sampler: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id = 0
+        # Момент последнего пробуждения задачи замера (time.monotonic, пишет цикл, читает поток)
+        self._heartbeat = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.last_stall: Optional[Dict[str, Any]] = None
+
+    def start(self) -> None:
+        """Запуск замера (и потока наблюдения) в текущем цикле событий"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._sampler = asyncio.create_task(self._sample(), name="loop-monitor")
+        if self.warn_after > 0:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+        logger.info(f"Event loop monitor started ({type(self._loop).__module__}): sampling every "
+                    f"{self.interval}s, stack dump after {self.warn_after}s of lag")
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.cancel()
+            await asyncio.gather(self._sampler, return_exceptions=True)
+            self._sampler = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            lag = max(0.0, loop.time() - started - self.interval)
+            self._samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.set(lag)
+            LOOP_LAG_HISTOGRAM.observe(lag)
+
+    def _watch(self) -> None:
+        """Поток наблюдения: один стек на каждую остановку цикла"""
+        reported = 0.0
+        check_every = min(self.interval, self.warn_after) / 2
+        while not self._stopped.wait(check_every):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled >= self.warn_after and heartbeat != reported:
+                reported = heartbeat
+                self._report(stalled)
+
+    def _report(self, stalled: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = ''.join(traceback.format_stack(frame, limit=STACK_LIMIT))
+        # current_task читает словарь текущих задач цикла и безопасна для чтения из другого потока
+        task = asyncio.current_task(self._loop)
+        task_name = task.get_name() if task is not None else 'callback (not a task)'
+        self.stalls += 1
+        self.last_stall = {'at': time.time(), 'lag': stalled, 'task': task_name,
+                           'where': stack.strip().splitlines()[-2].strip() if stack else ''}
+        logger.warning(f"Event loop blocked for {stalled:.2f}s+ in {task_name}, stack:\n{stack}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        samples = sorted(self._samples)
+
+        def percentile(fraction: float) -> float:
+            return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000 if samples else 0.0
+
+        return {
+            'loop': type(self._loop).__module__ if self._loop is not None else None,
+            'samples': len(samples),
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+            'max_ms': self.max_lag * 1000,
+            'stalls': self.stalls,
+            'last_stall': self.last_stall,
+        }
+
+
+# Глобальный монитор цикла событий (запускается в bot.py)
+loop_watchdog = LoopWatchdog()
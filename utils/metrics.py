@@ -0,0 +1,339 @@
+"""
+Метрики процесса в формате Prometheus
+
+Значения хранятся в объектах со __slots__ и меняются обычным присваиванием: всё выполняется
+в одном цикле событий, блокировки не нужны. Дочерние метрики с метками создаются один раз
+и кэшируются, поэтому на горячем пути — поиск в словаре и сложение, без новых объектов.
+Значения, которые уже считают другие модули (пулы БД, планировщик, лимиты Telegram), читаются
+при запросе /metrics.
+
+Сервер запускается в bot.py, если задан METRICS_PORT.
+"""
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Порт HTTP-сервера метрик (0 — не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+
+# Границы корзин гистограмм, секунды
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SLOW_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+# События, обработчики которых учитываются (остальные роутеры не используют)
+HANDLER_EVENTS = ('message', 'callback_query')
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def sync(self, value: float) -> None:
+        """Значение счётчика, который ведёт другой модуль (читается при запросе /metrics)"""
+        self.value = value
+
+
+class GaugeValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class HistogramValue:
+    """Гистограмма: счётчики корзин (не накопительные, суммируются при выводе), сумма и количество"""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # Последняя корзина — +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricFamily:
+    """Метрика с набором меток; labels(...) возвращает кэшированное значение"""
+
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Tuple[float, ...] = ()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str) -> Any:
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            if self.kind == 'counter':
+                child = CounterValue()
+            elif self.kind == 'gauge':
+                child = GaugeValue()
+            else:
+                child = HistogramValue(self.buckets)
+            self._children[values] = child
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._children.items():
+            if self.kind != 'histogram':
+                lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_number(child.value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(child.bounds + (float('inf'),), child.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_number(bound)
+                labels = _format_labels(self.labelnames, values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_number(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families: List[MetricFamily] = []
+        # Обновление метрик из состояния других модулей перед выводом
+        self._collectors: List[Callable[[], None]] = []
+
+    def _add(self, family: MetricFamily) -> MetricFamily:
+        self._families.append(family)
+        return family
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> MetricFamily:
+        return self._add(MetricFamily('counter', name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> MetricFamily:
+        return self._add(MetricFamily('gauge', name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Tuple[float, ...] = FAST_BUCKETS) -> MetricFamily:
+        return self._add(MetricFamily('histogram', name, documentation, labelnames, tuple(buckets)))
+
+    def collector(self, callback: Callable[[], None]) -> None:
+        self._collectors.append(callback)
+
+    def render(self) -> str:
+        for callback in self._collectors:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Metrics collector {callback.__name__} failed: {e}")
+        lines: List[str] = []
+        for family in self._families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+# --- Обработчики ---
+HANDLER_UPDATES = registry.counter(
+    'carbot_handler_updates_total', 'Updates handled, by handler and outcome', ('handler', 'outcome'))
+HANDLER_SECONDS = registry.histogram(
+    'carbot_handler_duration_seconds', 'Handler execution time', ('handler',), SLOW_BUCKETS)
+
+# --- RAG ---
+RAG_CREATE_SECONDS = registry.histogram(
+    'carbot_rag_create_seconds', 'RAG request creation latency', buckets=REQUEST_BUCKETS).labels()
+RAG_ANSWER_SECONDS = registry.histogram(
+    'carbot_rag_answer_seconds', 'Time from RAG request creation to final status', buckets=SLOW_BUCKETS).labels()
+RAG_POLLS = registry.histogram(
+    'carbot_rag_polls', 'Status polls per RAG request', buckets=COUNT_BUCKETS).labels()
+RAG_REQUESTS = registry.counter(
+    'carbot_rag_requests_total', 'RAG requests by outcome', ('outcome',))
+RAG_STALE_ANSWERS = registry.counter(
+    'carbot_rag_stale_answers_total', 'Stored answers served when RAG was slow or failed, and misses', ('reason',))
+RAG_STALE_AGE_SECONDS = registry.histogram(
+    'carbot_rag_stale_age_seconds', 'Age of stored answers served instead of RAG',
+    buckets=(3600.0, 6 * 3600.0, 86400.0, 3 * 86400.0, 7 * 86400.0, 14 * 86400.0, 30 * 86400.0)).labels()
+RAG_REFRESHES = registry.counter(
+    'carbot_rag_refreshes_total', 'Background refreshes of answers served from storage', ('outcome',))
+
+# --- База данных ---
+DB_QUERY_SECONDS = registry.histogram(
+    'carbot_db_query_seconds', 'Registry statement latency including network round trip', ('statement',))
+DB_POOL_CONNECTIONS = registry.gauge(
+    'carbot_db_pool_connections', 'Pool connections by state', ('pool', 'state'))
+
+# --- Telegram ---
+TELEGRAM_REQUEST_SECONDS = registry.histogram(
+    'carbot_telegram_request_seconds', 'Telegram API request latency including rate limiter wait',
+    ('method',), REQUEST_BUCKETS)
+TELEGRAM_LIMITER = registry.gauge(
+    'carbot_telegram_limiter', 'Outbound rate limiter queue size and chats tracked', ('kind',))
+TELEGRAM_LIMITER_EVENTS = registry.counter(
+    'carbot_telegram_limiter_events_total', 'Outbound rate limiter events since start', ('kind',))
+
+# --- Планировщик и защита от флуда ---
+SCHEDULER_LANE = registry.gauge(
+    'carbot_scheduler_lane', 'Handler lane slots', ('lane', 'state'))
+SCHEDULER_PENDING = registry.gauge(
+    'carbot_scheduler_pending_updates', 'Updates admitted and not finished').labels()
+THROTTLED_UPDATES = registry.counter(
+    'carbot_throttled_updates_total', 'Updates dropped by flood protection since start', ('reason',))
+CONVERSATION_MEMORY = registry.gauge(
+    'carbot_conversation_memory', 'Conversation context cache: users and bytes', ('kind',))
+CONVERSATION_LOOKUPS = registry.counter(
+    'carbot_conversation_lookups_total', 'Conversation context lookups and evictions since start', ('kind',))
+
+# --- Цикл событий ---
+LOOP_LAG_SECONDS = registry.gauge(
+    'carbot_event_loop_lag_seconds', 'Last measured event loop scheduling delay').labels()
+LOOP_LAG_HISTOGRAM = registry.histogram(
+    'carbot_event_loop_lag_histogram_seconds', 'Event loop scheduling delay').labels()
+
+
+def _collect_runtime() -> None:
+    """Состояние пулов БД, планировщика, лимитов Telegram, защиты от флуда и контекста диалогов"""
+    from database.db import db
+    from utils.scheduler import scheduler
+    from utils.telegram_limiter import telegram_limiter
+    from utils.conversation import conversation_memory
+    from utils.throttling import throttling
+
+    for name, pool in db.pool_stats().items():
+        DB_POOL_CONNECTIONS.labels(name, 'in_use').set(pool['size'] - pool['idle'])
+        DB_POOL_CONNECTIONS.labels(name, 'idle').set(pool['idle'])
+        DB_POOL_CONNECTIONS.labels(name, 'max').set(pool['max_size'])
+
+    stats = scheduler.snapshot()
+    SCHEDULER_PENDING.set(stats['pending'])
+    for name, lane in {**stats['lanes'], 'rag_wait': stats['rag_wait']}.items():
+        SCHEDULER_LANE.labels(name, 'active').set(lane['active'])
+        SCHEDULER_LANE.labels(name, 'waiting').set(lane['waiting'])
+        SCHEDULER_LANE.labels(name, 'limit').set(lane['limit'])
+
+    telegram = telegram_limiter.snapshot()
+    for kind in ('sent', 'throttled', 'retry_after', 'failed'):
+        TELEGRAM_LIMITER_EVENTS.labels(kind).sync(telegram[kind])
+    for kind in ('queued', 'chats'):
+        TELEGRAM_LIMITER.labels(kind).set(telegram[kind])
+
+    flood = throttling.snapshot()
+    THROTTLED_UPDATES.labels('rate').sync(flood['throttled'])
+    THROTTLED_UPDATES.labels('duplicate').sync(flood['duplicates'])
+
+    memory = conversation_memory.snapshot()
+    for kind in ('users', 'bytes', 'max_bytes', 'bytes_per_user'):
+        CONVERSATION_MEMORY.labels(kind).set(memory[kind])
+    for kind in ('hits', 'loads', 'evicted'):
+        CONVERSATION_LOOKUPS.labels(kind).sync(memory[kind])
+
+
+registry.collector(_collect_runtime)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Inner-middleware: количество и время выполнения по обработчикам"""
+
+    def __init__(self):
+        # Имя обработчика -> (успешные, ошибки, время)
+        self._children: Dict[str, Tuple[CounterValue, CounterValue, HistogramValue]] = {}
+
+    def setup(self, dp: Dispatcher) -> None:
+        # Inner-middleware диспетчера применяются и к обработчикам вложенных роутеров
+        for event in HANDLER_EVENTS:
+            dp.observers[event].middleware(self)
+
+    def _children_for(self, name: str) -> Tuple[CounterValue, CounterValue, HistogramValue]:
+        children = self._children.get(name)
+        if children is None:
+            children = (HANDLER_UPDATES.labels(name, 'ok'), HANDLER_UPDATES.labels(name, 'error'),
+                        HANDLER_SECONDS.labels(name))
+            self._children[name] = children
+        return children
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        ok, error, seconds = self._children_for(data['handler'].callback.__name__)
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            error.inc()
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - started)
+        ok.inc()
+        return result
+
+
+handler_metrics = HandlerMetrics()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+class MetricsServer:
+    """HTTP-сервер /metrics"""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics server listening on {self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,243 @@
+"""
+Профилирование по команде администратора (/profile)
+
+Пока профилирование не запущено, ничего не установлено: нет потока, sys.setprofile
+и tracemalloc, поэтому накладных расходов нет. Одновременно выполняется один замер.
+
+- cpu — семплирующий профилировщик: поток раз в PROFILE_SAMPLE_INTERVAL_SEC снимает стек
+  потока цикла событий (sys._current_frames). Нагрузка мала и не зависит от числа вызовов;
+  ожидание ввода-вывода (цикл спит в select) считается отдельно.
+- cprofile — cProfile на потоке цикла событий: точное число вызовов всех обработчиков,
+  но заметно замедляет бота на время замера.
+- mem — tracemalloc: прирост памяти по местам выделения за время замера и крупнейшие
+  места выделения.
+- tasks — задачи asyncio, сгруппированные по корутине и месту ожидания.
+
+Отчёт пишется во временный файл в рабочем потоке и отправляется документом.
+"""
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Any, List, Optional, Set
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Длительность замера по умолчанию и наибольшая
+PROFILE_DEFAULT_SEC = 30
+PROFILE_MAX_SEC = int(os.getenv('PROFILE_MAX_SEC', 300))
+# Период снятия стека семплирующим профилировщиком
+PROFILE_SAMPLE_INTERVAL_SEC = float(os.getenv('PROFILE_SAMPLE_INTERVAL_SEC', 0.005))
+# Глубина стека мест выделения памяти
+PROFILE_TRACEMALLOC_FRAMES = 10
+# Строк в таблицах отчёта
+REPORT_TOP = 40
+
+# Функции, в которых цикл событий ждёт ввода-вывода (у uvloop цикл на C, сверху остаётся Runner.run)
+_IDLE_FUNCTIONS = {('selectors.py', 'select'), ('selectors.py', 'poll'), ('runners.py', 'run')}
+
+
+def _frame_key(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfilerBusy(Exception):
+    """Замер уже выполняется"""
+
+
+class Profiler:
+    """Замеры по команде; результат — путь к временному файлу отчёта"""
+
+    def __init__(self):
+        self.running: Optional[str] = None
+        self._started_at = 0.0
+        self._background: Set[asyncio.Task] = set()
+
+    def status(self) -> Optional[str]:
+        if self.running is None:
+            return None
+        return f"{self.running}, идёт {time.monotonic() - self._started_at:.0f} с"
+
+    def spawn(self, coro: Any) -> None:
+        """Замер с отправкой отчёта в фоне: обработчик команды не держит слот планировщика"""
+        task = asyncio.create_task(coro, name="profile")
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def run(self, kind: str, seconds: float) -> str:
+        """Замер kind ('cpu', 'cprofile', 'mem', 'tasks'); возвращает путь к отчёту"""
+        runners = {
+            'cpu': self._sample_cpu,
+            'cprofile': self._cprofile,
+            'mem': self._memory,
+            'tasks': self._tasks,
+        }
+        if kind not in runners:
+            raise ValueError(f"Unknown profile kind: {kind}")
+        if self.running is not None:
+            raise ProfilerBusy(self.running)
+        seconds = max(1.0, min(float(seconds), PROFILE_MAX_SEC))
+        self.running = kind
+        self._started_at = time.monotonic()
+        logger.info(f"Profiling started: {kind} for {seconds:.0f}s")
+        try:
+            title = f"{kind} profile, {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            report = await runners[kind](seconds)
+            return await asyncio.to_thread(_write_report, kind, f"# {title}\n\n{report}")
+        finally:
+            logger.info(f"Profiling finished: {kind} after {time.monotonic() - self._started_at:.1f}s")
+            self.running = None
+
+    async def _sample_cpu(self, seconds: float) -> str:
+        loop_thread = threading.get_ident()
+        stop = threading.Event()
+        stacks: Counter = Counter()
+        counts = {'samples': 0, 'idle': 0}
+
+        def sample() -> None:
+            while not stop.wait(PROFILE_SAMPLE_INTERVAL_SEC):
+                frame = sys._current_frames().get(loop_thread)
+                if frame is None:
+                    continue
+                counts['samples'] += 1
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FUNCTIONS:
+                    counts['idle'] += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_key(frame))
+                    frame = frame.f_back
+                stacks[tuple(reversed(stack))] += 1
+
+        thread = threading.Thread(target=sample, name="profiler-sampler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.to_thread(thread.join)
+        return await asyncio.to_thread(_format_samples, stacks, counts['samples'], counts['idle'], seconds)
+
+    async def _cprofile(self, seconds: float) -> str:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+
+        def format_stats() -> str:
+            output = io.StringIO()
+            stats = pstats.Stats(profile, stream=output)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_TOP)
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(REPORT_TOP)
+            return output.getvalue()
+
+        return await asyncio.to_thread(format_stats)
+
+    async def _memory(self, seconds: float) -> str:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+        return await asyncio.to_thread(_format_memory, before, after, current, peak, seconds)
+
+    async def _tasks(self, seconds: float) -> str:
+        # Снимок мгновенный: длительность не используется
+        groups: Counter = Counter()
+        for task in asyncio.all_tasks():
+            coro = task.get_coro()
+            name = getattr(coro, '__qualname__', type(coro).__name__)
+            frames = task.get_stack(limit=1)
+            waiting = (f"{os.path.basename(frames[0].f_code.co_filename)}:{frames[0].f_lineno}"
+                       if frames else 'not started')
+            groups[(name, waiting)] += 1
+        by_coro: Counter = Counter()
+        for (name, _), count in groups.items():
+            by_coro[name] += count
+        lines = [f"Tasks: {sum(groups.values())}", "", "By coroutine:"]
+        lines += [f"{count:8d}  {name}" for name, count in by_coro.most_common()]
+        lines += ["", "By coroutine and await location:"]
+        lines += [f"{count:8d}  {name}  @ {waiting}" for (name, waiting), count in groups.most_common()]
+        return "\n".join(lines) + "\n"
+
+
+def _format_samples(stacks: Counter, samples: int, idle: int, seconds: float) -> str:
+    busy = samples - idle
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for function in set(stack):
+            total[function] += count
+
+    def table(counter: Counter) -> List[str]:
+        return [f"{count:8d} {count * 100 / busy:6.1f}%  {function}" for function, count in counter.most_common(REPORT_TOP)]
+
+    lines = [
+        f"Duration {seconds:.0f}s, {samples} samples every {PROFILE_SAMPLE_INTERVAL_SEC * 1000:g}ms: "
+        f"busy {busy} ({busy * 100 / max(samples, 1):.1f}%), idle in I/O wait {idle}",
+        "",
+    ]
+    if not busy:
+        return "\n".join(lines + ["The event loop was idle for the whole profile."]) + "\n"
+    lines += ["Self time (function on top of the stack), % of busy samples:"] + table(own)
+    lines += ["", "Total time (function anywhere in the stack), % of busy samples:"] + table(total)
+    # Формат collapsed stacks для flamegraph.pl / speedscope
+    lines += ["", "Collapsed stacks:"]
+    lines += [f"{';'.join(stack)} {count}" for stack, count in stacks.most_common()]
+    return "\n".join(lines) + "\n"
+
+
+def _format_memory(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot,
+                   current: int, peak: int, seconds: float) -> str:
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    before = before.filter_traces(filters)
+    after = after.filter_traces(filters)
+    lines = [f"Traced memory: current {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB "
+             f"(only allocations made while tracing)", ""]
+    lines.append(f"Growth over {seconds:.0f}s by allocation site:")
+    for stat in after.compare_to(before, 'lineno')[:REPORT_TOP]:
+        lines.append(f"  {stat}")
+    lines += ["", "Largest allocation sites:"]
+    for stat in after.statistics('traceback')[:REPORT_TOP // 4]:
+        lines.append(f"  {stat.size / 1024:.1f} KiB in {stat.count} block(s)")
+        lines += [f"    {line}" for line in stat.traceback.format()]
+    return "\n".join(lines) + "\n"
+
+
+def _write_report(kind: str, text: str) -> str:
+    fd, path = tempfile.mkstemp(prefix=f'profile_{kind}_', suffix='.txt')
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return path
+
+
+def remove_report(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Failed to remove profile report {path}: {e}")
+
+
+# Глобальный профилировщик (команда /profile)
+profiler = Profiler()
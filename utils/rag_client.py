@@ -1,11 +1,40 @@
 import aiohttp
 import asyncio
+import contextvars
 import os
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, NamedTuple, Set, Tuple
+from database.answers import QuestionContext, lookup_key
 from utils.logger import get_logger
+from utils.metrics import (RAG_ANSWER_SECONDS, RAG_CREATE_SECONDS, RAG_POLLS, RAG_REFRESHES, RAG_REQUESTS,
+                           RAG_STALE_AGE_SECONDS, RAG_STALE_ANSWERS)
+from utils.scheduler import scheduler
+from utils.shutdown import ReplyTarget, shutdown
+from utils.tracing import SPAN_RAG_CREATE, SPAN_RAG_POLL, SPAN_RAG_SLEEP, add_span
 
 logger = get_logger(__name__)
 
+# Счётчики исходов запросов для /metrics
+RAG_OUTCOMES = {
+    outcome: RAG_REQUESTS.labels(outcome)
+    for outcome in ('success', 'failed', 'error', 'timeout', 'interrupted', 'create_failed')
+}
+STALE_REASONS = {reason: RAG_STALE_ANSWERS.labels(reason) for reason in ('slow', 'failed', 'miss')}
+REFRESH_OUTCOMES = {outcome: RAG_REFRESHES.labels(outcome) for outcome in ('success', 'failed', 'skipped')}
+
+# Сохранённый ответ отдаётся, если RAG API не ответил за это время (0 — только при ошибке)
+RAG_LATENCY_BUDGET_SEC = float(os.getenv('RAG_LATENCY_BUDGET_SEC', 60))
+# Наибольший возраст сохранённого ответа, который можно отдать (0 — не отдавать)
+RAG_STALE_MAX_AGE_DAYS = float(os.getenv('RAG_STALE_MAX_AGE_DAYS', 30))
+
+
+class RAGAnswer(NamedTuple):
+    """Ответ пользователю: от RAG API или сохранённый (cached) возрастом age_sec"""
+    text: str
+    cached: bool = False
+    age_sec: float = 0.0
+
+
 class RAGClient:
     def __init__(self):
         self.api_url = os.getenv('RAG_API_URL')
@@ -13,6 +42,15 @@ class RAGClient:
         self.poll_interval = int(os.getenv('RAG_POLL_INTERVAL_SEC', 3))
         self.max_attempts = int(os.getenv('RAG_MAX_ATTEMPTS', 100))
         self.test_mode = os.getenv('RAG_TEST', '').lower() in ['true', '1', 'yes', 'on']
+        self.latency_budget = RAG_LATENCY_BUDGET_SEC
+        self.stale_max_age = RAG_STALE_MAX_AGE_DAYS * 86400
+        # Фоновые обновления сохранённых ответов: задачи и ключи вопросов, которые уже обновляются
+        self._refreshes: Set[asyncio.Task] = set()
+        self._refreshing: Dict[bytes, int] = {}
+        self.stale_served = 0
+        self.stale_age_max = 0.0
+        # Общая HTTP-сессия (пул соединений к API); закрывается при остановке бота
+        self._session: Optional[aiohttp.ClientSession] = None
         
         if self.test_mode:
             logger.info("RAG is running in TEST MODE - will return test responses")
@@ -21,7 +59,123 @@ class RAGClient:
             if not self.api_url or not self.api_key:
                 raise ValueError("RAG_API_URL and RAG_API_KEY environment variables are required")
     
-    async def send_request(self, text: str, user_id: int, username: str = None) -> Optional[str]:
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+    
+    async def close(self) -> None:
+        """Закрытие HTTP-сессии (после завершения всех ожиданий)"""
+        # Фоновые обновления не сохраняются для возобновления: ответ уже доставлен
+        for task in self._refreshes:
+            task.cancel()
+        if self._refreshes:
+            await asyncio.gather(*self._refreshes, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+    
+    async def answer(self, text: str, user_id: int, username: str = None,
+                     reply_to: Optional[ReplyTarget] = None,
+                     context: Optional[QuestionContext] = None) -> Optional[RAGAnswer]:
+        """
+        Ответ на вопрос с запасным путём на время деградации RAG API
+
+        Если RAG API не ответил за RAG_LATENCY_BUDGET_SEC или вернул ошибку, отдаётся последний
+        сохранённый ответ на такой же вопрос для такой же машины (не старше RAG_STALE_MAX_AGE_DAYS),
+        а свежий ответ сохраняется в фоне: при превышении времени — продолжением того же
+        запроса, при ошибке — новым запросом. Без сохранённого ответа ожидание продолжается как обычно.
+        Вопрос с историей разговора (context.history) зависит от неё, и запасного пути у него нет.
+        """
+        if context is None or context.history or self.test_mode or self.stale_max_age <= 0:
+            response = await self.send_request(text, user_id, username, reply_to=reply_to, context=context)
+            return RAGAnswer(response) if response else None
+        
+        # Запрос в дочерней задаче: при превышении времени он продолжается после ответа пользователю.
+        # Пока обработчик ждёт, остановка бота сохраняет ожидание по задаче обработчика
+        request = asyncio.create_task(self.send_request(
+            text, user_id, username, reply_to=reply_to, context=context, owner=asyncio.current_task()))
+        try:
+            done, _ = await asyncio.wait({request}, timeout=self.latency_budget or None)
+            if done:
+                response = request.result()
+                if response:
+                    return RAGAnswer(response)
+                stale = await self._stale_answer(context, 'failed')
+                if stale is not None:
+                    self._refresh(lookup_key(*context),
+                                  self.send_request(text, user_id, username, context=context))
+                return stale
+            
+            stale = await self._stale_answer(context, 'slow')
+            if stale is not None:
+                self._refresh(lookup_key(*context), request)
+                return stale
+            response = await request
+            return RAGAnswer(response) if response else None
+        except asyncio.CancelledError:
+            # Остановка прервала обработчик: ожидание уже сохранено для возобновления
+            request.cancel()
+            raise
+    
+    async def _stale_answer(self, context: QuestionContext, reason: str) -> Optional[RAGAnswer]:
+        from database.db import db
+        try:
+            stored = await db.find_rag_answer(context.question, context.car, self.stale_max_age)
+        except Exception as e:
+            logger.error(f"Error looking up stored RAG answer: {e}")
+            stored = None
+        if stored is None:
+            STALE_REASONS['miss'].inc()
+            return None
+        age = stored['age_sec']
+        STALE_REASONS[reason].inc()
+        RAG_STALE_AGE_SECONDS.observe(age)
+        self.stale_served += 1
+        self.stale_age_max = max(self.stale_age_max, age)
+        logger.warning(f"RAG API {reason}, serving stored answer {stored['request_id']} ({age / 3600:.1f}h old)")
+        return RAGAnswer(stored['answer'], cached=True, age_sec=age)
+    
+    def _refresh(self, key: bytes, request: Any) -> None:
+        """
+        Фоновое обновление ответа, исход — в метриках
+
+        request — продолжающийся запрос пользователя (задача) или новый запрос (корутина);
+        новый запрос не отправляется, если такой же вопрос уже обновляется.
+        """
+        if asyncio.iscoroutine(request):
+            if self._refreshing.get(key):
+                request.close()
+                REFRESH_OUTCOMES['skipped'].inc()
+                return
+            # Интервалы фонового запроса не относятся к трассе обработки обновления
+            request = asyncio.create_task(request, name="rag-refresh", context=contextvars.Context())
+        self._refreshing[key] = self._refreshing.get(key, 0) + 1
+        self._refreshes.add(request)
+        
+        def done(task: asyncio.Task) -> None:
+            self._refreshes.discard(task)
+            self._refreshing[key] -= 1
+            if not self._refreshing[key]:
+                del self._refreshing[key]
+            if not task.cancelled():
+                REFRESH_OUTCOMES['success' if task.result() else 'failed'].inc()
+        
+        request.add_done_callback(done)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'stale_served': self.stale_served,
+            'stale_age_max': self.stale_age_max,
+            'refreshing': len(self._refreshes),
+            'refreshed': REFRESH_OUTCOMES['success'].value,
+            'refresh_failed': REFRESH_OUTCOMES['failed'].value,
+            'misses': STALE_REASONS['miss'].value,
+        }
+    
+    async def send_request(self, text: str, user_id: int, username: str = None,
+                           reply_to: Optional[ReplyTarget] = None,
+                           context: Optional[QuestionContext] = None,
+                           owner: Optional[asyncio.Task] = None) -> Optional[str]:
         """
         Отправка запроса в RAG API и ожидание ответа
         
@@ -29,47 +183,74 @@ class RAGClient:
             text: Текст вопроса
             user_id: ID пользователя
             username: Имя пользователя
+            reply_to: Куда доставить ответ, если ожидание прервёт остановка бота
+            context: Вопрос и машина пользователя — ответ сохраняется с ними в rag_answers
+            owner: Задача обработчика, если запрос выполняется в дочерней задаче (answer)
             
         Returns:
             Ответ от RAG API или None в случае ошибки
         """
-        logger.info(f"Sending RAG request for user {user_id} (@{username}): {text[:100]}...")
+        logger.info("Sending RAG request for user %s (@%s): %.100s...", user_id, username, text)
         
+        from database.db import db, utc_now
+        asked_at = utc_now()
         try:
             # Если режим тестирования, возвращаем тестовый ответ
             if self.test_mode:
-                logger.info(f"Test mode active, returning test response for user {user_id}")
-                from database.db import db
-                await db.log_rag_request(user_id, "TEST_MODE", text[:200] + "..." if len(text) > 200 else text, 'success')
+                logger.info("Test mode active, returning test response for user %s", user_id)
+                await db.log_rag_request(user_id, "TEST_MODE", text[:200] + "..." if len(text) > 200 else text, 'success',
+                                         created_at=asked_at)
                 return self.test_response
             
-            # Отправка запроса
-            request_id = await self._create_request(text, user_id, username)
-            if not request_id:
-                logger.error(f"Failed to create RAG request for user {user_id}")
-                return None
-            
-            logger.debug(f"RAG request created with ID: {request_id}")
-            
-            # Логируем RAG запрос в базу данных
-            from database.db import db
-            await db.log_rag_request(user_id, request_id, text[:200] + "..." if len(text) > 200 else text, 'pending')
-            
-            # Ожидание ответа
-            logger.debug(f"Waiting for RAG response for request {request_id}")
-            response = await self._wait_for_response(request_id)
+            # Ожидание RAG занимает отдельный лимит, а не слот обработчика (utils/scheduler.py)
+            async with scheduler.long_wait():
+                # Отправка запроса
+                request_id = await self._create_request(text, user_id, username)
+                if not request_id:
+                    RAG_OUTCOMES['create_failed'].inc()
+                    logger.error("Failed to create RAG request for user %s", user_id)
+                    return None
+                
+                logger.debug("RAG request created with ID: %s", request_id)
+                
+                # Логируем RAG запрос в базу данных
+                await db.log_rag_request(user_id, request_id, text[:200] + "..." if len(text) > 200 else text, 'pending',
+                                         created_at=asked_at, accepted_at=utc_now())
+                
+                # Ожидание ответа (при остановке бота сохраняется и продолжается после запуска)
+                logger.debug("Waiting for RAG response for request %s", request_id)
+                with shutdown.track_rag_wait(request_id, user_id, reply_to, owner):
+                    response, polls = await self._wait_for_response(request_id)
             
             if response:
-                logger.info(f"RAG response received for user {user_id}, length: {len(response)} chars")
-                await db.update_rag_request_status(request_id, 'success')
+                logger.info("RAG response received for user %s, length: %d chars", user_id, len(response))
+                db.complete_rag_request(request_id, 'success', polls, response, user_id, context)
             else:
-                logger.warning(f"No RAG response received for user {user_id}, request {request_id}")
-                await db.update_rag_request_status(request_id, 'failed')
+                logger.warning("No RAG response received for user %s, request %s", user_id, request_id)
+                db.complete_rag_request(request_id, 'failed', polls, None)
+            
+            return response
+            
+        except Exception as e:
+            logger.error("Error in RAG request for user %s: %s", user_id, e)
+            return None
+    
+    async def resume_request(self, request_id: str, user_id: int, reply_to: ReplyTarget) -> Optional[str]:
+        """Ожидание ответа на запрос, созданный до перезапуска бота"""
+        try:
+            async with scheduler.long_wait():
+                with shutdown.track_rag_wait(request_id, user_id, reply_to):
+                    response, polls = await self._wait_for_response(request_id)
             
+            from database.db import db
+            # Опросы до перезапуска не учтены: poll_count — только после возобновления
+            db.complete_rag_request(request_id, 'success' if response else 'failed', polls, response)
+            logger.info(f"Resumed RAG request {request_id} for user {user_id}: "
+                        f"{'received ' + str(len(response)) + ' chars' if response else 'no response'}")
             return response
             
         except Exception as e:
-            logger.error(f"Error in RAG request for user {user_id}: {e}")
+            logger.error(f"Error resuming RAG request {request_id} for user {user_id}: {e}")
             return None
     
     async def _create_request(self, text: str, user_id: int, username: str = None) -> Optional[str]:
@@ -86,53 +267,76 @@ class RAGClient:
             # 'user_name': username or str(user_id)
         }
         
+        started = time.perf_counter()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=headers) as response:
-                    if response.status in [200, 201]:
-                        result = await response.json()
-                        return result.get('id')
-                    else:
-                        logger.error(f"RAG API error: {response.status} - {await response.text()}")
-                        return None
+            async with self._get_session().post(url, json=data, headers=headers) as response:
+                if response.status in [200, 201]:
+                    result = await response.json()
+                    return result.get('id')
+                else:
+                    logger.error(f"RAG API error: {response.status} - {await response.text()}")
+                    return None
         except Exception as e:
             logger.error(f"Error creating RAG request: {e}")
             return None
+        finally:
+            elapsed = time.perf_counter() - started
+            RAG_CREATE_SECONDS.observe(elapsed)
+            add_span(SPAN_RAG_CREATE, 'POST /api/v1/request', elapsed)
     
-    async def _wait_for_response(self, request_id: str) -> Optional[str]:
-        """Ожидание ответа от RAG API"""
+    async def _wait_for_response(self, request_id: str) -> Tuple[Optional[str], int]:
+        """Ожидание ответа от RAG API; возвращает ответ (None при ошибке) и число опросов"""
         url = f"{self.api_url}/api/v1/request/{request_id}"
         headers = {'ApiKey': self.api_key}
+        started = time.perf_counter()
+        polls = 0
+        # Если ожидание прервано (остановка бота), исход так и остаётся interrupted
+        outcome = 'interrupted'
         
-        for attempt in range(self.max_attempts):
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers) as response:
+        try:
+            for attempt in range(self.max_attempts):
+                polls += 1
+                poll_started = time.perf_counter()
+                try:
+                    async with self._get_session().get(url, headers=headers) as response:
                         if response.status == 200:
                             result = await response.json()
                             status = result.get('status')
                             
                             if status == 'completed':
-                                return result.get('response_text')
+                                outcome = 'success'
+                                return result.get('response_text'), polls
                             elif status == 'failed':
+                                outcome = 'failed'
                                 logger.error(f"RAG request failed: {result}")
-                                return None
+                                return None, polls
                             # Если статус 'processing' или другой, продолжаем ждать
                             
                         else:
+                            outcome = 'error'
                             logger.error(f"RAG API error: {response.status} - {await response.text()}")
-                            return None
-                            
-            except Exception as e:
-                logger.error(f"Error checking RAG response: {e}")
-                return None
+                            return None, polls
+                                
+                except Exception as e:
+                    outcome = 'error'
+                    logger.error(f"Error checking RAG response: {e}")
+                    return None, polls
+                finally:
+                    add_span(SPAN_RAG_POLL, 'GET /api/v1/request/:id', time.perf_counter() - poll_started)
+                
+                # Ждем перед следующей попыткой
+                sleep_started = time.perf_counter()
+                await asyncio.sleep(self.poll_interval)
+                add_span(SPAN_RAG_SLEEP, 'poll interval', time.perf_counter() - sleep_started)
             
-            # Ждем перед следующей попыткой
-            await asyncio.sleep(self.poll_interval)
-        
-        # Если превышено максимальное количество попыток
-        logger.warning(f"RAG request {request_id} timed out after {self.max_attempts} attempts")
-        return None
+            # Если превышено максимальное количество попыток
+            outcome = 'timeout'
+            logger.warning(f"RAG request {request_id} timed out after {self.max_attempts} attempts")
+            return None, polls
+        finally:
+            RAG_POLLS.observe(polls)
+            RAG_ANSWER_SECONDS.observe(time.perf_counter() - started)
+            RAG_OUTCOMES[outcome].inc()
 
 # Глобальный экземпляр RAG клиента
 rag_client = RAGClient()
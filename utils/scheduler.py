@@ -0,0 +1,234 @@
+"""
+Планировщик обработчиков: лимиты одновременной обработки и обратное давление
+
+Outer-middleware уровня Update распределяет обновления по полосам: fast — команды, нажатия
+inline-кнопок, кнопки меню и медиа (короткие ответы), default — остальной текст (вопросы к RAG).
+У каждой полосы свой лимит, поэтому поток вопросов не задерживает команды.
+
+Ожидание ответа RAG длится минутами и не должно занимать слот обработчика: внутри
+scheduler.long_wait() слот полосы освобождается и занимается слот отдельного лимита
+RAG_MAX_CONCURRENT_WAITS.
+
+В режимах polling и webhook планировщик сам запускает обработчики в фоне (detach): принимающий
+цикл ждёт, пока в обработке SCHEDULER_MAX_PENDING обновлений, и новые обновления остаются
+у Telegram, а не копятся задачами в памяти.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, Update
+
+from utils.logger import get_logger
+from utils.shutdown import shutdown
+from utils.tracing import SPAN_RAG_QUEUE, add_span
+
+logger = get_logger(__name__)
+
+LANE_FAST = "fast"
+LANE_DEFAULT = "default"
+
+# Одновременно выполняемые обработчики вопросов и команд
+SCHEDULER_MAX_CONCURRENT = int(os.getenv('SCHEDULER_MAX_CONCURRENT', 50))
+SCHEDULER_FAST_CONCURRENT = int(os.getenv('SCHEDULER_FAST_CONCURRENT', 20))
+# Одновременные ожидания ответа RAG
+RAG_MAX_CONCURRENT_WAITS = int(os.getenv('RAG_MAX_CONCURRENT_WAITS', 200))
+# Обновлений в системе (выполняются, ждут слота или ответа RAG), после которых приём ждёт
+SCHEDULER_MAX_PENDING = int(os.getenv('SCHEDULER_MAX_PENDING', 1000))
+
+
+class Lane:
+    """Семафор с учётом выполняемых и ожидающих задач"""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.total = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self) -> float:
+        """Захват слота, возвращает время ожидания"""
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.active += 1
+        self.total += 1
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'total': self.total,
+            'avg_wait_ms': round(self.wait_time / self.total * 1000, 2) if self.total else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+        }
+
+
+class _Slot:
+    """Слот полосы, занятый текущим обновлением (может быть освобождён раньше, в long_wait)"""
+    __slots__ = ('lane', 'held')
+
+    def __init__(self, lane: Lane):
+        self.lane = lane
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.lane.release()
+
+
+_current_slot: ContextVar[Optional[_Slot]] = ContextVar('handler_slot', default=None)
+
+
+class HandlerScheduler(BaseMiddleware):
+    """Лимиты обработчиков по полосам и приём обновлений с обратным давлением"""
+
+    def __init__(self, max_concurrent: int = SCHEDULER_MAX_CONCURRENT,
+                 fast_concurrent: int = SCHEDULER_FAST_CONCURRENT,
+                 max_long_waits: int = RAG_MAX_CONCURRENT_WAITS,
+                 max_pending: int = SCHEDULER_MAX_PENDING):
+        self.lanes: Dict[str, Lane] = {
+            LANE_FAST: Lane(LANE_FAST, fast_concurrent),
+            LANE_DEFAULT: Lane(LANE_DEFAULT, max_concurrent),
+        }
+        self.long_waits = Lane('rag_wait', max_long_waits)
+        self.max_pending = max_pending
+        # Тексты кнопок меню (короткие обработчики), регистрируются роутерами
+        self.fast_texts: Set[str] = set()
+        self.detach = False
+        self._admission: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # Принятые и ещё не завершённые фоновые обработчики (detach)
+        self._admitted = 0
+        self.failed = 0
+
+    def setup(self, dp: Dispatcher, detach: bool = False) -> None:
+        """
+        Подключение к диспетчеру
+
+        Args:
+            dp: Диспетчер
+            detach: Запускать обработчики в фоне; приём обновлений ждёт при max_pending
+                в обработке (polling с handle_as_tasks=False, webhook без handle_in_background)
+        """
+        self.detach = detach
+        if detach:
+            self._admission = asyncio.Semaphore(self.max_pending)
+        dp.update.outer_middleware(self)
+        # Дожидание фоновых обработчиков — первым из обработчиков shutdown бота (setup вызывается
+        # до остальных регистраций). Закрытие FSM-хранилища диспетчер регистрирует ещё в
+        # конструкторе, поэтому оно идёт раньше: PostgresStorage после close() работает без кэша,
+        # а пул базы закрывается в bot.py уже после shutdown
+        dp.shutdown.register(self.drain)
+
+    def lane_for(self, update: Update) -> str:
+        if update.callback_query is not None:
+            return LANE_FAST
+        message = update.message
+        if message is None:
+            return LANE_FAST
+        text = message.text
+        if text is None or text.startswith('/') or text in self.fast_texts:
+            return LANE_FAST
+        return LANE_DEFAULT
+
+    @property
+    def pending(self) -> int:
+        if self._admission is not None:
+            return self._admitted
+        return sum(lane.active + lane.waiting for lane in self.lanes.values())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'failed': self.failed,
+            'lanes': {name: lane.snapshot() for name, lane in self.lanes.items()},
+            'rag_wait': self.long_waits.snapshot(),
+        }
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        lane = self.lanes[self.lane_for(event)]
+        if self._admission is None:
+            return await self._run(lane, handler, event, data)
+
+        # Ожидание здесь останавливает цикл приёма обновлений
+        await self._admission.acquire()
+        self._admitted += 1
+        task = asyncio.create_task(self._run_detached(lane, handler, event, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, lane: Lane, handler: Callable, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        # Ожидание слота попадает в трассу обновления (utils/tracing.py)
+        data['scheduler_wait'] = await lane.acquire()
+        data['scheduler_lane'] = lane.name
+        slot = _Slot(lane)
+        token = _current_slot.set(slot)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_slot.reset(token)
+            slot.release()
+
+    async def _run_detached(self, lane: Lane, handler: Callable, event: Update, data: Dict[str, Any]) -> None:
+        try:
+            await self._run(lane, handler, event, data)
+        except Exception as e:
+            # Результат фоновой задачи никто не ждёт, поэтому ошибка только логируется
+            self.failed += 1
+            logger.exception(f"Error processing update {event.update_id}: {e}")
+        finally:
+            self._admitted -= 1
+            self._admission.release()
+
+    @asynccontextmanager
+    async def long_wait(self) -> AsyncIterator[None]:
+        """
+        Долгое ожидание внешнего сервиса вне слота обработчика
+
+        Слот полосы освобождается и после выхода не занимается снова — остаток обработчика
+        (отправка ответа) короткий.
+        """
+        slot = _current_slot.get()
+        if slot is not None:
+            slot.release()
+        add_span(SPAN_RAG_QUEUE, self.long_waits.name, await self.long_waits.acquire())
+        try:
+            yield
+        finally:
+            self.long_waits.release()
+
+    async def drain(self) -> None:
+        """Ожидание фоновых обработчиков при остановке (utils/shutdown.py)"""
+        await shutdown.drain(self._tasks)
+
+
+# Глобальный планировщик (подключается к диспетчеру в bot.py)
+scheduler = HandlerScheduler()
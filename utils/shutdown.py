@@ -0,0 +1,159 @@
+"""
+Корректная остановка: дожидание обработчиков и сохранение ожиданий ответа RAG
+
+При остановке приём обновлений прекращается (polling, webhook, воркер очереди), а начатые
+обработчики получают SHUTDOWN_GRACE_SEC на завершение. Вопросы, ответ на которые к этому
+времени не пришёл, сохраняются в rag_resume: после запуска бот дождётся ответа RAG по тому же
+request_id и отправит его пользователю. Пул БД и HTTP-сессии закрываются после этого (bot.py).
+"""
+import asyncio
+import os
+from contextlib import contextmanager, suppress
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+from database.db import Database, db
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Время на завершение начатых обработчиков
+SHUTDOWN_GRACE_SEC = float(os.getenv('SHUTDOWN_GRACE_SEC', 30))
+# Сохранённые ожидания старше этого не возобновляются (ответ пользователю уже не нужен)
+RAG_RESUME_MAX_AGE_SEC = int(os.getenv('RAG_RESUME_MAX_AGE_SEC', 3600))
+
+DEFAULT_RAG_ERROR_TEXT = "⚠️ Не удалось получить ответ, попробуйте позже."
+
+
+class ReplyTarget(NamedTuple):
+    """Куда доставить ответ: вопрос пользователя и сообщение «Обрабатываю...»"""
+    chat_id: int
+    message_id: int
+    status_message_id: Optional[int] = None
+
+
+class _RagWait:
+    __slots__ = ('request_id', 'user_id', 'reply_to', 'task')
+
+    def __init__(self, request_id: str, user_id: int, reply_to: ReplyTarget, task: Optional[asyncio.Task]):
+        self.request_id = request_id
+        self.user_id = user_id
+        self.reply_to = reply_to
+        self.task = task
+
+
+class ShutdownCoordinator:
+    """Учёт ожиданий RAG, дожидание задач при остановке и возобновление после запуска"""
+
+    def __init__(self, database: Database = db):
+        self.db = database
+        # request_id -> ожидание ответа в задаче обработчика
+        self._waits: Dict[str, _RagWait] = {}
+        # Задачи, ожидания которых сохранены (воркер очереди подтверждает их обновления)
+        self._saved_tasks: Set[asyncio.Task] = set()
+        self._resume_tasks: Set[asyncio.Task] = set()
+        self.drained = 0
+        self.abandoned = 0
+        self.saved = 0
+
+    @contextmanager
+    def track_rag_wait(self, request_id: str, user_id: int, reply_to: Optional[ReplyTarget],
+                       task: Optional[asyncio.Task] = None) -> Iterator[None]:
+        """
+        Ожидание ответа, которое можно сохранить, если остановка прервёт обработчик
+
+        task — задача обработчика, если ожидание выполняется в дочерней задаче (по умолчанию текущая).
+        """
+        if reply_to is None:
+            yield
+            return
+        self._waits[request_id] = _RagWait(request_id, user_id, reply_to, task or asyncio.current_task())
+        try:
+            yield
+        finally:
+            self._waits.pop(request_id, None)
+
+    def is_saved(self, task: Optional[asyncio.Task]) -> bool:
+        """Ожидание RAG в прерванной задаче сохранено для возобновления"""
+        return task in self._saved_tasks
+
+    async def drain(self, tasks: Iterable[asyncio.Task]) -> None:
+        """
+        Дожидание задач при остановке
+
+        Через SHUTDOWN_GRACE_SEC ожидания RAG в незавершённых задачах сохраняются,
+        а сами задачи отменяются.
+        """
+        tasks = set(tasks) | self._resume_tasks
+        if not tasks:
+            return
+        logger.info(f"Waiting up to {SHUTDOWN_GRACE_SEC:.0f}s for {len(tasks)} request(s) in progress...")
+        done, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_GRACE_SEC)
+        saved = 0
+        if pending:
+            saved = await self._save_waits(pending)
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+        self.drained += len(done)
+        self.abandoned += len(pending)
+        self.saved += saved
+        logger.info(f"Shutdown drain: {len(done)} request(s) finished, {len(pending)} interrupted, "
+                    f"{saved} RAG wait(s) saved for resumption")
+
+    async def _save_waits(self, pending: Set[asyncio.Task]) -> int:
+        waits = [wait for wait in self._waits.values() if wait.task in pending]
+        if not waits:
+            return 0
+        try:
+            await self.db.save_rag_resume([
+                (wait.request_id, wait.user_id, *wait.reply_to) for wait in waits
+            ])
+        except Exception as e:
+            logger.error(f"Failed to save {len(waits)} RAG wait(s) for resumption: {e}")
+            return 0
+        self._saved_tasks.update(wait.task for wait in waits)
+        return len(waits)
+
+    def resume_rag_waits(self, bot: Bot) -> None:
+        """Доставка ответов на вопросы, прерванные прошлой остановкой (в фоне)"""
+        self._spawn(self._resume(bot))
+
+    def _spawn(self, coro: Any) -> None:
+        task = asyncio.create_task(coro)
+        self._resume_tasks.add(task)
+        task.add_done_callback(self._resume_tasks.discard)
+
+    async def _resume(self, bot: Bot) -> None:
+        try:
+            rows = await self.db.claim_rag_resume(RAG_RESUME_MAX_AGE_SEC)
+        except Exception as e:
+            logger.error(f"Failed to load interrupted RAG waits: {e}")
+            return
+        if rows:
+            logger.info(f"Resuming {len(rows)} RAG wait(s) interrupted by the previous shutdown")
+        for row in rows:
+            reply_to = ReplyTarget(row['chat_id'], row['message_id'], row['status_message_id'])
+            self._spawn(self._deliver(bot, row['request_id'], row['user_id'], reply_to))
+
+    async def _deliver(self, bot: Bot, request_id: str, user_id: int, reply_to: ReplyTarget) -> None:
+        from utils.rag_client import rag_client
+        try:
+            response = await rag_client.resume_request(request_id, user_id, reply_to)
+            if reply_to.status_message_id:
+                with suppress(TelegramAPIError):
+                    await bot.delete_message(reply_to.chat_id, reply_to.status_message_id)
+            if not response:
+                response = await self.db.get_template('rag_error_text') or DEFAULT_RAG_ERROR_TEXT
+            await bot.send_message(
+                reply_to.chat_id, response,
+                reply_to_message_id=reply_to.message_id, allow_sending_without_reply=True,
+            )
+        except Exception as e:
+            logger.error(f"Failed to deliver resumed RAG answer {request_id} to user {user_id}: {e}")
+
+
+# Глобальный координатор остановки
+shutdown = ShutdownCoordinator()
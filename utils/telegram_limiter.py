@@ -0,0 +1,251 @@
+"""
+Ограничение частоты исходящих запросов к Telegram
+
+Middleware сессии aiogram: все методы с chat_id проходят через общий лимит
+(около 30 сообщений в секунду на бота) и лимит чата (1 в секунду в личном чате,
+20 в минуту в группе). Запросы, ожидающие общего лимита, обслуживаются по приоритету:
+ответы пользователям раньше служебных сообщений и правок, массовые рассылки — последними.
+Ответ 429 (retry_after) блокирует отправку в чат на указанное время, запрос повторяется.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    DeleteMessage, EditMessageCaption, EditMessageReplyMarkup, EditMessageText, SendChatAction, TelegramMethod,
+)
+from aiogram.methods.base import Response, TelegramType
+
+from utils.logger import get_logger
+from utils.metrics import TELEGRAM_REQUEST_SECONDS, HistogramValue
+from utils.tracing import SPAN_TELEGRAM, SPAN_TELEGRAM_WAIT, add_span
+
+logger = get_logger(__name__)
+
+# Приоритеты (меньше — раньше)
+PRIORITY_ANSWER = 0
+PRIORITY_STATUS = 1
+PRIORITY_BULK = 2
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_GLOBAL_BURST = int(os.getenv('TELEGRAM_GLOBAL_BURST', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', 20 / 60))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 3))
+# Повторы после 429; дольше TELEGRAM_MAX_RETRY_AFTER_SEC не ждём, ошибка уходит вызывающему
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 3))
+TELEGRAM_MAX_RETRY_AFTER_SEC = float(os.getenv('TELEGRAM_MAX_RETRY_AFTER_SEC', 60))
+
+# Служебные сообщения по умолчанию идут после ответов
+STATUS_METHODS = (DeleteMessage, EditMessageText, EditMessageCaption, EditMessageReplyMarkup, SendChatAction)
+
+# Сколько лимитов чатов держать, прежде чем удалять неактивные
+_CHAT_LIMITS_SOFT_MAX = 10000
+
+_send_priority: ContextVar[Optional[int]] = ContextVar('telegram_send_priority', default=None)
+
+
+@contextmanager
+def send_priority(priority: int) -> Iterator[None]:
+    """Приоритет запросов к Telegram внутри блока (например, PRIORITY_BULK для рассылки)"""
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class RateLimit:
+    """
+    Лимит частоты по алгоритму GCRA (эквивалент token bucket)
+
+    Каждый вызов reserve() резервирует ближайший слот и возвращает задержку до него,
+    поэтому ожидающие обслуживаются по порядку без блокировок.
+    """
+    __slots__ = ('interval', 'tolerance', 'tat')
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        # Theoretical arrival time — момент, к которому «расписаны» выданные слоты
+        self.tat = 0.0
+
+    def delay(self, now: float) -> float:
+        return max(0.0, self.tat - self.tolerance - now)
+
+    def reserve(self, now: float) -> float:
+        delay = self.delay(now)
+        self.tat = max(self.tat, now) + self.interval
+        return delay
+
+    def block(self, until: float) -> None:
+        """Запрет отправки до момента until (после 429)"""
+        self.tat = max(self.tat, until + self.tolerance)
+
+    def idle(self, now: float) -> bool:
+        return self.tat <= now
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Middleware сессии бота: общий лимит и лимиты чатов, очередь по приоритету, повтор после 429"""
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, global_burst: int = TELEGRAM_GLOBAL_BURST,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, group_rate: float = TELEGRAM_GROUP_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST):
+        self.global_limit = RateLimit(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self._chats: Dict[Union[int, str], RateLimit] = {}
+        # Очередь к общему лимиту: (приоритет, порядковый номер, future)
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+        # Статистика
+        self.sent = 0
+        self.throttled = 0
+        self.retry_after = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.by_priority: Dict[int, int] = defaultdict(int)
+        # Класс метода -> гистограмма времени запроса для /metrics
+        self._latency: Dict[type, HistogramValue] = {}
+
+    def _chat_limit(self, chat_id: Union[int, str]) -> RateLimit:
+        limit = self._chats.get(chat_id)
+        if limit is None:
+            if len(self._chats) >= _CHAT_LIMITS_SOFT_MAX:
+                now = time.monotonic()
+                for key in [key for key, value in self._chats.items() if value.idle(now)]:
+                    del self._chats[key]
+            # Отрицательные ID — группы и каналы
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            limit = RateLimit(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = limit
+        return limit
+
+    @staticmethod
+    def _priority(method: TelegramMethod) -> int:
+        priority = _send_priority.get()
+        if priority is not None:
+            return priority
+        return PRIORITY_STATUS if isinstance(method, STATUS_METHODS) else PRIORITY_ANSWER
+
+    async def _acquire(self, chat_id: Union[int, str], priority: int) -> None:
+        # Сначала слот чата (без очереди: порядок внутри чата задаёт резервирование)
+        delay = self._chat_limit(chat_id).reserve(time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # Затем общий слот: при свободном лимите и пустой очереди — сразу
+        if not self._queue and self.global_limit.delay(time.monotonic()) == 0:
+            self.global_limit.reserve(time.monotonic())
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._counter), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump(), name="telegram-rate-limiter")
+        await future
+
+    async def _pump(self) -> None:
+        """Выдача общих слотов ожидающим в порядке приоритета"""
+        while self._queue:
+            delay = self.global_limit.delay(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                # Ожидающий отменён
+                continue
+            self.global_limit.reserve(time.monotonic())
+            future.set_result(None)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # getUpdates, getMe, answerCallbackQuery и т. п. не ограничиваются
+            started = time.monotonic()
+            try:
+                return await make_request(bot, method)
+            finally:
+                add_span(SPAN_TELEGRAM, type(method).__name__, time.monotonic() - started)
+
+        priority = self._priority(method)
+        self.by_priority[priority] += 1
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            queued = time.monotonic()
+            await self._acquire(chat_id, priority)
+            waited = time.monotonic() - queued
+            if waited > 0.001:
+                self.throttled += 1
+                add_span(SPAN_TELEGRAM_WAIT, type(method).__name__, waited)
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+            requested = time.monotonic()
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                attempt += 1
+                if attempt > TELEGRAM_MAX_RETRIES or e.retry_after > TELEGRAM_MAX_RETRY_AFTER_SEC:
+                    self.failed += 1
+                    raise
+                logger.warning(f"Telegram flood control for chat {chat_id}: retry after {e.retry_after}s "
+                               f"({type(method).__name__}, attempt {attempt})")
+                self._chat_limit(chat_id).block(time.monotonic() + e.retry_after)
+                continue
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                add_span(SPAN_TELEGRAM, type(method).__name__, time.monotonic() - requested)
+            self._observe(method, time.monotonic() - started)
+            return response
+
+    def _observe(self, method: TelegramMethod, latency: float) -> None:
+        self.sent += 1
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        histogram = self._latency.get(type(method))
+        if histogram is None:
+            histogram = self._latency[type(method)] = TELEGRAM_REQUEST_SECONDS.labels(type(method).__name__)
+        histogram.observe(latency)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'retry_after': self.retry_after,
+            'failed': self.failed,
+            'queued': len(self._queue),
+            'chats': len(self._chats),
+            'avg_wait_ms': round(self.wait_time / max(self.sent, 1) * 1000, 2),
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+            'avg_latency_ms': round(self.latency / max(self.sent, 1) * 1000, 2),
+            'max_latency_ms': round(self.max_latency * 1000, 2),
+            'by_priority': dict(self.by_priority),
+        }
+
+
+# Глобальный ограничитель (подключается к сессии бота в bot.py)
+telegram_limiter = TelegramRateLimiter()
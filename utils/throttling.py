@@ -0,0 +1,171 @@
+"""
+Защита от флуда: ограничение частоты сообщений пользователя
+
+Outer-middleware уровня Update до планировщика: лишние сообщения и нажатия кнопок
+отбрасываются сразу, без обращений к базе и RAG и без слота обработчика.
+
+Частота считается скользящим окном из двух счётчиков (текущее и предыдущее окно, вклад
+предыдущего — пропорционально неистёкшей доле), поэтому на пользователя хранится несколько
+чисел. Подряд повторённый текст в пределах THROTTLE_DUPLICATE_SEC тоже отбрасывается.
+Записи неактивных пользователей удаляются по порядку последнего обращения.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import TelegramObject, Update
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Сообщений и нажатий кнопок за окно
+THROTTLE_RATE_LIMIT = int(os.getenv('THROTTLE_RATE_LIMIT', 8))
+THROTTLE_WINDOW_SEC = float(os.getenv('THROTTLE_WINDOW_SEC', 10))
+# Повтор того же текста подряд в пределах этого времени отбрасывается (0 — не проверять)
+THROTTLE_DUPLICATE_SEC = float(os.getenv('THROTTLE_DUPLICATE_SEC', 5))
+
+THROTTLED_TEXT = "⏳ Слишком много сообщений подряд. Подождите немного и повторите."
+
+
+class UserRate:
+    """Состояние пользователя: счётчики двух окон и последний текст"""
+    __slots__ = ('seen_at', 'window_start', 'current', 'previous', 'last_hash', 'last_at', 'warned_window')
+
+    def __init__(self, now: float):
+        self.seen_at = now
+        self.window_start = now
+        self.current = 0
+        self.previous = 0
+        self.last_hash: Optional[int] = None
+        self.last_at = 0.0
+        # Окно, в котором пользователь уже получил предупреждение
+        self.warned_window = -1.0
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты сообщений и нажатий кнопок по user_id"""
+
+    def __init__(self, limit: int = THROTTLE_RATE_LIMIT, window: float = THROTTLE_WINDOW_SEC,
+                 duplicate_window: float = THROTTLE_DUPLICATE_SEC):
+        self.limit = limit
+        self.window = window
+        self.duplicate_window = duplicate_window
+        # user_id -> состояние; порядок — от давно не писавших к недавним
+        self._users: 'OrderedDict[int, UserRate]' = OrderedDict()
+        # Через это время без сообщений состояние пользователя не влияет на решение
+        self._idle_after = max(2 * window, duplicate_window)
+        self._notifications: Set[asyncio.Task] = set()
+        self.throttled = 0
+        self.duplicates = 0
+
+    def setup(self, dp: Dispatcher) -> None:
+        """Подключение к диспетчеру (до планировщика, чтобы отброшенные обновления не ждали слота)"""
+        dp.update.outer_middleware(self)
+
+    def _state(self, user_id: int, now: float) -> UserRate:
+        # Удаление неактивных с начала очереди: в среднем O(1) на сообщение
+        while self._users:
+            oldest = next(iter(self._users.values()))
+            if now - oldest.seen_at < self._idle_after:
+                break
+            self._users.popitem(last=False)
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = UserRate(now)
+        else:
+            self._users.move_to_end(user_id)
+            state.seen_at = now
+        return state
+
+    def _allow(self, state: UserRate, now: float) -> bool:
+        elapsed = now - state.window_start
+        if elapsed >= self.window:
+            # Переход в новое окно; если пропущено больше одного, предыдущее пустое
+            windows = int(elapsed // self.window)
+            state.previous = state.current if windows == 1 else 0
+            state.current = 0
+            state.window_start += windows * self.window
+            elapsed = now - state.window_start
+        estimated = state.previous * (1 - elapsed / self.window) + state.current
+        if estimated >= self.limit:
+            return False
+        state.current += 1
+        return True
+
+    def check(self, user_id: int, text: Optional[str], now: Optional[float] = None) -> Optional[str]:
+        """
+        Решение по одному сообщению
+
+        Returns:
+            None — пропустить; 'duplicate' или 'rate' — причина отбрасывания
+        """
+        now = time.monotonic() if now is None else now
+        state = self._state(user_id, now)
+        if text is not None and self.duplicate_window > 0:
+            text_hash = hash(text)
+            duplicate = text_hash == state.last_hash and now - state.last_at < self.duplicate_window
+            state.last_hash = text_hash
+            state.last_at = now
+            if duplicate:
+                self.duplicates += 1
+                return 'duplicate'
+        if not self._allow(state, now):
+            self.throttled += 1
+            return 'rate'
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        message = event.message if isinstance(event, Update) else None
+        callback = event.callback_query if isinstance(event, Update) else None
+        source = message or callback
+        if source is None or source.from_user is None:
+            return await handler(event, data)
+
+        user_id = source.from_user.id
+        reason = self.check(user_id, message.text if message is not None else None)
+        if reason is None:
+            return await handler(event, data)
+
+        logger.debug(f"Dropped update {event.update_id} from {user_id}: {reason}")
+        state = self._users[user_id]
+        if callback is not None:
+            # Нажатие без ответа оставляет кнопку «зависшей»
+            self._notify(user_id, callback.answer(THROTTLED_TEXT if reason == 'rate' else None))
+        elif reason == 'rate' and state.warned_window != state.window_start:
+            # Предупреждение не чаще раза за окно
+            state.warned_window = state.window_start
+            self._notify(user_id, message.answer(THROTTLED_TEXT))
+        return None
+
+    def _notify(self, user_id: int, request: Awaitable[Any]) -> None:
+        """Отправка уведомления в фоне: приём обновлений не ждёт лимита частоты чата"""
+        async def send() -> None:
+            try:
+                await request
+            except TelegramAPIError as e:
+                logger.debug(f"Failed to notify throttled user {user_id}: {e}")
+
+        task = asyncio.create_task(send())
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'users': len(self._users),
+            'throttled': self.throttled,
+            'duplicates': self.duplicates,
+        }
+
+
+# Глобальный ограничитель (подключается к диспетчеру в bot.py)
+throttling = ThrottlingMiddleware()
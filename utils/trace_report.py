@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Сводка по файлу трасс (utils/tracing.py)
+
+Показывает распределение длительности, долю времени по видам интервалов (база, Telegram,
+очередь и опрос RAG) и самые медленные трассы с разбивкой. «Прочее» — время трассы,
+не покрытое интервалами (код обработчика и неучтённые ожидания).
+    python -m utils.trace_report logs/traces.jsonl logs/traces.jsonl.1 --top 10
+    python -m utils.trace_report logs/traces.jsonl --handler handle_text_message --trace 3f2a...
+"""
+import argparse
+import json
+import sys
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List
+
+OTHER = 'other'
+
+
+def load_traces(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    traces = []
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    traces.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"{path}:{line_number}: skipped malformed line", file=sys.stderr)
+    return traces
+
+
+def breakdown(trace: Dict[str, Any]) -> Dict[str, float]:
+    """Время по видам интервалов, мс; параллельные интервалы одного вида не суммируются дважды"""
+    by_kind: Dict[str, List[List[float]]] = defaultdict(list)
+    for kind, _, start, duration in trace['spans']:
+        by_kind[kind].append([start, start + duration])
+    result: Dict[str, float] = {}
+    for kind, intervals in by_kind.items():
+        intervals.sort()
+        total, current_start, current_end = 0.0, intervals[0][0], intervals[0][1]
+        for start, end in intervals[1:]:
+            if start > current_end:
+                total += current_end - current_start
+                current_start, current_end = start, end
+            else:
+                current_end = max(current_end, end)
+        result[kind] = total + current_end - current_start
+    result[OTHER] = max(0.0, trace['duration_ms'] - sum(result.values()))
+    return result
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def format_breakdown(parts: Dict[str, float], total: float) -> str:
+    items = sorted(parts.items(), key=lambda item: item[1], reverse=True)
+    return ', '.join(f"{kind} {ms / 1000:.2f}s ({ms * 100 / total:.0f}%)" for kind, ms in items if ms >= 0.5) if total else ''
+
+
+def print_trace(trace: Dict[str, Any]) -> None:
+    print(f"trace {trace['trace_id']} update {trace['update_id']} user {trace['user_id']} "
+          f"{trace.get('handler') or trace.get('event')} at {trace['start']}: {trace['duration_ms'] / 1000:.2f}s")
+    if trace.get('error'):
+        print(f"  error: {trace['error']}")
+    for kind, name, start, duration in trace['spans']:
+        print(f"  +{start / 1000:8.3f}s {duration:10.1f}ms  {kind:<15} {name}")
+    if trace.get('dropped_spans'):
+        print(f"  ... {trace['dropped_spans']} span(s) not recorded")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help="Файлы трасс (JSONL)")
+    parser.add_argument('--top', type=int, default=10, help="Сколько самых медленных трасс показать")
+    parser.add_argument('--handler', help="Только трассы этого обработчика")
+    parser.add_argument('--trace', help="Показать все интервалы трассы с этим trace_id")
+    args = parser.parse_args()
+
+    traces = load_traces(args.files)
+    if args.handler:
+        traces = [trace for trace in traces if trace.get('handler') == args.handler]
+    if not traces:
+        print("No traces found")
+        return
+
+    if args.trace:
+        for trace in traces:
+            if trace['trace_id'].startswith(args.trace):
+                print_trace(trace)
+        return
+
+    durations = [trace['duration_ms'] for trace in traces]
+    print(f"{len(traces)} trace(s): p50 {percentile(durations, 0.5) / 1000:.2f}s, "
+          f"p90 {percentile(durations, 0.9) / 1000:.2f}s, p99 {percentile(durations, 0.99) / 1000:.2f}s, "
+          f"max {max(durations) / 1000:.2f}s")
+
+    totals: Dict[str, float] = defaultdict(float)
+    by_handler: Dict[str, List[float]] = defaultdict(list)
+    for trace in traces:
+        for kind, ms in breakdown(trace).items():
+            totals[kind] += ms
+        by_handler[trace.get('handler') or trace.get('event') or '?'].append(trace['duration_ms'])
+    print(f"\nTime by span kind: {format_breakdown(totals, sum(durations))}")
+
+    print("\nBy handler:")
+    for handler, values in sorted(by_handler.items(), key=lambda item: sum(item[1]), reverse=True):
+        print(f"  {handler:<30} {len(values):6d} trace(s), p50 {percentile(values, 0.5) / 1000:.2f}s, "
+              f"max {max(values) / 1000:.2f}s")
+
+    print(f"\nSlowest {min(args.top, len(traces))} trace(s):")
+    for trace in sorted(traces, key=lambda trace: trace['duration_ms'], reverse=True)[:args.top]:
+        print(f"  {trace['trace_id']} {trace['duration_ms'] / 1000:7.2f}s "
+              f"{trace.get('handler') or trace.get('event')} user {trace['user_id']} at {trace['start'][:19]}")
+        print(f"      {format_breakdown(breakdown(trace), trace['duration_ms'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Трассировка обработки обновлений
+
+Каждое обновление получает trace_id; запросы к базе, к RAG API и к Telegram, выполненные
+в его контексте (contextvars), записываются интервалами (span) с началом и длительностью
+относительно начала трассы. В файл попадает доля TRACE_SAMPLE_RATE трасс и все трассы
+дольше TRACE_SLOW_SEC — решение принимается по завершении, поэтому медленные не теряются.
+
+Запись асинхронная: трасса передаётся через очередь в поток logging.handlers.QueueListener,
+который сериализует её в JSON и пишет в ротируемый файл TRACE_FILE. Сводка по файлу:
+    python -m utils.trace_report logs/traces.jsonl
+"""
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+from aiogram.types.update import UpdateTypeLookupError
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Доля трасс, записываемых в файл, и порог, начиная с которого записываются все
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))
+TRACE_SLOW_SEC = float(os.getenv('TRACE_SLOW_SEC', 10))
+TRACE_FILE = os.getenv('TRACE_FILE', 'logs/traces.jsonl')
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 20 * 1024 * 1024))
+TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', 5))
+# Больше интервалов в трассе не сохраняется (ожидание RAG даёт два интервала на опрос)
+TRACE_MAX_SPANS = 500
+
+# Виды интервалов
+SPAN_DB = 'db'
+SPAN_TELEGRAM = 'telegram'
+SPAN_TELEGRAM_WAIT = 'telegram.wait'
+SPAN_SCHEDULER_WAIT = 'scheduler.wait'
+SPAN_RAG_QUEUE = 'rag.queue'
+SPAN_RAG_CREATE = 'rag.create'
+SPAN_RAG_POLL = 'rag.poll'
+SPAN_RAG_SLEEP = 'rag.sleep'
+
+
+class Trace:
+    """Трасса одного обновления; интервалы — (вид, имя, начало мс, длительность мс)"""
+    __slots__ = ('trace_id', 'update_id', 'user_id', 'event', 'handler', 'started_at', 'started',
+                 'spans', 'dropped', 'closed')
+
+    def __init__(self, update_id: int, user_id: Optional[int], event: Optional[str]):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.update_id = update_id
+        self.user_id = user_id
+        self.event = event
+        self.handler: Optional[str] = None
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, str, float, float]] = []
+        self.dropped = 0
+        # Обработка закончена: интервалы задач, переживших обработчик (фоновое обновление
+        # ответа RAG с тем же контекстом), в трассу не попадают
+        self.closed = False
+
+    def add_span(self, kind: str, name: str, duration: float) -> None:
+        """Интервал, закончившийся только что"""
+        if self.closed:
+            return
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        end = time.perf_counter() - self.started
+        self.spans.append((kind, name, round((end - duration) * 1000, 2), round(duration * 1000, 2)))
+
+    def to_dict(self, duration: float, error: Optional[str]) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'update_id': self.update_id,
+            'user_id': self.user_id,
+            'event': self.event,
+            'handler': self.handler,
+            'start': datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            'duration_ms': round(duration * 1000, 2),
+            'error': error,
+            # Копия: запись сериализуется в потоке QueueListener
+            'spans': list(self.spans),
+            'dropped_spans': self.dropped,
+        }
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar('trace', default=None)
+
+
+def add_span(kind: str, name: str, duration: float) -> None:
+    """Запись интервала в текущую трассу (вне обработки обновления ничего не делает)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(kind, name, duration)
+
+
+class _TraceQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сериализация выполняется в потоке записи (форматтер файлового обработчика)
+        return record
+
+
+class _TraceFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, separators=(',', ':'))
+
+
+class Tracer(BaseMiddleware):
+    """Outer-middleware уровня Update: трасса на каждое обновление и её запись при завершении"""
+
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, slow_sec: float = TRACE_SLOW_SEC):
+        self.sample_rate = sample_rate
+        self.slow_sec = slow_sec
+        self.enabled = sample_rate > 0 or slow_sec > 0
+        self._writer: Optional[logging.Logger] = None
+        self._listener: Optional[QueueListener] = None
+        self.written = 0
+
+    def setup(self, dp: Dispatcher, path: str = TRACE_FILE) -> None:
+        """
+        Подключение к диспетчеру после планировщика: трасса начинается, когда обновление
+        получило слот, а ожидание слота записывается интервалом scheduler.wait
+        """
+        if not self.enabled:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = RotatingFileHandler(path, maxBytes=TRACE_FILE_MAX_BYTES,
+                                           backupCount=TRACE_FILE_BACKUPS, encoding='utf-8')
+        file_handler.setFormatter(_TraceFormatter())
+        queue: SimpleQueue = SimpleQueue()
+        self._listener = QueueListener(queue, file_handler)
+        self._listener.start()
+        self._writer = logging.getLogger('carbot.traces')
+        self._writer.propagate = False
+        self._writer.setLevel(logging.INFO)
+        self._writer.addHandler(_TraceQueueHandler(queue))
+
+        dp.update.outer_middleware(self)
+        for event in ('message', 'callback_query'):
+            dp.observers[event].middleware(self._name_handler)
+        logger.info(f"Tracing enabled: sample rate {self.sample_rate}, slow traces >= {self.slow_sec}s to {path}")
+
+    @staticmethod
+    async def _name_handler(handler: Callable, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.handler = data['handler'].callback.__name__
+        return await handler(event, data)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        try:
+            event_type = event.event_type
+        except UpdateTypeLookupError:
+            event_type = None
+        trace = Trace(event.update_id, user.id if user else None, event_type)
+        waited = data.get('scheduler_wait', 0.0)
+        if waited > 0.001:
+            # Трасса начинается с постановки в очередь полосы планировщика
+            trace.started -= waited
+            trace.started_at -= waited
+            trace.spans.append((SPAN_SCHEDULER_WAIT, data.get('scheduler_lane', ''), 0.0, round(waited * 1000, 2)))
+        token = _current_trace.set(trace)
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.closed = True
+            duration = time.perf_counter() - trace.started
+            if duration >= self.slow_sec > 0 or random.random() < self.sample_rate:
+                self._writer.info(trace.to_dict(duration, error))
+                self.written += 1
+
+    def close(self) -> None:
+        """Запись оставшихся трасс (при остановке)"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+# Глобальный трассировщик (подключается к диспетчеру в bot.py)
+tracer = Tracer()
@@ -0,0 +1,395 @@
+"""
+Очередь обновлений в PostgreSQL: один ingress-процесс и N воркеров
+
+Ingress (RUN_MODE=ingress) получает обновления long polling'ом и пишет их в update_queue.
+Воркеры (RUN_MODE=worker) арендуют шарды (user_id % UPDATE_QUEUE_SHARDS) через
+FOR UPDATE SKIP LOCKED и прогоняют обновления через обычные роутеры. Шард в каждый момент
+обрабатывает один воркер, а внутри воркера обновления одного пользователя выполняются
+строго по очереди — порядок сообщений пользователя сохраняется.
+
+Строка удаляется только после обработки. Если воркер упал, его аренда истекает через
+UPDATE_QUEUE_LEASE_SEC, и шард вместе с необработанными обновлениями забирает другой воркер
+(доставка «хотя бы один раз»). Шарды делятся между живыми воркерами поровну; лишний шард
+отдаётся только после завершения всех его обновлений.
+"""
+import asyncio
+import json
+import math
+import os
+import socket
+import uuid
+from contextlib import suppress
+from typing import Any, Dict, Iterable, Optional, Set
+
+import asyncpg
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+
+from database.batch_writer import BatchWriter
+from database.db import Database, db
+from database.statements import UPDATE_QUEUE_CHANNEL
+from utils.helpers import stop_on_signals
+from utils.logger import get_logger
+from utils.shutdown import shutdown
+
+logger = get_logger(__name__)
+
+# Число шардов; менять только при пустой очереди, иначе порядок пользователя может нарушиться
+UPDATE_QUEUE_SHARDS = int(os.getenv('UPDATE_QUEUE_SHARDS', 64))
+# Аренда шарда; продлевается каждые lease/3 секунд
+UPDATE_QUEUE_LEASE_SEC = int(os.getenv('UPDATE_QUEUE_LEASE_SEC', 30))
+# Опрос очереди, если уведомление потерялось
+UPDATE_QUEUE_POLL_INTERVAL_SEC = float(os.getenv('UPDATE_QUEUE_POLL_INTERVAL_SEC', 1))
+UPDATE_QUEUE_BATCH_SIZE = int(os.getenv('UPDATE_QUEUE_BATCH_SIZE', 100))
+# Сколько обновлений воркер обрабатывает одновременно (RAG-запрос держит обновление минутами)
+UPDATE_WORKER_MAX_INFLIGHT = int(os.getenv('UPDATE_WORKER_MAX_INFLIGHT', 200))
+# Таймаут long polling getUpdates в режиме ingress
+INGRESS_POLL_TIMEOUT_SEC = int(os.getenv('INGRESS_POLL_TIMEOUT_SEC', 30))
+
+DB_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    """ID отправителя обновления (None, если отправителя нет)"""
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return None
+    user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+    return user.id if user else None
+
+
+def shard_for(user_id: Optional[int], shards: int = UPDATE_QUEUE_SHARDS) -> int:
+    """Шард пользователя; обновления без отправителя попадают в шард 0"""
+    return (user_id or 0) % shards
+
+
+def queue_record(update: Update, shards: int = UPDATE_QUEUE_SHARDS) -> tuple:
+    """Запись для Database.enqueue_updates: (update_id, shard, user_id, JSON)"""
+    user_id = update_user_id(update)
+    payload = update.model_dump_json(exclude_unset=True, by_alias=True)
+    return update.update_id, shard_for(user_id, shards), user_id, payload
+
+
+async def _wait(events: Iterable[asyncio.Event], timeout: float) -> None:
+    """Ожидание любого из событий не дольше timeout"""
+    waiters = [asyncio.ensure_future(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+# --- Ingress ---
+
+async def _confirm_offset(bot: Bot, database: Database, offset: int) -> None:
+    """
+    Подтверждение offset перед остановкой
+
+    getUpdates подтверждает обновления только следующим вызовом; без него после перезапуска
+    Telegram вернёт последнюю пачку, а уже обработанные строки из очереди удалены.
+    """
+    while True:
+        updates = await bot.get_updates(offset=offset, timeout=0, limit=100)
+        if not updates:
+            return
+        await database.enqueue_updates([queue_record(update) for update in updates])
+        offset = updates[-1].update_id + 1
+
+
+async def run_ingress(bot: Bot, dp: Dispatcher, database: Database = db) -> None:
+    """Приём обновлений long polling'ом и запись в очередь до SIGTERM/SIGINT"""
+    allowed_updates = dp.resolve_used_update_types()
+    offset: Optional[int] = None
+    backoff = 1.0
+    stop = asyncio.Event()
+
+    with stop_on_signals(stop):
+        logger.info(f"Ingress started ({UPDATE_QUEUE_SHARDS} shards, updates: {', '.join(allowed_updates)})")
+        while not stop.is_set():
+            poll = asyncio.ensure_future(bot.get_updates(
+                offset=offset, timeout=INGRESS_POLL_TIMEOUT_SEC, allowed_updates=allowed_updates,
+            ))
+            stopped = asyncio.ensure_future(stop.wait())
+            await asyncio.wait([poll, stopped], return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if not poll.done():
+                # Обновления ещё не получены — offset не сдвигался, ничего не теряется
+                poll.cancel()
+                with suppress(asyncio.CancelledError):
+                    await poll
+                break
+
+            try:
+                updates = poll.result()
+                if updates:
+                    await database.enqueue_updates([queue_record(update) for update in updates])
+                    offset = updates[-1].update_id + 1
+                    logger.debug(f"Enqueued {len(updates)} update(s)")
+                backoff = 1.0
+            except Exception as e:
+                # Offset сдвигается только после записи, поэтому пачка будет получена повторно
+                logger.error(f"Ingress error: {e}, retrying in {backoff:.0f}s")
+                await _wait([stop], timeout=backoff)
+                backoff = min(backoff * 2, 30.0)
+
+        if offset is not None:
+            try:
+                await _confirm_offset(bot, database, offset)
+            except Exception as e:
+                logger.warning(f"Failed to confirm update offset: {e}")
+    logger.info("Ingress stopped")
+
+
+# --- Воркер ---
+
+class UpdateWorker:
+    """Обработка обновлений арендованных шардов через роутеры диспетчера"""
+
+    def __init__(self, bot: Bot, dp: Dispatcher, database: Database = db,
+                 shard_count: int = UPDATE_QUEUE_SHARDS, lease_sec: int = UPDATE_QUEUE_LEASE_SEC,
+                 max_inflight: int = UPDATE_WORKER_MAX_INFLIGHT, batch_size: int = UPDATE_QUEUE_BATCH_SIZE,
+                 poll_interval: float = UPDATE_QUEUE_POLL_INTERVAL_SEC, **workflow_data: Any):
+        self.bot = bot
+        self.dp = dp
+        self.db = database
+        self.shard_count = shard_count
+        self.lease_sec = lease_sec
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.workflow_data = workflow_data
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        # Арендованные шарды; draining — шарды, которые будут отданы после завершения их обновлений
+        self.owned: Set[int] = set()
+        self.draining: Set[int] = set()
+        # Последний взятый в работу id по шарду
+        self._cursors: Dict[int, int] = {}
+        self._inflight: Dict[int, int] = {}
+        # Последняя задача пользователя: следующая задача ждёт её завершения
+        self._user_tails: Dict[int, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._listener: Optional[asyncpg.Connection] = None
+        # Обработанные строки удаляются пакетами
+        self._acks = BatchWriter('update_queue_ack', self.db.ack_updates, flush_interval=0.2)
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'worker_id': self.worker_id,
+            'shards': len(self.owned),
+            'draining': len(self.draining),
+            'inflight': self.inflight,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+    async def run(self, stop: asyncio.Event) -> None:
+        """Обработка до установки stop, затем дожидание текущих обновлений и возврат шардов"""
+        await self.db.seed_update_shards(self.shard_count)
+        await self._listen()
+        self._acks.start()
+        await self._rebalance()
+        lease_task = asyncio.create_task(self._lease_loop(), name="update-worker-lease")
+        logger.info(f"Update worker {self.worker_id} started with {len(self.owned)} shard(s)")
+        try:
+            await self._fetch_loop(stop)
+        finally:
+            try:
+                await self._drain()
+            finally:
+                lease_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await lease_task
+                await self._shutdown()
+        logger.info(f"Update worker {self.worker_id} stopped: {self.snapshot()}")
+
+    # --- Уведомления ---
+
+    async def _listen(self) -> None:
+        try:
+            self._listener = await self.db.pool.acquire()
+            await self._listener.add_listener(UPDATE_QUEUE_CHANNEL, self._on_notify)
+        except DB_ERRORS as e:
+            logger.warning(f"LISTEN {UPDATE_QUEUE_CHANNEL} failed, polling every {self.poll_interval}s: {e}")
+            await self._unlisten()
+
+    async def _unlisten(self) -> None:
+        if self._listener is None:
+            return
+        listener, self._listener = self._listener, None
+        try:
+            await listener.remove_listener(UPDATE_QUEUE_CHANNEL, self._on_notify)
+            await self.db.pool.release(listener)
+        except DB_ERRORS as e:
+            logger.debug(f"Update queue listener release failed: {e}")
+
+    def _on_notify(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        active = self.owned - self.draining
+        if any(int(shard) in active for shard in payload.split(',') if shard):
+            self._wakeup.set()
+
+    # --- Чтение очереди ---
+
+    async def _fetch_loop(self, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            self._wakeup.clear()
+            try:
+                fetched = await self._fetch()
+            except DB_ERRORS as e:
+                logger.warning(f"Update queue fetch failed: {e}")
+                fetched = 0
+            if fetched and self.inflight < self.max_inflight:
+                # В шардах могут оставаться обновления сверх пачки
+                continue
+            await _wait([self._wakeup, stop], timeout=self.poll_interval)
+
+    async def _fetch(self) -> int:
+        shards = sorted(self.owned - self.draining)
+        capacity = self.max_inflight - self.inflight
+        if not shards or capacity <= 0:
+            return 0
+        per_shard = max(1, min(self.batch_size, capacity // len(shards)))
+        rows = await self.db.fetch_queued_updates(
+            shards, [self._cursors.get(shard, 0) for shard in shards], per_shard,
+        )
+        for row in rows:
+            shard = row['shard']
+            # Шард могли отдать, пока шёл запрос
+            if shard not in self.owned or shard in self.draining:
+                continue
+            self._cursors[shard] = max(self._cursors.get(shard, 0), row['id'])
+            self._dispatch(row['id'], shard, row['user_id'], row['payload'])
+        return len(rows)
+
+    def _dispatch(self, queue_id: int, shard: int, user_id: Optional[int], payload: str) -> None:
+        previous = self._user_tails.get(user_id) if user_id is not None else None
+        self._inflight[shard] = self._inflight.get(shard, 0) + 1
+        task = asyncio.create_task(self._process(queue_id, shard, payload, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if user_id is not None:
+            self._user_tails[user_id] = task
+            task.add_done_callback(lambda done, uid=user_id: self._forget_tail(uid, done))
+
+    def _forget_tail(self, user_id: int, task: asyncio.Task) -> None:
+        if self._user_tails.get(user_id) is task:
+            del self._user_tails[user_id]
+
+    async def _process(self, queue_id: int, shard: int, payload: str, previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                # Предыдущее обновление пользователя; его ошибка не мешает следующему
+                await asyncio.wait([previous])
+            try:
+                await self.dp.feed_raw_update(self.bot, json.loads(payload), **self.workflow_data)
+                self.processed += 1
+            except asyncio.CancelledError:
+                # Ожидание RAG сохранено и продолжится после запуска: повтор обновления задал бы вопрос снова
+                if shutdown.is_saved(asyncio.current_task()):
+                    self._acks.add(queue_id)
+                raise
+            except Exception as e:
+                # Ошибку уже видели middleware и обработчики ошибок; повтор её не исправит
+                self.failed += 1
+                logger.error(f"Error processing queued update {queue_id}: {e}")
+            # Отмена (остановка воркера) не подтверждает строку — её обработает следующий владелец
+            self._acks.add(queue_id)
+        finally:
+            self._inflight[shard] -= 1
+            if not self._inflight[shard]:
+                del self._inflight[shard]
+            self._wakeup.set()
+
+    # --- Аренда шардов ---
+
+    async def _lease_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_sec / 3)
+            try:
+                await self._rebalance()
+            except DB_ERRORS as e:
+                logger.warning(f"Update shard lease renewal failed: {e}")
+
+    def _forget_shards(self, shards: Iterable[int]) -> None:
+        for shard in shards:
+            self.owned.discard(shard)
+            self.draining.discard(shard)
+            self._cursors.pop(shard, None)
+
+    async def _rebalance(self) -> None:
+        """Продление аренды, возврат лишних шардов и захват недостающих до равной доли"""
+        workers = await self.db.worker_heartbeat(self.worker_id, self.lease_sec)
+        target = math.ceil(self.shard_count / max(workers, 1))
+
+        if self.owned:
+            kept = set(await self.db.renew_update_shards(self.worker_id, self.lease_sec, sorted(self.owned)))
+            lost = self.owned - kept
+            if lost:
+                # Аренда истекла (например, база была недоступна) и шард забрал другой воркер
+                logger.warning(f"Lost lease on shard(s) {sorted(lost)}")
+                self._forget_shards(lost)
+
+        active = sorted(self.owned - self.draining)
+        if len(active) > target:
+            self.draining.update(active[target:])
+
+        drained = [shard for shard in self.draining if not self._inflight.get(shard)]
+        if drained:
+            # Новый владелец начнёт с неудалённых строк, поэтому подтверждения должны дойти до базы
+            await self._acks.flush()
+            if not len(self._acks):
+                await self.db.release_update_shards(self.worker_id, drained)
+                self._forget_shards(drained)
+                logger.info(f"Released {len(drained)} shard(s), {workers} worker(s) alive")
+
+        missing = target - len(self.owned)
+        if missing > 0:
+            claimed = await self.db.claim_update_shards(self.worker_id, self.lease_sec, missing, self.shard_count)
+            if claimed:
+                self.owned.update(claimed)
+                self._wakeup.set()
+                logger.info(f"Claimed {len(claimed)} shard(s), owning {len(self.owned)}/{self.shard_count}")
+
+    # --- Остановка ---
+
+    async def _drain(self) -> None:
+        self.draining.update(self.owned)
+        # Прерванные обновления без сохранённого ожидания RAG не подтверждаются и будут доставлены снова
+        await shutdown.drain(self._tasks)
+
+    async def _shutdown(self) -> None:
+        await self._acks.stop()
+        try:
+            # Шарды с неподтверждёнными строками не возвращаются: аренда истечёт сама
+            releasable = [shard for shard in self.owned if not self._inflight.get(shard)]
+            if releasable and not len(self._acks):
+                await self.db.release_update_shards(self.worker_id, releasable)
+                self._forget_shards(releasable)
+            await self.db.remove_worker(self.worker_id)
+        except DB_ERRORS as e:
+            logger.warning(f"Update worker cleanup failed, leases will expire: {e}")
+        await self._unlisten()
+
+
+async def run_worker(bot: Bot, dp: Dispatcher, database: Database = db) -> None:
+    """Обработка очереди до SIGTERM/SIGINT с событиями startup/shutdown диспетчера, как у polling"""
+    workflow_data = {'dispatcher': dp, 'bots': [bot], **dp.workflow_data}
+    workflow_data.pop('bot', None)
+    worker = UpdateWorker(bot, dp, database, **workflow_data)
+    stop = asyncio.Event()
+
+    await dp.emit_startup(bot=bot, **workflow_data)
+    try:
+        with stop_on_signals(stop):
+            await worker.run(stop)
+    finally:
+        await dp.emit_shutdown(bot=bot, **workflow_data)
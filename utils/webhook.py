@@ -0,0 +1,92 @@
+"""
+Режим webhook: приём обновлений Telegram встроенным aiohttp-сервером
+
+TLS завершается в nginx (nginx.conf проксирует на bot:8000), бот слушает обычный HTTP.
+Ответ 200 отдаётся сразу, обработка обновления идёт в фоновой задаче.
+При перегрузке планировщик обработчиков задерживает ответ, и Telegram сам снижает темп.
+"""
+import asyncio
+import os
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from utils.helpers import stop_on_signals
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Публичный адрес (https://your-domain.com); если не задан, setWebhook не вызывается
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8000))
+# Максимум одновременных HTTPS-соединений Telegram к боту (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+
+
+async def healthz(request: web.Request) -> web.Response:
+    """Проверка живости для nginx и оркестратора"""
+    return web.Response(text="ok")
+
+
+def create_app(bot: Bot, dp: Dispatcher, secret_token: Optional[str] = None,
+               handle_in_background: bool = True) -> web.Application:
+    """
+    aiohttp-приложение с обработчиком webhook
+
+    Args:
+        bot: Экземпляр бота
+        dp: Диспетчер с подключёнными роутерами
+        secret_token: Ожидаемый заголовок X-Telegram-Bot-Api-Secret-Token (иначе 401)
+        handle_in_background: Отвечать до обработки; False, если обработчики в фоне
+            запускает планировщик (utils/scheduler.py) — тогда ответ задерживается при перегрузке
+    """
+    app = web.Application()
+    app.router.add_get('/healthz', healthz)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token or None,
+        handle_in_background=handle_in_background,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, handle_in_background: bool = True) -> None:
+    """Запуск HTTP-сервера и ожидание SIGTERM/SIGINT"""
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests are not authenticated")
+
+    app = create_app(bot, dp, WEBHOOK_SECRET, handle_in_background)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    stop = asyncio.Event()
+    try:
+        with stop_on_signals(stop):
+            site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+            await site.start()
+            logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+            if WEBHOOK_URL:
+                # Несколько реплик вызывают setWebhook с одинаковыми параметрами — это безопасно
+                await bot.set_webhook(
+                    url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET or None,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=dp.resolve_used_update_types(),
+                )
+                logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH} (max_connections={WEBHOOK_MAX_CONNECTIONS})")
+            else:
+                logger.info("WEBHOOK_URL is not set, skipping setWebhook")
+
+            await stop.wait()
+            logger.info("Stopping webhook server...")
+    finally:
+        # Вызывает shutdown диспетчера и закрывает сессию бота
+        await runner.cleanup()